@@ -0,0 +1,4 @@
+"""Benchmarks of the UserSpace methods against a local PostgreSQL server.
+
+Run with ``python -m benchmarks --help``. See benchmarks/run.py.
+"""
@@ -0,0 +1,438 @@
+"""Throughput and latency of the UserSpace methods.
+
+Creates a throwaway database on a local PostgreSQL server (by default the
+one libpq finds through PGHOST, PGPORT, PGUSER...), loads it with users and
+with sessions tables of increasing sizes, and for each size runs each
+operation for a fixed time on several threads or processes. For every run
+the operations per second and the 50th and 99th percentile latencies are
+written out as JSON, along with the versions and settings involved, so that
+the results of two releases can be compared with --compare.
+
+The passwords are hashed with PBKDF2 and only 1000 iterations by default,
+to measure the database work rather than the hashing; see --iterations.
+kill_sessions runs last for each size, as it deletes the sessions of the
+users it is called on.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import psycopg2
+
+import pgusers
+
+
+def session_key(index):
+    return hashlib.md5(f"bench{index}".encode("ascii")).hexdigest()
+
+
+def op_create_user(usp, rng, ctx):
+    name = "c" + os.urandom(8).hex()
+    usp.create_user(name, "password", f"{name}@bench.test")
+
+
+def op_validate_user(usp, rng, ctx):
+    usp.validate_user(f"user{rng.randrange(ctx['users'])}", "password")
+
+
+def op_check_key(usp, rng, ctx):
+    usp.check_key(session_key(rng.randrange(ctx["sessions"])))
+
+
+def op_find_user(usp, rng, ctx):
+    usp.find_user(username=f"user{rng.randrange(ctx['users'])}")
+
+
+def op_all_users(usp, rng, ctx):
+    for row in usp.all_users():
+        pass
+
+
+def op_kill_sessions(usp, rng, ctx):
+    usp.kill_sessions(rng.choice(ctx["userids"]))
+
+
+OPERATIONS = {
+    "create_user": op_create_user,
+    "validate_user": op_validate_user,
+    "check_key": op_check_key,
+    "find_user": op_find_user,
+    "all_users": op_all_users,
+    "kill_sessions": op_kill_sessions,
+}
+
+
+def run_worker(usp, operation, ctx, seed, warmup, duration, max_ops):
+    """Run operation for warmup seconds, then for duration seconds or
+    max_ops times.
+    @return tuple(latencies, elapsed) the latencies of the timed calls and
+            the seconds they took altogether.
+    """
+    func = OPERATIONS[operation]
+    rng = random.Random(seed)
+    until = time.perf_counter() + warmup
+    while time.perf_counter() < until:
+        func(usp, rng, ctx)
+    latencies = []
+    start = time.perf_counter()
+    until = start + duration
+    now = start
+    while now < until and len(latencies) < max_ops:
+        func(usp, rng, ctx)
+        last, now = now, time.perf_counter()
+        latencies.append(now - last)
+    return latencies, now - start
+
+
+def make_userspace(dbname, conn_args, options, maxconn=None):
+    return pgusers.UserSpace(
+        dbname,
+        maxconn=maxconn,
+        hasher=pgusers.PBKDF2Hasher(options["iterations"]),
+        **conn_args,
+    )
+
+
+def _process_worker(dbname, conn_args, options, operation, ctx, seed):
+    usp = make_userspace(dbname, conn_args, options)
+    try:
+        return run_worker(
+            usp,
+            operation,
+            ctx,
+            seed,
+            options["warmup"],
+            options["duration"],
+            options["max_ops"],
+        )
+    finally:
+        usp.close()
+
+
+def run_threads(usp, operation, ctx, workers, options, seed):
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(
+                run_worker,
+                usp,
+                operation,
+                ctx,
+                seed + n,
+                options["warmup"],
+                options["duration"],
+                options["max_ops"],
+            )
+            for n in range(workers)
+        ]
+        return [future.result() for future in futures]
+
+
+def run_processes(dbname, conn_args, operation, ctx, workers, options, seed):
+    # spawned, not forked: the parent's connections must not be shared
+    mp = multiprocessing.get_context("spawn")
+    with mp.Pool(workers) as pool:
+        return pool.starmap(
+            _process_worker,
+            [
+                (dbname, conn_args, options, operation, ctx, seed + n)
+                for n in range(workers)
+            ],
+        )
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(operation, sessions, mode, workers, outcomes):
+    latencies = sorted(lat for lats, elapsed in outcomes for lat in lats)
+    return {
+        "operation": operation,
+        "sessions": sessions,
+        "mode": mode,
+        "workers": workers,
+        "ops": len(latencies),
+        "ops_per_sec": sum(
+            len(lats) / elapsed for lats, elapsed in outcomes if elapsed
+        ),
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def create_database(dbname, conn_args, recreate):
+    admin = psycopg2.connect(dbname="postgres", **conn_args)
+    admin.autocommit = True
+    with admin.cursor() as cr:
+        cr.execute("select 1 from pg_database where datname = %s", (dbname,))
+        if cr.fetchone():
+            if not recreate:
+                admin.close()
+                raise SystemExit(
+                    f"Database '{dbname}' exists, pass --recreate to drop it first"
+                )
+            cr.execute(f'drop database "{dbname}"')
+        cr.execute(f'create database "{dbname}"')
+    admin.close()
+
+
+def drop_database(dbname, conn_args):
+    admin = psycopg2.connect(dbname="postgres", **conn_args)
+    admin.autocommit = True
+    with admin.cursor() as cr:
+        cr.execute(f'drop database if exists "{dbname}"')
+    admin.close()
+
+
+def load_users(usp, users):
+    usp.create_users(
+        ((f"user{n}", "password", f"user{n}@bench.test") for n in range(users)),
+        batch_size=10000,
+    )
+    with usp._cursor() as cr:
+        cr.execute("select userid from users order by userid")
+        userids = [row[0] for row in cr.fetchall()]
+        cr.connection.commit()
+    return userids
+
+
+def load_sessions(usp, userids, sessions):
+    """Replace the sessions with sessions rows, keyed by session_key()"""
+    with usp._cursor() as cr:
+        cr.execute("truncate sessions")
+        cr.execute(
+            "insert into sessions (userid, key, expiration) "
+            "select (%s::integer[])[i %% %s + 1], md5('bench' || i), %s "
+            "from generate_series(0, %s - 1) as i",
+            (userids, len(userids), time.time() + 864000, sessions),
+        )
+        cr.execute("analyze sessions")
+        cr.connection.commit()
+
+
+def compare(old_path, results):
+    """Print how each result differs from the same run in old_path"""
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    previous = {
+        (r["operation"], r["sessions"], r["mode"], r["workers"]): r
+        for r in old["results"]
+    }
+    print(
+        f"{'operation':14} {'sessions':>9} {'mode':>7} {'workers':>7} "
+        f"{'ops/s':>10} {'change':>8} {'p99 ms':>9} {'change':>8}",
+        file=sys.stderr,
+    )
+    for result in results:
+        key = (
+            result["operation"],
+            result["sessions"],
+            result["mode"],
+            result["workers"],
+        )
+        before = previous.get(key)
+        if before is None or not before["ops_per_sec"] or not before["p99_ms"]:
+            continue
+        speed = result["ops_per_sec"] / before["ops_per_sec"] - 1
+        p99 = (result["p99_ms"] or 0) / before["p99_ms"] - 1
+        print(
+            f"{result['operation']:14} {result['sessions']:9} {result['mode']:>7} "
+            f"{result['workers']:7} {result['ops_per_sec']:10.1f} {speed:+8.1%} "
+            f"{result['p99_ms'] or 0:9.3f} {p99:+8.1%}",
+            file=sys.stderr,
+        )
+
+
+def get_options(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the UserSpace methods on a throwaway database.",
+    )
+    parser.add_argument(
+        "--dbname",
+        default="pgusers_bench",
+        help="database created for the benchmark (default pgusers_bench)",
+    )
+    parser.add_argument(
+        "--host", help="server host or socket directory, by default libpq's"
+    )
+    parser.add_argument("--port", help="server port")
+    parser.add_argument("--user", help="database user")
+    parser.add_argument(
+        "--recreate",
+        action="store_true",
+        help="drop the database first if it already exists",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="do not drop the database at the end"
+    )
+    parser.add_argument(
+        "--users", type=int, default=10000, help="users loaded (default 10000)"
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        nargs="+",
+        default=[10000, 100000],
+        metavar="N",
+        help="sizes of the sessions table to measure with, up to 10000000 "
+        "(default 10000 100000)",
+    )
+    parser.add_argument(
+        "--operations",
+        nargs="+",
+        choices=list(OPERATIONS),
+        default=list(OPERATIONS),
+        metavar="OP",
+        help="operations to run, by default all of: " + ", ".join(OPERATIONS),
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="*",
+        default=[1, 8],
+        metavar="N",
+        help="numbers of threads sharing a pooled userspace (default 1 8)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="*",
+        default=[8],
+        metavar="N",
+        help="numbers of processes with a userspace each (default 8)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=3.0,
+        help="seconds each run is timed (default 3)",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=0.5,
+        help="seconds each worker runs before being timed (default 0.5)",
+    )
+    parser.add_argument(
+        "--max-ops",
+        type=int,
+        default=1000000,
+        help="stop a worker after this many timed calls (default 1000000)",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=1000,
+        help="PBKDF2 iterations of the passwords (default 1000)",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    parser.add_argument(
+        "--output", "-o", help="write the results to this file instead of stdout"
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="JSON",
+        help="print the changes from the results in this file",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    opts = get_options(sys.argv[1:] if argv is None else argv)
+    conn_args = {
+        name: value
+        for name, value in (
+            ("host", opts.host),
+            ("port", opts.port),
+            ("user", opts.user),
+        )
+        if value
+    }
+    options = {
+        "iterations": opts.iterations,
+        "warmup": opts.warmup,
+        "duration": opts.duration,
+        "max_ops": opts.max_ops,
+    }
+
+    create_database(opts.dbname, conn_args, opts.recreate)
+    results = []
+    try:
+        usp = make_userspace(opts.dbname, conn_args, options, max([1] + opts.threads))
+        userids = load_users(usp, opts.users)
+        with usp._cursor() as cr:
+            server_version = cr.connection.server_version
+            cr.connection.commit()
+        for sessions in sorted(opts.sessions):
+            print(f"loading {sessions} sessions", file=sys.stderr)
+            load_sessions(usp, userids, sessions)
+            ctx = {"users": opts.users, "userids": userids, "sessions": sessions}
+            for operation in opts.operations:
+                runs = [("thread", n) for n in opts.threads]
+                runs += [("process", n) for n in opts.processes]
+                for mode, workers in runs:
+                    if mode == "thread":
+                        outcomes = run_threads(
+                            usp, operation, ctx, workers, options, opts.seed
+                        )
+                    else:
+                        outcomes = run_processes(
+                            opts.dbname,
+                            conn_args,
+                            operation,
+                            ctx,
+                            workers,
+                            options,
+                            opts.seed,
+                        )
+                    result = summarize(operation, sessions, mode, workers, outcomes)
+                    results.append(result)
+                    print(
+                        "{operation:14} {sessions:9} {mode:>7} {workers:3}: "
+                        "{ops_per_sec:10.1f} ops/s, p50 {p50_ms:.3f} ms, "
+                        "p99 {p99_ms:.3f} ms".format(**result),
+                        file=sys.stderr,
+                    )
+        usp.close()
+    finally:
+        if not opts.keep:
+            drop_database(opts.dbname, conn_args)
+
+    report = {
+        "pgusers": pgusers.version,
+        "python": platform.python_version(),
+        "psycopg2": psycopg2.__version__.split()[0],
+        "server_version": server_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "settings": dict(
+            options,
+            users=opts.users,
+            seed=opts.seed,
+            threads=opts.threads,
+            processes=opts.processes,
+        ),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, "w") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+    if opts.compare:
+        compare(opts.compare, results)
+    return 0
@@ -1,4 +1,18 @@
 from .pgusers import BadCallError, UserSpace, OK, NOT_FOUND, EXPIRED, REJECTED
+from .embedded import EmbeddedUserSpace
+from .storage import Backend, MemoryBackend, SQLiteBackend
+from .hashing import (
+    HashExecutor,
+    PBKDF2Hasher,
+    ScryptHasher,
+    register_hasher,
+    calibrate,
+)
+
+try:
+    from .asyncusers import AsyncUserSpace
+except ImportError:  # psycopg 3 not installed
+    AsyncUserSpace = None
 
 __version__ = (0, 9, 3)
 version = "{0}.{1}.{2}".format(*__version__)
@@ -6,6 +20,16 @@ version = "{0}.{1}.{2}".format(*__version__)
 __all__ = [
     "BadCallError",
     "UserSpace",
+    "AsyncUserSpace",
+    "EmbeddedUserSpace",
+    "Backend",
+    "MemoryBackend",
+    "SQLiteBackend",
+    "HashExecutor",
+    "PBKDF2Hasher",
+    "ScryptHasher",
+    "register_hasher",
+    "calibrate",
     "OK",
     "NOT_FOUND",
     "EXPIRED",
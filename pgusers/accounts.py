@@ -0,0 +1,149 @@
+"""Logic of users, passwords and sessions shared by the userspaces,
+whatever they keep them in: UserSpace and EmbeddedUserSpace mix in
+Credentials, and AsyncUserSpace uses the functions.
+"""
+
+import os
+import pickle
+import time
+import binascii
+from collections.abc import Mapping
+from itertools import islice
+
+from .hashing import PBKDF2Hasher, HashExecutor, get_hasher
+from .metrics import add_time
+
+NEW_USER_FIELDS = ("username", "password", "email", "admin", "extra_data")
+USERNAME_LENGTH = 20  # sizes of the users columns
+EMAIL_LENGTH = 128
+
+
+def new_session_key():
+    """Return a new random session key, 32 hexadecimal digits"""
+    return os.urandom(16).hex()
+
+
+def renewed_expiration(expiration, now, ttl, refresh_threshold):
+    """Return the expiration a session should have when checked at now:
+    None if it has expired, now + ttl if less than refresh_threshold * ttl
+    was left, or else the same
+    """
+    if expiration < now:
+        return None
+    if expiration - now < ttl * refresh_threshold:
+        return now + ttl
+    return expiration
+
+
+def new_user(user):
+    """Return a user given to create_users() as a dictionary"""
+    if isinstance(user, Mapping):
+        return user
+    return dict(zip(NEW_USER_FIELDS, user))
+
+
+def _text_fits(value, length):
+    return isinstance(value, str) and len(value) <= length and "\x00" not in value
+
+
+def user_problem(user):
+    """Why a user given to create_users() cannot be created, None if it can"""
+    if not (user.get("username") and user.get("password")):
+        return "missing field"
+    if not _text_fits(user["username"], USERNAME_LENGTH):
+        return "invalid username"
+    if not isinstance(user["password"], str):
+        return "invalid password"
+    email = user.get("email")
+    if email is not None and not _text_fits(email, EMAIL_LENGTH):
+        return "invalid email"
+    return None
+
+
+class Credentials:
+    """Mixin hashing and checking the passwords of a userspace with its
+    hasher, on its hash_executor if any, and creating users in batches.
+    """
+
+    hasher = PBKDF2Hasher()  # hasher for new passwords
+    hash_executor = None  # HashExecutor, to hash passwords off the caller's thread
+
+    def _hash(self, password, salt, hasher=None):
+        hasher = hasher or self.hasher
+        start = time.perf_counter()
+        try:
+            if self.hash_executor is not None:
+                return self.hash_executor.run(hasher.hash, password, salt)
+            return hasher.hash(password, salt)
+        finally:
+            add_time("hash", time.perf_counter() - start)
+
+    def _new_password(self, password):
+        """Hash password with a new salt.
+        @return tuple(kpasswd, salt, hasher) as stored in the users table
+        """
+        salt = os.urandom(16)
+        return self._hash(password, salt).hex(), salt.hex(), self.hasher.descriptor
+
+    def _check_password(self, password, salt, kpasswd, hasher):
+        """Check password against the stored salt, kpasswd and hasher.
+        @return tuple(valid, rehash), rehash being True if the password is
+                valid and was hashed otherwise than with the current hasher.
+        """
+        stored_hasher = get_hasher(hasher)
+        hpwd = self._hash(password, binascii.unhexlify(salt), stored_hasher)
+        if binascii.unhexlify(kpasswd) != hpwd:
+            return False, False
+        return True, stored_hasher.descriptor != self.hasher.descriptor
+
+    def _create_in_batches(self, users, batch_size):
+        """Feed users to self._create_batch(batch, executor, failures),
+        batch_size at a time, as a list of (index, user)
+        @return tuple(created, failures) as returned by create_users()
+        """
+        executor = self.hash_executor or HashExecutor()
+        created = 0
+        failures = []
+        try:
+            users = enumerate(users)
+            while True:
+                batch = list(islice(users, batch_size))
+                if not batch:
+                    break
+                created += self._create_batch(batch, executor, failures)
+        finally:
+            if executor is not self.hash_executor:
+                executor.shutdown()
+        failures.sort()
+        return created, failures
+
+    def _hash_batch(self, batch, executor, failures, dump_extra):
+        """Check the users of a batch and hash their passwords in parallel.
+        The users that cannot be created are added to failures.
+        @param dump_extra Function encoding the extra_data of a user.
+        @return List of (index, user, extra, kpasswd, salt) tuples, kpasswd
+                and salt as stored in the users table.
+        """
+        pending = []
+        for index, user in batch:
+            user = new_user(user)
+            problem = user_problem(user)
+            if problem is None:
+                try:
+                    extra = dump_extra(user.get("extra_data"))
+                except (TypeError, ValueError, pickle.PicklingError):
+                    problem = "invalid extra_data"
+            if problem is not None:
+                failures.append((index, user.get("username"), problem))
+                continue
+            salt = os.urandom(16)
+            future = executor.submit(self.hasher.hash, user["password"], salt)
+            pending.append((index, user, extra, salt, future))
+
+        start = time.perf_counter()
+        rows = [
+            (index, user, extra, future.result().hex(), salt.hex())
+            for index, user, extra, salt, future in pending
+        ]
+        add_time("hash", time.perf_counter() - start)
+        return rows
@@ -0,0 +1,427 @@
+import os
+import binascii
+import time
+import json
+import asyncio
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+from .pgusers import (
+    BadCallError,
+    OK,
+    NOT_FOUND,
+    EXPIRED,
+    REJECTED,
+    dbinit,
+    _user_row,
+    _insert_error,
+    INSERT_SESSION_SQL,
+    SET_PASSWORD_SQL,
+)
+from .accounts import new_session_key, renewed_expiration
+from .hashing import PBKDF2Hasher, get_hasher
+from .extra import dump_extra, load_extra
+
+
+class AsyncUserSpace:
+    """asyncio version of UserSpace, backed by psycopg 3 and an async pool.
+
+    The methods are coroutines with the same arguments and return values
+    as the UserSpace ones. all_users() and list_sessions() are asynchronous
+    generators.
+
+    The pool must be opened before use, either with ``await usp.open()``
+    or by using the userspace as an asynchronous context manager.
+    """
+
+    ttl = 864000.0  # 10 day default session time to live
+    hash_executor = None  # HashExecutor, instead of the loop's default executor
+    hasher = PBKDF2Hasher()  # hasher for new passwords
+    refresh_threshold = 1.0  # renew expiration when less than this * ttl is left
+    json_extra = False  # store extra_data as JSON instead of pickled
+    sync_session_commit = True  # wait for new sessions to be flushed to disk
+
+    def __init__(
+        self,
+        dbname="",
+        min_size=1,
+        max_size=10,
+        timeout=30.0,
+        hash_executor=None,
+        hasher=None,
+        json_extra=False,
+        sync_session_commit=True,
+        **kwargs,
+    ):
+        """Set up (but do not open) the connection pool.
+        @param dbname   Name of the database holding the userspace.
+        @param min_size Connections kept open in the pool.
+        @param max_size Maximum number of connections in the pool.
+        @param timeout  Seconds to wait for a free connection.
+        @param hash_executor A HashExecutor to compute the password hashes
+                        on, instead of the event loop's default executor.
+        @param hasher   The password hasher for new passwords.
+                        See UserSpace.__init__()
+        @param json_extra If True, store extra_data as JSON.
+                        See UserSpace.__init__()
+        @param sync_session_commit If False, logins commit with
+                        synchronous_commit off. See UserSpace.__init__()
+
+        The rest of the keyword arguments are connection parameters.
+        """
+        if not dbname:
+            raise BadCallError("No name for UserSpace")
+        self.dbname = dbname
+        self.connection_args = kwargs
+        self.hash_executor = hash_executor
+        self.hasher = hasher or PBKDF2Hasher()
+        self.json_extra = json_extra
+        self.sync_session_commit = sync_session_commit
+        self.conninfo = make_conninfo(dbname=dbname, **kwargs)
+        self.pool = AsyncConnectionPool(
+            self.conninfo,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            open=False,
+        )
+
+    async def open(self):
+        """Create the database structure if needed and open the pool"""
+        await asyncio.get_running_loop().run_in_executor(None, self._dbinit)
+        await self.pool.open()
+        return self
+
+    def _dbinit(self):
+        with psycopg.connect(self.conninfo) as conn:
+            dbinit(conn)
+
+    async def _hash(self, password, salt, hasher=None):
+        """Password hash, computed off the event loop"""
+        hasher = hasher or self.hasher
+        loop = asyncio.get_running_loop()
+        if self.hash_executor is not None:
+            # HashExecutor.run() may block waiting for room in its queue
+            return await loop.run_in_executor(
+                None, self.hash_executor.run, hasher.hash, password, salt
+            )
+        return await loop.run_in_executor(None, hasher.hash, password, salt)
+
+    def _dump_extra(self, extra_data):
+        try:
+            return dump_extra(extra_data, self.json_extra)
+        except TypeError as err:
+            raise BadCallError(f"extra_data cannot be stored as JSON: {err}")
+
+    async def close(self):
+        await self.pool.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def create_user(
+        self, username, password, email, admin=False, extra_data=None
+    ):
+        """Create a user in the UserSpace's database.
+        See UserSpace.create_user()
+        @return Integer representing the user id
+        """
+        salt = os.urandom(16)
+        kpasswd = await self._hash(password, salt)
+        edata, ejson = self._dump_extra(extra_data)
+        async with self.pool.connection() as conn:
+            try:
+                cr = await conn.execute(
+                    "insert into users "
+                    "(username, email, salt, kpasswd, hasher, admin, "
+                    "extra_data, extra_json) "
+                    "values (%s, %s, %s, %s, %s, %s, %s, %s::jsonb) returning userid",
+                    (
+                        username,
+                        email,
+                        salt.hex(),
+                        kpasswd.hex(),
+                        self.hasher.descriptor,
+                        admin,
+                        edata,
+                        ejson,
+                    ),
+                )
+            except (psycopg.IntegrityError, psycopg.DataError) as err:
+                raise BadCallError(_insert_error(err, username, email))
+            userid = (await cr.fetchone())[0]
+        return userid
+
+    async def is_admin(self, userid):
+        """True if a user is admin. See UserSpace.is_admin()"""
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(
+                "select admin from users where userid = %s", (userid,)
+            )
+            row = await cr.fetchone()
+        if row is None:
+            raise BadCallError("User {} not found.".format(userid))
+        return row[0]
+
+    async def set_admin(self, userid, admin=True):
+        """Mark the user as admin"""
+        admin = True if admin else False
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "update users set admin = %s where userid = %s", (admin, userid)
+            )
+
+    async def validate_user(self, username, password, extra_data=None):
+        """Validates (or logs in) a username. See UserSpace.validate_user()
+        @return tuple(key, admin, userid)
+        """
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(
+                "select userid, salt, kpasswd, admin, hasher "
+                "from users where username = %s",
+                (username,),
+            )
+            row = await cr.fetchone()
+        if row is None:
+            return "", False, None
+        userid, salt, kpasswd, admin, hasher = row
+        stored_hasher = get_hasher(hasher)
+        hpwd = await self._hash(password, binascii.unhexlify(salt), stored_hasher)
+        if binascii.unhexlify(kpasswd) != hpwd:
+            return "", False, None
+        rehash = None
+        if stored_hasher.descriptor != self.hasher.descriptor:
+            rehash = await self._password_args(userid, password)
+        return await self._make_session_key(userid, extra_data, rehash), admin, userid
+
+    async def _password_args(self, userid, password):
+        salt = os.urandom(16)
+        hashpwd = await self._hash(password, salt)
+        return (hashpwd.hex(), salt.hex(), self.hasher.descriptor, userid)
+
+    async def _set_password(self, userid, password):
+        args = await self._password_args(userid, password)
+        async with self.pool.connection() as conn:
+            await conn.execute(SET_PASSWORD_SQL, args)
+
+    async def _make_session_key(self, userid, extra_data, rehash=None):
+        now = time.time()
+        timeout = self.ttl + now
+        sessid = new_session_key()
+        edata, ejson = self._dump_extra(extra_data)
+        statements = [(INSERT_SESSION_SQL, (userid, sessid, timeout, edata, ejson))]
+        if rehash is not None:
+            statements.append((SET_PASSWORD_SQL, rehash))
+        if not self.sync_session_commit:
+            statements.insert(0, ("set local synchronous_commit = off", None))
+        # one transaction, pipelined where libpq supports it
+        async with self.pool.connection() as conn:
+            if psycopg.Pipeline.is_supported():
+                async with conn.pipeline():
+                    for sql, args in statements:
+                        await conn.execute(sql, args)
+            else:
+                for sql, args in statements:
+                    await conn.execute(sql, args)
+        return sessid
+
+    async def delete_user(self, username=None, userid=None):
+        """Delete a user given either its username or userid.
+        @return OK if deleted, NOT_FOUND if not found.
+        """
+        if username is not None:
+            query, value = "delete from users where username = %s", username
+        elif userid is not None:
+            query, value = "delete from users where userid = %s", userid
+        else:
+            raise BadCallError(
+                "delete_user(): Either 'username'" + " or 'userid' must be specified."
+            )
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(query, (value,))
+            return OK if cr.rowcount else NOT_FOUND
+
+    async def change_password(self, userid, newpassword, oldpassword=None):
+        """Change a user's password. See UserSpace.change_password()
+        @returns OK, NOT_FOUND or REJECTED
+        """
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(
+                "select username from users where userid = %s", (userid,)
+            )
+            row = await cr.fetchone()
+        if row is None:
+            return NOT_FOUND
+
+        if oldpassword is not None:
+            key, admin, uid = await self.validate_user(row[0], oldpassword)
+            if not key:
+                return REJECTED
+            await self._kill_session(key)
+
+        await self._set_password(userid, newpassword)
+        return OK
+
+    async def _kill_session(self, key):
+        async with self.pool.connection() as conn:
+            await conn.execute("delete from sessions where key = %s", (key,))
+
+    async def check_key(self, key):
+        """Reset the session timeout. See UserSpace.check_key()
+        @returns    Tuple of the form (rc, username, userid, extra_data)
+        """
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(
+                """select t1.userid, t1.expiration, t1.extra_data,
+                          t1.extra_json::text, t2.username
+                from sessions as t1, users as t2
+                where  t1.userid = t2.userid and
+                       t1.key = %s""",
+                (key,),
+            )
+            session_row = await cr.fetchone()
+            if session_row is None:
+                return (NOT_FOUND, None, None, None)
+            now = time.time()
+            uid, timeout, extra, extra_json, username = session_row
+            expiration = renewed_expiration(
+                timeout, now, self.ttl, self.refresh_threshold
+            )
+            if expiration is None:
+                await conn.execute("delete from sessions where key = %s", (key,))
+                return (EXPIRED, None, None, None)
+
+            if expiration != timeout:
+                await conn.execute(
+                    "update sessions set expiration = %s where key = %s",
+                    (expiration, key),
+                )
+        return (OK, username, uid, load_extra(extra, extra_json))
+
+    def set_session_TTL(self, secs):
+        """Sets the TTL for all sessions."""
+        self.ttl = secs
+
+    def set_refresh_threshold(self, fraction):
+        """Sets when check_key() renews the expiration of a session.
+        See UserSpace.set_refresh_threshold()
+        """
+        if not 0.0 <= fraction <= 1.0:
+            raise BadCallError("Refresh threshold must be between 0 and 1")
+        self.refresh_threshold = fraction
+
+    async def find_user(self, username=None, email=None, userid=None):
+        """Find a user given either its username, its email or its userid.
+        @returns A dictionary with fields userid, username, email, admin, and extra_data
+                 None if not found.
+        """
+        query_stmt = (
+            "select userid, username, email, admin, extra_data, "
+            "extra_json::text from users where {} = %s"
+        )
+        if username is not None:
+            query, value = query_stmt.format("username"), username
+        elif email is not None:
+            query, value = query_stmt.format("email"), email
+        elif userid is not None:
+            query, value = query_stmt.format("userid"), userid
+        else:
+            raise BadCallError(
+                "find_user(): Either 'username', "
+                "'email' or 'userid' must be specified."
+            )
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(query, (value,))
+            row = await cr.fetchone()
+        return _user_row(row)
+
+    async def find_users_by_extra(self, **criteria):
+        """Find the users whose extra_data contains the given items.
+        See UserSpace.find_users_by_extra()
+        """
+        try:
+            contained = json.dumps(criteria)
+        except TypeError as err:
+            raise BadCallError(f"find_users_by_extra(): {err}")
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(
+                "select userid, username, email, admin, extra_data, "
+                "extra_json::text from users where extra_json @> %s::jsonb "
+                "order by username",
+                (contained,),
+            )
+            rows = await cr.fetchall()
+        return [_user_row(row) for row in rows]
+
+    async def modify_user(self, userid, username=None, email=None, extra_data=None):
+        """Modify user data. See UserSpace.modify_user()
+        @returns OK if successful NOT_FOUND if not.
+        """
+        fields_sql = []
+        fields_list = []
+        if username is not None:
+            fields_sql.append("username = %s")
+            fields_list.append(username)
+        if email is not None:
+            fields_sql.append("email = %s")
+            fields_list.append(email)
+        if extra_data is not None:
+            fields_sql.append("extra_data = %s, extra_json = %s::jsonb")
+            fields_list.extend(self._dump_extra(extra_data))
+        if not fields_list:
+            return OK
+
+        query = "update users set " + ", ".join(fields_sql) + " where userid = %s"
+        fields_list.append(userid)
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(query, fields_list)
+            return OK if cr.rowcount > 0 else NOT_FOUND
+
+    async def all_users(self):
+        """Async generator yielding (userid, username, email, admin) tuples"""
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(
+                "select userid, username, email, admin from users order by username"
+            )
+            async for row in cr:
+                yield row
+
+    async def list_sessions(self, uid, expired=False):
+        """Async generator yielding (username, key, expiration) tuples.
+        See UserSpace.list_sessions()
+        """
+        sql = """select u.username, s.key, s.expiration
+                 from sessions s
+                 inner join users u on (s.userid = u.userid) """
+        conds, args = _session_conditions("s.", uid, expired)
+        async with self.pool.connection() as conn:
+            cr = await conn.execute(sql + conds, args)
+            async for row in cr:
+                yield row
+
+    async def kill_sessions(self, uid, expired=False):
+        """Kill the sessions for a user or for all users if uid is 0."""
+        conds, args = _session_conditions("", uid, expired)
+        async with self.pool.connection() as conn:
+            await conn.execute("delete from sessions " + conds, args)
+
+
+def _session_conditions(prefix, uid, expired):
+    """Where clause and arguments selecting the sessions of uid (all if 0),
+    possibly restricted to the expired ones"""
+    conds = []
+    args = []
+    if uid != 0:
+        conds.append(f"({prefix}userid = %s)")
+        args.append(uid)
+    if expired:
+        conds.append(f"({prefix}expiration < %s)")
+        args.append(time.time())
+    if not conds:
+        return "", args
+    return "where " + " and ".join(conds), args
@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+CachedSession = namedtuple(
+    "CachedSession", "username userid extra_data expiration cached_at"
+)
+
+
+class SessionCache:
+    """Bounded in-memory cache of validated sessions.
+
+    Entries are evicted in least recently used order once there are more
+    than ``max_size`` of them. An entry is only trusted for ``max_age``
+    seconds after it was read from the database, which bounds how long a
+    session killed by another process can still be seen as valid here.
+    """
+
+    def __init__(self, max_size=10000, max_age=60.0):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, now):
+        """Return the CachedSession for key, or None if absent or stale"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expiration < now or now - entry.cached_at > self.max_age:
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, username, userid, extra_data, expiration, now):
+        with self._lock:
+            self._entries[key] = CachedSession(
+                username, userid, extra_data, expiration, now
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_user(self, userid=None, username=None):
+        """Remove all the sessions of a user given its userid or username"""
+        with self._lock:
+            stale = [
+                key
+                for key, entry in self._entries.items()
+                if entry.userid == userid or entry.username == username
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary with the cache size and counters"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,346 @@
+import time
+
+from .pgusers import BadCallError, OK, NOT_FOUND, EXPIRED, REJECTED
+from .accounts import Credentials, new_session_key, renewed_expiration
+from .extra import dump_extra, load_extra
+from .hashing import PBKDF2Hasher
+from .storage import MemoryBackend, DuplicateError, MAX_USERID
+from .throttle import LoginThrottle
+
+
+class EmbeddedUserSpace(Credentials):
+    """Userspace kept in the process, in memory or in an SQLite file,
+    instead of on a PostgreSQL server.
+
+    It has the same methods, arguments and return values as UserSpace,
+    without the features that depend on the server: pools and replicas,
+    partitions, tokens, JSON extra_data and the write-behind queue and
+    session cache, which make no difference in memory. Unlike UserSpace it
+    is not a singleton: each instance has its own backend.
+
+    It is a userspace of its own rather than a storage backend under
+    UserSpace, whose methods are written around what PostgreSQL does for
+    them (COPY, partitions, prepared statements, server-side cursors). The
+    passwords, session keys and expirations are handled by the same code,
+    in pgusers.accounts.
+    """
+
+    ttl = 864000.0  # 10 day default session time to live
+    refresh_threshold = 1.0  # renew expiration when less than this * ttl is left
+
+    def __init__(
+        self,
+        backend=None,
+        hasher=None,
+        hash_executor=None,
+        login_rate=None,
+        login_burst=10,
+        client_rate=None,
+        client_burst=None,
+    ):
+        """
+        @param backend  A storage backend, by default a new MemoryBackend.
+                        Use SQLiteBackend(path) to keep the users and
+                        sessions in a file.
+        @param hasher   The password hasher for new passwords, as for
+                        UserSpace.
+        @param hash_executor A HashExecutor to compute the password hashes on.
+        @param login_rate, login_burst, client_rate, client_burst
+                        Limits of the login attempts, as for UserSpace.
+        """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.hasher = hasher or PBKDF2Hasher()
+        self.hash_executor = hash_executor
+        if login_rate is not None or client_rate is not None:
+            self.throttle = LoginThrottle(
+                login_rate, login_burst, client_rate, client_burst
+            )
+        else:
+            self.throttle = None
+
+    def close(self):
+        self.backend.close()
+
+    def _password_fields(self, password):
+        kpasswd, salt, hasher = self._new_password(password)
+        return {"salt": salt, "kpasswd": kpasswd, "hasher": hasher}
+
+    def _insert(self, username, email, fields, admin, extra_data):
+        try:
+            return self.backend.insert_user(
+                username,
+                email,
+                fields["salt"],
+                fields["kpasswd"],
+                fields["hasher"],
+                bool(admin),
+                _dump(extra_data),
+            )
+        except DuplicateError as err:
+            raise BadCallError(_duplicate_message(err, username, email))
+
+    def create_user(self, username, password, email, admin=False, extra_data=None):
+        """Create a new user, see UserSpace.create_user()"""
+        return self._insert(
+            username, email, self._password_fields(password), admin, extra_data
+        )
+
+    def create_users(self, users, batch_size=1000):
+        """Create many users at once, see UserSpace.create_users().
+        The passwords are hashed in parallel, batch_size at a time.
+        """
+        return self._create_in_batches(users, batch_size)
+
+    def _create_batch(self, batch, executor, failures):
+        created = 0
+        for index, user, extra, kpasswd, salt in self._hash_batch(
+            batch, executor, failures, _dump
+        ):
+            try:
+                self.backend.insert_user(
+                    user["username"],
+                    user.get("email"),
+                    salt,
+                    kpasswd,
+                    self.hasher.descriptor,
+                    bool(user.get("admin", False)),
+                    extra,
+                )
+                created += 1
+            except DuplicateError as err:
+                failures.append((index, user["username"], f"{err.args[0]} exists"))
+        return created
+
+    def is_admin(self, userid):
+        """True if a user is admin, see UserSpace.is_admin()"""
+        row = self.backend.get_user("userid", userid)
+        if row is None:
+            raise BadCallError("User {} not found.".format(userid))
+        return row[6]
+
+    def set_admin(self, userid, admin=True):
+        self.backend.update_user(userid, admin=bool(admin))
+
+    def validate_user(self, username, password, extra_data=None, client=None):
+        """Log a user in, see UserSpace.validate_user()
+        @return tuple(key, admin, userid)
+        """
+        if self.throttle is not None:
+            limits = self.throttle.limits(username, client)
+            if not self.throttle.acquire(limits, time.time()):
+                return "", False, None
+        row = self.backend.get_user("username", username)
+        if row is None:
+            return "", False, None
+        userid, username, email, salt, kpasswd, hasher, admin, extra = row
+        valid, outdated = self._check_password(password, salt, kpasswd, hasher)
+        if not valid:
+            return "", False, None
+        if self.throttle is not None:
+            self.throttle.release(limits, time.time())
+        if outdated:
+            self.backend.update_user(userid, **self._password_fields(password))
+        key = new_session_key()
+        self.backend.insert_session(
+            userid, key, time.time() + self.ttl, _dump(extra_data)
+        )
+        return key, admin, userid
+
+    def delete_user(self, username=None, userid=None):
+        """Delete a user and its sessions, see UserSpace.delete_user()
+        @return OK if deleted, NOT_FOUND if not found.
+        """
+        if username is not None:
+            deleted = self.backend.delete_user("username", username)
+        elif userid is not None:
+            deleted = self.backend.delete_user("userid", userid)
+        else:
+            raise BadCallError(
+                "delete_user(): Either 'username'" + " or 'userid' must be specified."
+            )
+        return NOT_FOUND if deleted is None else OK
+
+    def change_password(self, userid, newpassword, oldpassword=None):
+        """Change a user's password, see UserSpace.change_password()
+        @returns OK, NOT_FOUND or REJECTED
+        """
+        row = self.backend.get_user("userid", userid)
+        if row is None:
+            return NOT_FOUND
+        if oldpassword is not None:
+            key, admin, uid = self.validate_user(row[1], oldpassword)
+            if not key:
+                return REJECTED
+            self.backend.delete_sessions([key])
+        self.backend.update_user(userid, **self._password_fields(newpassword))
+        return OK
+
+    def check_key(self, key):
+        """Check and renew a session, see UserSpace.check_key()
+        @returns    Tuple of the form (rc, username, userid, extra_data)
+        """
+        return self.check_keys([key])[key]
+
+    def check_keys(self, keys):
+        """Check many session keys at once, see UserSpace.check_keys()"""
+        keys = set(keys)
+        now = time.time()
+        results = {}
+        expired = []
+        renewed = []
+        for uid, key, timeout, extra, username in self.backend.get_sessions(keys):
+            expiration = renewed_expiration(
+                timeout, now, self.ttl, self.refresh_threshold
+            )
+            if expiration is None:
+                expired.append(key)
+                results[key] = (EXPIRED, None, None, None)
+                continue
+            if expiration != timeout:
+                renewed.append((key, expiration))
+            results[key] = (OK, username, uid, _load(extra))
+        if expired:
+            self.backend.delete_sessions(expired)
+        if renewed:
+            self.backend.renew_sessions(renewed)
+        for key in keys:
+            results.setdefault(key, (NOT_FOUND, None, None, None))
+        return results
+
+    def set_session_TTL(self, secs):
+        self.ttl = secs
+
+    def set_refresh_threshold(self, fraction):
+        if not 0.0 <= fraction <= 1.0:
+            raise BadCallError("Refresh threshold must be between 0 and 1")
+        self.refresh_threshold = fraction
+
+    def find_user(self, username=None, email=None, userid=None):
+        """Find a user, see UserSpace.find_user()
+        @returns A dictionary with fields userid, username, email, admin, and extra_data
+                 None if not found.
+        """
+        if username is not None:
+            row = self.backend.get_user("username", username)
+        elif email is not None:
+            row = self.backend.get_user("email", email)
+        elif userid is not None:
+            row = self.backend.get_user("userid", userid)
+        else:
+            raise BadCallError(
+                "find_user(): Either 'username', "
+                "'email' or 'userid' must be specified."
+            )
+        if row is None:
+            return None
+        return {
+            "userid": row[0],
+            "username": row[1],
+            "email": row[2],
+            "admin": row[6],
+            "extra_data": _load(row[7]),
+        }
+
+    def modify_user(self, userid, username=None, email=None, extra_data=None):
+        """Modify user data, see UserSpace.modify_user()
+        @returns OK if successful NOT_FOUND if not.
+        """
+        fields = {}
+        if username is not None:
+            fields["username"] = username
+        if email is not None:
+            fields["email"] = email
+        if extra_data is not None:
+            fields["extra_data"] = _dump(extra_data)
+        if not fields:
+            return OK
+        try:
+            found = self.backend.update_user(userid, **fields)
+        except DuplicateError as err:
+            raise BadCallError(_duplicate_message(err, username, email))
+        return OK if found else NOT_FOUND
+
+    def all_users(self, page_size=2000):
+        """Generator yielding (userid, username, email, admin) tuples for
+        all users, in username order
+        """
+        after = None
+        while True:
+            page = self.backend.users(after, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = (page[-1][1], page[-1][0])
+
+    def list_users(
+        self,
+        limit=50,
+        after=None,
+        admins_only=False,
+        username_prefix=None,
+        email_prefix=None,
+        count=False,
+    ):
+        """Return one page of users, see UserSpace.list_users().
+        The total is exact rather than estimated.
+        @return tuple(users, next_after, total)
+        """
+        if limit < 1:
+            raise BadCallError("The page limit must be at least 1")
+        if isinstance(after, str):
+            after = (after, MAX_USERID)
+        rows = self.backend.users(
+            after, limit + 1, admins_only, username_prefix, email_prefix
+        )
+        total = None
+        if count:
+            total = self.backend.count_users(admins_only, username_prefix, email_prefix)
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = (rows[-1][1], rows[-1][0])
+        return rows, next_after, total
+
+    def list_sessions(self, uid, expired=False):
+        """Generator yielding (username, key, expiration) tuples for the
+        sessions of uid, or of every user if 0, only the expired ones if
+        expired
+        """
+        yield from self.backend.sessions(uid or None, time.time() if expired else None)
+
+    def kill_sessions(self, uid, expired=False):
+        """Delete the sessions of uid, or of every user if 0, only the expired
+        ones if expired
+        """
+        self.backend.kill_sessions(uid or None, time.time() if expired else None)
+
+    def reap_sessions(self, batch_size=1000, sleep=0.1, max_batches=None):
+        """Delete the expired sessions batch_size at a time, see
+        UserSpace.reap_sessions()
+        @return The number of sessions deleted.
+        """
+        reaped = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            deleted = self.backend.delete_expired(time.time(), batch_size)
+            reaped += deleted
+            batches += 1
+            if deleted < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+        return reaped
+
+
+def _dump(extra_data):
+    return dump_extra(extra_data)[0]
+
+
+def _load(extra):
+    return load_extra(extra, None)
+
+
+def _duplicate_message(err, username, email):
+    if err.args[0] == "email":
+        return f"Email '{email}' already in database"
+    return f"User '{username}' already in database"
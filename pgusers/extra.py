@@ -0,0 +1,81 @@
+"""Encoding of the extra_data of users and sessions.
+
+extra_data is stored either pickled, in the bytea extra_data columns, or as
+JSON in the jsonb extra_json columns. Only one of the two is set on a row,
+so rows written before switching from one to the other remain readable.
+
+JSON objects are read as the database's text and only decoded when the
+application first looks into them.
+"""
+
+import json
+import pickle
+from collections.abc import Mapping
+
+
+class LazyJSON(Mapping):
+    """Read-only mapping over a JSON object, decoded on first access.
+
+    Compares equal to the dictionary it decodes to. Use dict(lazy) for a
+    copy that can be modified.
+    """
+
+    __slots__ = ("text", "_value")
+
+    def __init__(self, text):
+        self.text = text
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = json.loads(self.text)
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __repr__(self):
+        return f"LazyJSON({self.text!r})"
+
+    def __reduce__(self):
+        return (LazyJSON, (self.text,))
+
+
+def dump_extra(extra_data, as_json=False):
+    """Return the (extra_data, extra_json) column values for extra_data.
+    Raises TypeError if as_json and extra_data cannot be encoded as JSON,
+    or would not be read back the same, as with tuples or keys that are
+    not strings.
+    """
+    if isinstance(extra_data, LazyJSON):
+        if as_json:
+            return None, extra_data.text
+        extra_data = extra_data.value
+    if not as_json:
+        return pickle.dumps(extra_data), None
+    if extra_data is None:
+        return None, None
+    text = json.dumps(extra_data)
+    if json.loads(text) != extra_data:
+        raise TypeError("extra_data would not be the same read back from JSON")
+    return None, text
+
+
+def load_extra(pickled, json_text):
+    """Return the extra_data stored in a row's extra_data and extra_json
+    columns, the latter read as text.
+    """
+    if json_text is not None:
+        if json_text.startswith("{"):
+            return LazyJSON(json_text)
+        return json.loads(json_text)
+    if pickled is not None:
+        return pickle.loads(pickled)
+    return None
@@ -0,0 +1,215 @@
+import os
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+HASHERS = {}  # hasher classes by name
+
+
+def register_hasher(cls):
+    """Class decorator making a hasher class available by its name"""
+    HASHERS[cls.name] = cls
+    return cls
+
+
+def get_hasher(descriptor):
+    """Return the hasher described by a string as returned by its descriptor.
+    None, for passwords stored before hashers were recorded, is PBKDF2 with
+    SHA-512 and 100000 iterations.
+    """
+    if descriptor is None:
+        return PBKDF2Hasher()
+    name, *params = descriptor.split("$")
+    if name not in HASHERS:
+        raise ValueError(f"Unknown password hasher '{name}'")
+    return HASHERS[name].from_params(params)
+
+
+@register_hasher
+class PBKDF2Hasher:
+    """PBKDF2-HMAC, the cost being the number of iterations"""
+
+    name = "pbkdf2"
+    min_cost = 1000
+
+    def __init__(self, iterations=100000, digest="sha512"):
+        self.iterations = iterations
+        self.digest = digest
+
+    @property
+    def descriptor(self):
+        return f"{self.name}${self.digest}${self.iterations}"
+
+    @classmethod
+    def from_params(cls, params):
+        digest, iterations = params
+        return cls(int(iterations), digest)
+
+    @classmethod
+    def with_cost(cls, cost, digest="sha512"):
+        return cls(cost, digest)
+
+    @staticmethod
+    def next_cost(cost, ratio):
+        return int(cost * min(max(ratio, 1.1), 8.0))
+
+    def hash(self, password, salt):
+        return hashlib.pbkdf2_hmac(
+            self.digest, password.encode("utf-8"), salt, self.iterations
+        )
+
+
+@register_hasher
+class ScryptHasher:
+    """scrypt, the cost being the CPU/memory cost parameter n"""
+
+    name = "scrypt"
+    min_cost = 2**10
+
+    def __init__(self, n=2**14, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    @property
+    def descriptor(self):
+        return f"{self.name}${self.n}${self.r}${self.p}"
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(*(int(param) for param in params))
+
+    @classmethod
+    def with_cost(cls, cost, r=8, p=1):
+        return cls(cost, r, p)
+
+    @staticmethod
+    def next_cost(cost, ratio):
+        return cost * 2  # n must be a power of 2
+
+    def hash(self, password, salt):
+        return hashlib.scrypt(
+            password.encode("utf-8"),
+            salt=salt,
+            n=self.n,
+            r=self.r,
+            p=self.p,
+            maxmem=256 * self.n * self.r + 2**20,
+            dklen=64,
+        )
+
+
+def hash_time(hasher, rounds=3):
+    """Best time, in seconds, to compute a hash with hasher"""
+    salt = os.urandom(16)
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        hasher.hash("calibration password", salt)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate(hasher_class=PBKDF2Hasher, target=0.1, **params):
+    """Return a hasher of hasher_class taking at least target seconds per hash.
+    @param hasher_class The hasher class, e.g. PBKDF2Hasher or ScryptHasher
+    @param target       Desired time per hash, in seconds, on this machine.
+    The rest of the keyword arguments are passed to hasher_class.with_cost()
+    """
+    cost = hasher_class.min_cost
+    while True:
+        hasher = hasher_class.with_cost(cost, **params)
+        elapsed = hash_time(hasher)
+        if elapsed >= target:
+            return hasher
+        cost = hasher_class.next_cost(cost, target / max(elapsed, 1e-6))
+
+
+class HashExecutor:
+    """Runs password hashes on a pool of threads or processes.
+
+    At most ``max_workers`` hashes are computed at the same time, and at
+    most ``max_pending`` may be waiting or running: further callers block
+    until there is room, so a burst of logins queues up instead of piling
+    up CPU contention. hashlib releases the GIL while hashing, so threads
+    are enough to use all the cores; processes isolate the hashing from
+    the rest of the application at the cost of pickling the arguments.
+
+    One executor can be shared by several userspaces.
+    """
+
+    def __init__(self, kind="thread", max_workers=None, max_pending=None):
+        if kind == "thread":
+            executor_class = ThreadPoolExecutor
+        elif kind == "process":
+            executor_class = ProcessPoolExecutor
+        else:
+            raise ValueError(f"Unknown executor kind '{kind}'")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.max_workers
+        self._executor = executor_class(max_workers=self.max_workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.wait_time = 0.0
+
+    def submit(self, func, *args):
+        """Schedule func(*args), waiting for room in the queue if it is full.
+        @return A concurrent.futures.Future
+        """
+        if not self._slots.acquire(blocking=False):
+            start = time.perf_counter()
+            self._slots.acquire()
+            with self._lock:
+                self.wait_time += time.perf_counter() - start
+        with self._lock:
+            self.depth += 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.depth -= 1
+            if future is not None:
+                self.completed += 1
+        self._slots.release()
+
+    def run(self, func, *args):
+        """Run func(*args) on the executor and return its result"""
+        return self.submit(func, *args).result()
+
+    @property
+    def queue_depth(self):
+        """Number of hashes waiting or running"""
+        return self.depth
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        """Return a dictionary with the executor's counters"""
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "queue_depth": self.depth,
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "wait_time": self.wait_time,
+            }
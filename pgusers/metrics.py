@@ -0,0 +1,327 @@
+"""Instrumentation of the UserSpace methods.
+
+Each instrumented call is counted by method and outcome, and its latency
+recorded in histograms, both in total and split into the time spent
+hashing passwords, running queries and committing. The queries and commits
+are timed by the connections and cursors of the userspace, which charge
+them to the calls in progress on their thread. The number of rows the
+queries return or modify is added up by method too.
+
+Metrics.prometheus() returns a snapshot in the Prometheus text format.
+Functions added with Metrics.add_sink() are called after every call with
+its details, to send them elsewhere.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from inspect import isgeneratorfunction
+
+from psycopg2.extensions import connection, cursor
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_active = threading.local()  # calls in progress on each thread
+
+
+class _Call:
+    __slots__ = ("hash", "query", "commit", "queries", "rows", "outcome")
+
+    def __init__(self):
+        self.hash = self.query = self.commit = 0.0
+        self.queries = self.rows = 0
+        self.outcome = None  # set by set_outcome(), else from the result
+
+
+def add_time(phase, seconds, rows=0):
+    """Charge seconds of phase, "hash", "query" or "commit", and rows to
+    the instrumented calls in progress on this thread
+    """
+    for call in getattr(_active, "calls", ()):
+        setattr(call, phase, getattr(call, phase) + seconds)
+        if phase == "query":
+            call.queries += 1
+            call.rows += rows
+
+
+def set_outcome(outcome):
+    """Name the outcome of the innermost instrumented call in progress on
+    this thread, for when its return value does not tell it
+    """
+    calls = getattr(_active, "calls", None)
+    if calls:
+        calls[-1].outcome = outcome
+
+
+def _timing():
+    """Whether an instrumented call is in progress on this thread"""
+    return bool(getattr(_active, "calls", None))
+
+
+class TimedCursor(cursor):
+    """Cursor charging the time of its queries to the calls in progress"""
+
+    def execute(self, query, vars=None):
+        if not _timing():
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            add_time("query", time.perf_counter() - start, max(self.rowcount, 0))
+
+    def executemany(self, query, vars_list):
+        if not _timing():
+            return super().executemany(query, vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            add_time("query", time.perf_counter() - start, max(self.rowcount, 0))
+
+    def copy_expert(self, sql, file, size=8192):
+        if not _timing():
+            return super().copy_expert(sql, file, size)
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            add_time("query", time.perf_counter() - start, max(self.rowcount, 0))
+
+
+class TimedConnection(connection):
+    """Connection charging the time of its commits to the calls in progress,
+    and creating TimedCursors by default
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedCursor
+
+    def commit(self):
+        if not _timing():
+            return super().commit()
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            add_time("commit", time.perf_counter() - start)
+
+
+class Histogram:
+    """Counts of observations by bucket, their number and their sum"""
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return the list of (upper bound, count) of the buckets, as
+        Prometheus has them: each count includes the previous ones
+        """
+        total = 0
+        result = []
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """Counters and histograms of the calls to the methods of a userspace"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}  # (method, outcome): count
+        self.latency = {}  # (method, phase): Histogram
+        self.queries = {}  # method: count
+        self.rows = {}  # method: count
+        self.sinks = []
+
+    def add_sink(self, sink):
+        """Call sink(method, outcome, timings, rows) after every call.
+        timings is a dictionary with the seconds spent in each phase:
+        total, hash, query and commit. outcome is "ok", "not_found",
+        "expired", "rejected", "throttled" or the name of the exception
+        raised.
+        Sinks are called on the caller's thread and should be quick.
+        """
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def record(self, method, outcome, total, call):
+        timings = {
+            "total": total,
+            "hash": call.hash,
+            "query": call.query,
+            "commit": call.commit,
+        }
+        with self._lock:
+            key = (method, outcome)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            for phase, seconds in timings.items():
+                if seconds or phase == "total":
+                    histogram = self.latency.get((method, phase))
+                    if histogram is None:
+                        histogram = self.latency[method, phase] = Histogram()
+                    histogram.observe(seconds)
+            self.queries[method] = self.queries.get(method, 0) + call.queries
+            self.rows[method] = self.rows.get(method, 0) + call.rows
+        for sink in self.sinks:
+            sink(method, outcome, timings, call.rows)
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.latency = {}
+            self.queries = {}
+            self.rows = {}
+
+    def snapshot(self):
+        """Return a dictionary with copies of the counters, and of the
+        histograms as (cumulative buckets, count, sum) tuples
+        """
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "latency": {
+                    key: (h.cumulative(), h.count, h.sum)
+                    for key, h in self.latency.items()
+                },
+                "queries": dict(self.queries),
+                "rows": dict(self.rows),
+            }
+
+    def prometheus(self):
+        """Return a snapshot of the metrics in the Prometheus text format"""
+        snap = self.snapshot()
+        lines = [
+            "# HELP pgusers_calls_total Calls to the userspace methods by outcome.",
+            "# TYPE pgusers_calls_total counter",
+        ]
+        for (method, outcome), count in sorted(snap["calls"].items()):
+            lines.append(
+                f'pgusers_calls_total{{method="{method}",outcome="{outcome}"}} {count}'
+            )
+        lines += [
+            "# HELP pgusers_call_seconds Latency of the userspace methods by phase.",
+            "# TYPE pgusers_call_seconds histogram",
+        ]
+        for (method, phase), (buckets, count, total) in sorted(snap["latency"].items()):
+            labels = f'method="{method}",phase="{phase}"'
+            for bound, cumulative in buckets:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f'pgusers_call_seconds_bucket{{{labels},le="{le}"}} {cumulative}'
+                )
+            lines.append(f"pgusers_call_seconds_sum{{{labels}}} {total!r}")
+            lines.append(f"pgusers_call_seconds_count{{{labels}}} {count}")
+        for name, help_text in (
+            ("queries", "Queries run by the userspace methods."),
+            ("rows", "Rows returned or modified by the userspace methods."),
+        ):
+            lines += [
+                f"# HELP pgusers_{name}_total {help_text}",
+                f"# TYPE pgusers_{name}_total counter",
+            ]
+            for method, count in sorted(snap[name].items()):
+                lines.append(f'pgusers_{name}_total{{method="{method}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Write prometheus() to the file path, replacing it atomically, for
+        a textfile collector or for usermgr stats to read
+        """
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "w") as out:
+            out.write(self.prometheus())
+        os.replace(temp, path)
+
+
+def _ok(result):
+    return "ok"
+
+
+def instrumented(outcome=_ok):
+    """Decorator recording the calls to a UserSpace method in the
+    userspace's metrics, if any. outcome(result) names the outcome of a
+    call from its return value, unless the method names it with
+    set_outcome(). Generator methods are timed while they
+    produce each item, and their rows are the items produced.
+    """
+
+    def decorator(method):
+        name = method.__name__
+
+        if isgeneratorfunction(method):
+
+            @wraps(method)
+            def generator(self, *args, **kwargs):
+                if self.metrics is None:
+                    yield from method(self, *args, **kwargs)
+                    return
+                call = _Call()
+                items = 0
+                total = 0.0
+                result = "ok"
+                iterator = method(self, *args, **kwargs)
+                try:
+                    while True:
+                        _active.__dict__.setdefault("calls", []).append(call)
+                        start = time.perf_counter()
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            break
+                        finally:
+                            total += time.perf_counter() - start
+                            _active.calls.remove(call)
+                        items += 1
+                        yield item
+                except Exception as err:
+                    result = type(err).__name__
+                    raise
+                finally:
+                    iterator.close()
+                    call.rows = items
+                    self.metrics.record(name, result, total, call)
+
+            return generator
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            call = _Call()
+            calls = _active.__dict__.setdefault("calls", [])
+            calls.append(call)
+            start = time.perf_counter()
+            result = "ok"
+            try:
+                value = method(self, *args, **kwargs)
+                result = call.outcome or outcome(value)
+                return value
+            except Exception as err:
+                result = type(err).__name__
+                raise
+            finally:
+                total = time.perf_counter() - start
+                calls.remove(call)
+                self.metrics.record(name, result, total, call)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,265 @@
+"""Versioned schema migrations for the userspace database.
+
+Each migration is a function registered with the @migration decorator
+under an increasing version number. The version of the schema is kept in
+the ``schema_version`` table, one row per migration applied. migrate()
+runs the pending migrations in order, in autocommit mode so that indexes
+can be built with ``create index concurrently`` without blocking writes
+on a live database. Migrations must therefore be idempotent: if one fails
+half-way, running it again finishes the job.
+"""
+
+import time
+
+from .partitions import is_partitioned
+
+MIGRATIONS = []  # (version, description, function), sorted by version
+LOCK_ID = 0x70677573  # advisory lock serialising concurrent migrations
+
+
+class DuplicateValuesError(Exception):
+    """Users share a username or an email, so that their unique constraint
+    cannot be added. ``duplicates`` lists them as (column, value, userids).
+    """
+
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        shown = [
+            "{} '{}' (userids {})".format(column, value, ", ".join(map(str, ids)))
+            for column, value, ids in duplicates[:10]
+        ]
+        if len(duplicates) > 10:
+            shown.append(f"and {len(duplicates) - 10} more")
+        super().__init__(
+            "Users must have unique usernames and emails before the upgrade: "
+            + "; ".join(shown)
+        )
+
+
+def migration(version, description):
+    """Register the decorated function as the migration to version"""
+
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+
+    return register
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def schema_version(db):
+    """Return the schema version of the database, 0 if it has no tables"""
+    with db.cursor() as cr:
+        version = _current_version(cr)
+    db.commit()
+    return version
+
+
+def migrate(db, target=None):
+    """Upgrade the database to the target version (latest if None).
+    @param db       An open connection to the database.
+    @param target   Version to upgrade to.
+    @return List of (version, description) of the migrations applied.
+    """
+    db.commit()
+    autocommit = db.autocommit
+    db.autocommit = True
+    applied = []
+    try:
+        with db.cursor() as cr:
+            cr.execute("select pg_advisory_lock(%s)", (LOCK_ID,))
+            try:
+                current = _current_version(cr)
+                for version, description, func in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    if target is not None and version > target:
+                        break
+                    func(cr)
+                    cr.execute(
+                        "insert into schema_version (version, description, applied) "
+                        "values (%s, %s, %s)",
+                        (version, description, time.time()),
+                    )
+                    applied.append((version, description))
+            finally:
+                cr.execute("select pg_advisory_unlock(%s)", (LOCK_ID,))
+    finally:
+        db.autocommit = autocommit
+    return applied
+
+
+def _current_version(cr):
+    cr.execute(
+        """create table if not exists schema_version (
+            version     integer primary key,
+            description varchar(128),
+            applied     double precision
+            )"""
+    )
+    cr.execute("select to_regclass('users') is not null")
+    if not cr.fetchone()[0]:
+        # tables dropped or never created, the history no longer applies
+        cr.execute("delete from schema_version")
+        return 0
+    cr.execute("select max(version) from schema_version")
+    version = cr.fetchone()[0]
+    # tables created before schema versioning was introduced
+    return 1 if version is None else version
+
+
+def _drop_invalid_index(cr, name):
+    """Drop what is left of an index whose concurrent build failed"""
+    cr.execute(
+        "select not i.indisvalid from pg_index i "
+        "where i.indexrelid = to_regclass(%s)",
+        (name,),
+    )
+    row = cr.fetchone()
+    if row and row[0]:
+        cr.execute(f"drop index concurrently if exists {name}")
+
+
+def find_duplicates(cr):
+    """Return the (column, value, userids) of the usernames and emails
+    shared by several users
+    """
+    duplicates = []
+    for column in ("username", "email"):
+        cr.execute(
+            f"select {column}, array_agg(userid order by userid) from users "
+            f"where {column} is not null group by {column} "
+            f"having count(*) > 1 order by {column}"
+        )
+        duplicates += [(column, value, ids) for value, ids in cr.fetchall()]
+    return duplicates
+
+
+def _create_index(cr, name, definition, unique=False):
+    _drop_invalid_index(cr, name)
+    # partitioned tables cannot be indexed concurrently
+    table = definition.split()[0]
+    cr.execute(
+        "create {}index {}if not exists {} on {}".format(
+            "unique " if unique else "",
+            "" if is_partitioned(cr, table) else "concurrently ",
+            name,
+            definition,
+        )
+    )
+
+
+def _add_unique_constraint(cr, table, column):
+    """Unique constraint on table(column) built from a concurrent index"""
+    name = f"{table}_{column}_key"
+    _create_index(cr, name, f"{table} ({column})", unique=True)
+    cr.execute(
+        f"""do $$ begin
+            if not exists (select 1 from pg_constraint
+                           where conname = '{name}'
+                           and conrelid = to_regclass('{table}')) then
+                alter table {table} add constraint {name} unique using index {name};
+            end if;
+        end $$"""
+    )
+
+
+@migration(1, "users and sessions tables")
+def _create_tables(cr):
+    cr.execute(
+        """create table if not exists users (
+            userid      serial primary key,
+            username    varchar(20),
+            email       varchar(128),
+            salt        varchar(32),
+            kpasswd     varchar(128),
+            admin       boolean not null default 'no',
+            extra_data  bytea
+            )"""
+    )
+    cr.execute(
+        """create table if not exists sessions (
+            userid  integer,
+            key     varchar(32),
+            expiration real,
+            extra_data  bytea
+            )"""
+    )
+
+
+@migration(2, "indexes and unique constraints")
+def _add_indexes(cr):
+    # versions before 2 did not enforce these: check first rather than leave
+    # an invalid index behind, and drop the sessions sharing a key, which
+    # could be taken for one another
+    duplicates = find_duplicates(cr)
+    if duplicates:
+        raise DuplicateValuesError(duplicates)
+    cr.execute(
+        "delete from sessions where key in "
+        "(select key from sessions group by key having count(*) > 1)"
+    )
+    _add_unique_constraint(cr, "users", "username")
+    _add_unique_constraint(cr, "users", "email")
+    if is_partitioned(cr):
+        # unique indexes on a partitioned table must include the partition key
+        _create_index(cr, "sessions_key_idx", "sessions (key)")
+    else:
+        _add_unique_constraint(cr, "sessions", "key")
+    _create_index(cr, "sessions_userid_idx", "sessions (userid)")
+    _create_index(cr, "sessions_expiration_idx", "sessions (expiration)")
+
+
+@migration(3, "password hasher of each user")
+def _add_hasher(cr):
+    cr.execute("alter table users add column if not exists hasher varchar(64)")
+
+
+@migration(4, "indexes for user listing and prefix searches")
+def _add_listing_indexes(cr):
+    _create_index(cr, "users_username_userid_idx", "users (username, userid)")
+    _create_index(
+        cr, "users_username_pattern_idx", "users (username varchar_pattern_ops)"
+    )
+    _create_index(cr, "users_email_pattern_idx", "users (email varchar_pattern_ops)")
+
+
+@migration(5, "extra_data stored as JSON")
+def _add_extra_json(cr):
+    cr.execute("alter table users add column if not exists extra_json jsonb")
+    cr.execute("alter table sessions add column if not exists extra_json jsonb")
+    _create_index(
+        cr, "users_extra_json_idx", "users using gin (extra_json jsonb_path_ops)"
+    )
+
+
+@migration(6, "revoked session tokens")
+def _create_revocations(cr):
+    cr.execute(
+        """create table if not exists revocations (
+            id          bigserial primary key,
+            userid      integer,
+            jti         varchar(32),
+            issued_before double precision,
+            expiration  double precision
+            )"""
+    )
+    _create_index(cr, "revocations_issued_idx", "revocations (issued_before)")
+
+
+@migration(7, "login throttle buckets shared by the processes")
+def _create_login_throttle(cr):
+    # unlogged: the buckets need not survive a crash, and are written on
+    # every login attempt
+    cr.execute(
+        """create unlogged table if not exists login_throttle (
+            key         text primary key,
+            tokens      double precision,
+            updated     double precision
+            )"""
+    )
+    _create_index(cr, "login_throttle_updated_idx", "login_throttle (updated)")
@@ -0,0 +1,110 @@
+"""Range partitioning of the sessions table on expiration.
+
+In the partitioned layout the sessions are kept in one partition per window
+of expiration times, named sessions_<start>_<end> after the window bounds in
+seconds since the epoch, plus a default partition for the sessions outside
+of every window. Once a window is over all its sessions have expired, and
+the whole partition can be dropped instead of deleting its rows one by one.
+
+The functions here take a cursor and leave committing to the caller.
+"""
+
+import re
+
+LOCK_ID = 0x70677370  # advisory lock serialising partition maintenance
+PARTITION_NAME = re.compile(r"sessions_(\d+)_(\d+)$")
+
+
+def create_sessions_table(cr):
+    """Create the sessions table partitioned, unless it already exists"""
+    cr.execute("select to_regclass('sessions') is not null")
+    if cr.fetchone()[0]:
+        return
+    cr.execute(
+        """create table sessions (
+            userid  integer,
+            key     varchar(32),
+            expiration real,
+            extra_data  bytea
+            ) partition by range (expiration)"""
+    )
+    cr.execute("create table sessions_default partition of sessions default")
+
+
+def is_partitioned(cr, table="sessions"):
+    cr.execute(
+        "select relkind = 'p' from pg_class where oid = to_regclass(%s)", (table,)
+    )
+    row = cr.fetchone()
+    return bool(row and row[0])
+
+
+def partitions(cr):
+    """Return the sorted list of (start, end) windows of the partitions"""
+    cr.execute(
+        """select c.relname from pg_inherits i
+           inner join pg_class c on (c.oid = i.inhrelid)
+           where i.inhparent = 'sessions'::regclass"""
+    )
+    windows = []
+    for (name,) in cr.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            windows.append((int(match.group(1)), int(match.group(2))))
+    return sorted(windows)
+
+
+def ensure_partitions(cr, now, until, size):
+    """Create the partitions for the sessions expiring from now until until.
+    @param cr       A cursor on the userspace's database.
+    @param now      Current time, the first window is the one holding it.
+    @param until    Create windows until this time is covered.
+    @param size     Length of each new window, in seconds.
+    @return List of the names of the partitions created.
+
+    Windows are only added after the last existing one. Sessions in the
+    default partition that fall in a new window are moved to it.
+    """
+    size = int(size)
+    cr.execute("select pg_advisory_xact_lock(%s)", (LOCK_ID,))
+    windows = partitions(cr)
+    start = int(now // size * size)
+    if windows:
+        start = max(start, windows[-1][1])
+    created = []
+    while start <= until:
+        end = start + size
+        name = f"sessions_{start}_{end}"
+        cr.execute(f"create table {name} (like sessions including defaults)")
+        cr.execute(
+            f"""with moved as (
+                    delete from sessions_default
+                    where expiration >= %s and expiration < %s
+                    returning *)
+                insert into {name} select * from moved""",
+            (start, end),
+        )
+        cr.execute(
+            f"alter table sessions attach partition {name} "
+            "for values from (%s) to (%s)",
+            (start, end),
+        )
+        created.append(name)
+        start = end
+    return created
+
+
+def drop_expired_partitions(cr, now):
+    """Drop the partitions whose window is over.
+    @return The number of sessions dropped with them.
+    """
+    cr.execute("select pg_advisory_xact_lock(%s)", (LOCK_ID,))
+    dropped = 0
+    for start, end in partitions(cr):
+        if end > now:
+            break
+        name = f"sessions_{start}_{end}"
+        cr.execute(f"select count(*) from {name}")
+        dropped += cr.fetchone()[0]
+        cr.execute(f"drop table {name}")
+    return dropped
@@ -1,25 +1,132 @@
-import os
-import hashlib
-import pickle
-import binascii
 import time
+import atexit
+import io
+import csv
+import json
+import threading
+from itertools import count
+from contextlib import contextmanager
+from functools import partial
 
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.extensions import quote_ident
+
+from .pool import ConnectionPool
+from .replicas import ReplicaSet
+from .cache import SessionCache
+from .writebehind import TouchQueue
+from .reaper import SessionReaper
+from .hashing import PBKDF2Hasher
+from .accounts import Credentials, new_session_key, renewed_expiration
+from .migrations import migrate, DuplicateValuesError
+from . import partitions
+from . import prepared
+from .prepared import PreparingConnection
+from .metrics import Metrics, TimedConnection, instrumented, set_outcome
+from .extra import dump_extra, load_extra
+from .tokens import TokenSigner, RevocationList, is_token
+from .throttle import LoginThrottle, SharedLoginThrottle
 
 OK = 0
 NOT_FOUND = 1
 EXPIRED = 2
 REJECTED = 3
+OUTCOMES = {OK: "ok", NOT_FOUND: "not_found", EXPIRED: "expired", REJECTED: "rejected"}
+
+# renew the expiration of the sessions in a list of (key, expiration) values
+RENEW_SESSIONS_SQL = (
+    "update sessions as s set expiration = v.expiration "
+    "from (values %s) as v (key, expiration) "
+    "where s.key = v.key and s.expiration < v.expiration"
+)
+
+
+INSERT_SESSION_SQL = (
+    "insert into sessions (userid, key, expiration, extra_data, extra_json) "
+    "values (%s, %s, %s, %s, %s::jsonb)"
+)
+SET_PASSWORD_SQL = (
+    "update users set kpasswd = %s, salt = %s, hasher = %s where userid = %s"
+)
+SESSION_COLUMNS_SQL = (
+    "select t1.userid, t1.key, t1.expiration, "
+    "t1.extra_data, t1.extra_json::text, t2.username "
+    "from sessions as t1, users as t2 where t1.userid = t2.userid and "
+)
+USER_COLUMNS_SQL = (
+    "select userid, username, email, admin, extra_data, extra_json::text "
+    "from users where "
+)
+
+# statements run on every login or session check, prepared by name on the
+# connections that allow it
+STATEMENTS = {
+    "login": "select userid, username, salt, kpasswd, admin, hasher "
+    "from users where username = %s",
+    "insert_session": INSERT_SESSION_SQL,
+    "set_password": SET_PASSWORD_SQL,
+    "check_session": SESSION_COLUMNS_SQL + "t1.key = %s",
+    "check_sessions": SESSION_COLUMNS_SQL + "t1.key = any(%s)",
+    "renew_session": "update sessions set expiration = %s where key = %s",
+    "delete_session": "delete from sessions where key = %s",
+    "find_user_username": USER_COLUMNS_SQL + "username = %s",
+    "find_user_email": USER_COLUMNS_SQL + "email = %s",
+    "find_user_userid": USER_COLUMNS_SQL + "userid = %s",
+}
 
 
 class BadCallError(Exception):
     pass
 
 
-class UserSpace:
+def _rc_outcome(rc):
+    return OUTCOMES[rc]
+
+
+def _session_outcome(result):
+    return OUTCOMES[result[0]]
+
+
+def _login_outcome(result):
+    return "ok" if result[0] else "rejected"
+
+
+def _found_outcome(result):
+    return "not_found" if result is None else "ok"
+
+
+def _keep(conn):
+    """Give back the shared connection, which stays open"""
+
+
+class UserSpace(Credentials):
 
     userspaces = {}  # instance list
     ttl = 864000.0  # 10 day default session time to live
+    refresh_threshold = 1.0  # renew expiration when less than this * ttl is left
+    pool = None  # ConnectionPool, when running in pooled mode
+    session_cache = None  # SessionCache, if enabled
+    touch_queue = None  # TouchQueue, in write-behind mode
+    flush_connector = None  # connection used by the TouchQueue if not pooled
+    reaper = None  # SessionReaper, if started
+    reap_connector = None  # connection used by the SessionReaper if not pooled
+    stream_connector = None  # idle connection for streaming cursors if not pooled
+    itersize = 2000  # rows fetched at a time by all_users() and list_sessions()
+    cursor_ids = count()  # to give the server-side cursors unique names
+    partition_size = None  # seconds per sessions partition, if partitioned
+    partitions_until = 0.0  # sessions partitions exist up to this time
+    json_extra = False  # store extra_data as JSON instead of pickled
+    sync_session_commit = True  # wait for new sessions to be flushed to disk
+    replicas = None  # ReplicaSet, if reads are sent to replicas
+    read_your_writes = 0.0  # seconds a thread reads from the primary after a write
+    token_signer = None  # TokenSigner, in token mode
+    metrics = None  # Metrics, if the methods are instrumented
+    schema = None  # schema holding the tables of a tenant userspace
+    parent = None  # userspace whose pool a tenant userspace uses
+    revocations = None  # RevocationList, in token mode
+    throttle = None  # LoginThrottle, if login attempts are limited
+    opened = False  # set once __init__ completes, cleared by close()
 
     def __new__(cls, dbname="", **kwargs):
         """Return the existing instance if already created or create a new one."""
@@ -33,20 +140,483 @@ class UserSpace:
             cls.userspaces[dbname] = newobj
             return newobj
 
-    def __init__(self, dbname="", **kwargs):
+    def __init__(
+        self,
+        dbname="",
+        minconn=None,
+        maxconn=None,
+        pool_timeout=None,
+        cache_size=0,
+        cache_max_age=60.0,
+        write_behind=False,
+        flush_interval=1.0,
+        flush_size=1000,
+        hash_executor=None,
+        hasher=None,
+        reap_interval=None,
+        partitioned_sessions=False,
+        partition_size=86400.0,
+        json_extra=False,
+        token_secret=None,
+        revocation_refresh=5.0,
+        sync_session_commit=True,
+        replicas=None,
+        replica_retry=30.0,
+        read_your_writes=0.0,
+        prepare_statements=True,
+        metrics=True,
+        login_rate=None,
+        login_burst=10,
+        client_rate=None,
+        client_burst=None,
+        shared_throttle=False,
+        **kwargs,
+    ):
+        """Connect to the userspace's database.
+        @param dbname   Name of the database holding the userspace.
+        @param minconn  Connections opened beforehand in pooled mode.
+        @param maxconn  If specified, use a pool of up to this many connections
+                        instead of a single shared connection.
+        @param pool_timeout Seconds to wait for a free pooled connection
+                        before giving up, or None to wait forever.
+        @param cache_size   If not zero, keep up to this many validated
+                        sessions in memory so check_key() can answer
+                        without querying the database.
+        @param cache_max_age Seconds a cached session is trusted before
+                        it is read from the database again.
+        @param write_behind If True, check_key() queues the renewed session
+                        expirations and writes them in batches.
+        @param flush_interval Seconds between batches written by the
+                        background thread in write-behind mode, or None
+                        to only write them when flush_size is reached.
+        @param flush_size   Write a batch as soon as this many sessions
+                        are queued.
+        @param hash_executor A HashExecutor to compute the password hashes
+                        on, limiting how many run at the same time.
+        @param hasher   The password hasher for new passwords, by default
+                        PBKDF2 with SHA-512 and 100000 iterations.
+                        Passwords hashed differently are re-hashed with
+                        it the next time their user logs in.
+        @param reap_interval If specified, start a background thread
+                        deleting the expired sessions every this many
+                        seconds. See start_reaper().
+        @param partitioned_sessions If True, create the sessions table
+                        partitioned by expiration, so that expired
+                        sessions are purged by dropping whole partitions.
+                        Only possible when the tables are created.
+        @param partition_size Seconds of expiration times per partition
+                        of a partitioned sessions table.
+        @param json_extra If True, store the extra_data of users and
+                        sessions as JSON instead of pickled, so that it
+                        can be searched with find_users_by_extra().
+        @param token_secret If specified, validate_user() issues tokens
+                        signed with this secret (a string or bytes, or a
+                        list of them, the first one signing) that
+                        check_key() verifies without querying the database.
+        @param revocation_refresh Seconds between reads of the token
+                        revocations made by other processes.
+        @param sync_session_commit If False, logins commit with
+                        synchronous_commit off: faster, but a database
+                        crash may lose the sessions created during the
+                        last moments before it.
+        @param replicas List of read-only replicas of the database, each
+                        one a DSN string or a dictionary of connection
+                        parameters completing the primary's. The read-only
+                        methods query them in turn, or the primary if none
+                        is available.
+        @param replica_retry Seconds a failed replica is left out.
+        @param read_your_writes After using the primary, a thread keeps
+                        reading from it for this many seconds so that it
+                        sees its own changes.
+        @param prepare_statements If True, the statements run on every
+                        login and session check are prepared once per
+                        connection and then executed by name. Set it to
+                        False behind a pooler that does not keep the
+                        server connection between transactions.
+        @param metrics  If True, count and time the calls to the methods
+                        in self.metrics. See pgusers.metrics.
+        @param login_rate If specified, limit the login attempts of each
+                        username to login_burst at once, regaining this
+                        many per second. validate_user() refuses the
+                        attempts over the limit before reading the user
+                        or hashing the password. Successful logins do not
+                        count. See pgusers.throttle.
+        @param login_burst Login attempts a username can make at once.
+        @param client_rate If specified, limit in the same way the login
+                        attempts of each client given to validate_user().
+        @param client_burst Login attempts a client can make at once,
+                        login_burst if not specified.
+        @param shared_throttle If True, keep the login attempts in the
+                        database so that the limits hold across processes,
+                        at the cost of a short transaction per attempt.
+
+        The rest of the keyword arguments are passed to psycopg2.connect()
+
+        Once the userspace is open, creating it again returns it as it is,
+        ignoring the arguments: other threads may be using its connections.
+        To open it with other settings, close() it first.
+        """
+        if self.opened:
+            return
         self.dbname = dbname
+        kwargs.setdefault(
+            "connection_factory",
+            PreparingConnection if prepare_statements else TimedConnection,
+        )
         self.connection_args = kwargs
-        self.connector = psycopg2.connect(dbname=dbname, **kwargs)
-        dbinit(self.connector)
+        self.hash_executor = hash_executor
+        self.hasher = hasher or PBKDF2Hasher()
+        self.json_extra = json_extra
+        self.sync_session_commit = sync_session_commit
+        self.metrics = Metrics() if metrics else None
+        if self.reaper is not None:
+            self.stop_reaper()
+        if self.touch_queue is not None:
+            self.touch_queue.stop()
+        if self.pool is not None:
+            self.pool.closeall()
+        if self.replicas is not None:
+            self.replicas.closeall()
+
+        if maxconn:
+            self.pool = ConnectionPool(
+                minconn or 1, maxconn, pool_timeout, dbname=dbname, **kwargs
+            )
+            self.connector = None
+            with self._cursor() as cr:
+                dbinit(cr.connection, partitioned_sessions)
+        else:
+            self.pool = None
+            self.connector = psycopg2.connect(dbname=dbname, **kwargs)
+            dbinit(self.connector, partitioned_sessions)
+
+        with self._cursor() as cr:
+            partitioned = partitions.is_partitioned(cr)
+            cr.connection.commit()
+        if partitioned_sessions and not partitioned:
+            raise BadCallError(
+                f"The sessions table of '{dbname}' exists and is not partitioned"
+            )
+        self.partition_size = partition_size if partitioned else None
+        self.partitions_until = 0.0
+        if partitioned:
+            self.ensure_partitions()
+
+        if cache_size:
+            self.session_cache = SessionCache(cache_size, cache_max_age)
+        else:
+            self.session_cache = None
 
-    def _cursor(self):
-        """Return a cursor, re-connecting to the database if necessary"""
+        if write_behind:
+            self.touch_queue = TouchQueue(
+                self._write_touches, flush_interval, flush_size
+            )
+            self.touch_queue.start()
+            atexit.register(self.touch_queue.stop)
+        else:
+            self.touch_queue = None
+
+        if replicas:
+            self.replicas = ReplicaSet(
+                [
+                    dict(
+                        dsn=replica, connection_factory=kwargs.get("connection_factory")
+                    )
+                    if isinstance(replica, str)
+                    else dict(dict(dbname=dbname, **kwargs), **replica)
+                    for replica in replicas
+                ],
+                maxconn or 1,
+                pool_timeout,
+                replica_retry,
+            )
+        else:
+            self.replicas = None
+        self.read_your_writes = read_your_writes
+        self.last_write = threading.local()
+        self.stream_lock = threading.Lock()
+        self.open_tenants = {}
+
+        if reap_interval:
+            self.start_reaper(reap_interval)
+
+        if token_secret:
+            if isinstance(token_secret, (str, bytes)):
+                token_secret = [token_secret]
+            self.token_signer = TokenSigner(*token_secret)
+            self.revocations = RevocationList(
+                self._load_revocations, revocation_refresh
+            )
+        else:
+            self.token_signer = None
+            self.revocations = None
+
+        if login_rate is not None or client_rate is not None:
+            limits = dict(
+                burst=login_burst, client_rate=client_rate, client_burst=client_burst
+            )
+            if shared_throttle:
+                self.throttle = SharedLoginThrottle(self._cursor, login_rate, **limits)
+            else:
+                self.throttle = LoginThrottle(login_rate, **limits)
+        else:
+            self.throttle = None
+        self.opened = True
+
+    def tenant(self, schema):
+        """Return the userspace of a tenant.
+        @param schema   The schema of the database holding the tenant's
+                        tables, as created by create_tenant().
+
+        The tenant userspace has the same methods as this one and uses its
+        connection pool, pointing the search_path of the connections at the
+        tenant's schema as they are checked out. Opening it takes no query
+        and no connection. It shares this userspace's settings, except that
+        it has no session cache of its own unless this one has, and no
+        write-behind queue, reaper or tokens.
+        Only possible on a pooled userspace.
+        """
+        if self.parent is not None:
+            return self.parent.tenant(schema)
+        if self.pool is None:
+            raise BadCallError("Tenants need a pooled userspace (maxconn)")
+        tenant = self.open_tenants.get(schema)
+        if tenant is None:
+            tenant = object.__new__(type(self))  # not a registered singleton
+            tenant.__dict__.update(self.__dict__)
+            tenant.parent = self
+            tenant.schema = schema
+            tenant.open_tenants = {}
+            if self.session_cache is not None:
+                tenant.session_cache = SessionCache(
+                    self.session_cache.max_size, self.session_cache.max_age
+                )
+            tenant.touch_queue = None
+            tenant.reaper = None
+            tenant.token_signer = None
+            tenant.revocations = None
+            tenant.partition_size = None
+            tenant.partitions_until = 0.0
+            tenant = self.open_tenants.setdefault(schema, tenant)
+        return tenant
+
+    def create_tenant(self, schema):
+        """Create the schema of a tenant and its tables, or upgrade them, and
+        return its userspace
+        """
+        tenant = self.tenant(schema)
+        with tenant._cursor() as cr:
+            cr.execute("create schema if not exists " + quote_ident(schema, cr))
+            cr.connection.commit()
+            dbinit(cr.connection)
+        return tenant
+
+    def drop_tenant(self, schema):
+        """Drop the schema of a tenant, with all its users and sessions"""
+        (self.parent or self).open_tenants.pop(schema, None)
+        with self._cursor() as cr:
+            cr.execute("drop schema if exists " + quote_ident(schema, cr) + " cascade")
+            cr.connection.commit()
+
+    def tenants(self):
+        """Return the sorted list of the schemas holding a tenant's tables.
+        The same on a tenant userspace as on its parent.
+        """
+        with (self.parent or self)._cursor() as cr:
+            cr.execute(
+                "select n.nspname from pg_class c "
+                "inner join pg_namespace n on (n.oid = c.relnamespace) "
+                "where c.relname = 'users' and c.relkind in ('r', 'p') "
+                "and n.nspname <> current_schema() order by n.nspname"
+            )
+            schemas = [row[0] for row in cr.fetchall()]
+            cr.connection.commit()
+        return schemas
+
+    @instrumented()
+    def flush(self):
+        """Write the session expirations queued in write-behind mode.
+        @return The number of sessions updated.
+        """
+        if self.touch_queue is None:
+            return 0
+        return self.touch_queue.flush()
+
+    def close(self):
+        """Write any queued session expirations and close the connections.
+        On a tenant userspace, only forget it: the connections are its
+        parent's.
+        """
+        if self.parent is not None:
+            self.parent.open_tenants.pop(self.schema, None)
+            return
+        self.opened = False
+        if self.reaper is not None:
+            self.stop_reaper()
+        if self.touch_queue is not None:
+            self.touch_queue.stop()
+            atexit.unregister(self.touch_queue.stop)
+            self.touch_queue = None
+        if self.pool is not None:
+            self.pool.closeall()
+        if self.replicas is not None:
+            self.replicas.closeall()
+        if self.connector is not None:
+            self.connector.close()
+        for conn in (self.flush_connector, self.reap_connector, self.stream_connector):
+            if conn is not None:
+                conn.close()
+
+    def _dump_extra(self, extra_data):
+        try:
+            return dump_extra(extra_data, self.json_extra)
+        except TypeError as err:
+            raise BadCallError(f"extra_data cannot be stored as JSON: {err}")
+
+    def _write_touches(self, touches):
+        """Renew the expiration of a batch of sessions in one statement"""
+        with self._thread_cursor("flush_connector") as cr:
+            execute_values(cr, RENEW_SESSIONS_SQL, touches, page_size=len(touches))
+            cr.connection.commit()
+
+    @contextmanager
+    def _thread_cursor(self, attr):
+        """Yield a cursor for a background thread.
+
+        In pooled mode this is just a pooled cursor. Otherwise the shared
+        connection may be in the middle of another thread's transaction, so
+        the background thread gets a connection of its own, kept in the
+        attribute named attr.
+        """
+        if self.pool is not None:
+            with self._cursor() as cr:
+                yield cr
+            return
+
+        conn = getattr(self, attr)
+        if conn is None or conn.closed:
+            conn = psycopg2.connect(dbname=self.dbname, **self.connection_args)
+            setattr(self, attr, conn)
+        try:
+            with conn.cursor() as cr:
+                yield cr
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+    def _wrote_recently(self):
+        """Whether this thread used the primary in the last read_your_writes
+        seconds
+        """
+        return time.time() - getattr(self.last_write, "at", 0.0) < self.read_your_writes
+
+    def _getconn(self, streaming=False):
+        """Return a connection, re-connecting to the database if necessary,
+        and the function giving it back: the putconn() of the pool it was
+        taken from, whatever self.pool is by then.
+
+        Without a pool, a streaming cursor gets a connection of its own, so
+        that the calls made while it is iterated cannot end its transaction.
+        """
+        pool = self.pool
+        if pool is not None:
+            return pool.getconn(), pool.putconn
+        if streaming:
+            with self.stream_lock:
+                conn, self.stream_connector = self.stream_connector, None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(dbname=self.dbname, **self.connection_args)
+            return conn, self._put_stream_conn
         if self.connector.closed:
             self.connector = psycopg2.connect(
                 dbname=self.dbname, **self.connection_args
             )
-        return self.connector.cursor()
+        return self.connector, _keep
+
+    def _put_stream_conn(self, conn):
+        """Keep conn as the idle streaming connection, or close it if there
+        is one already
+        """
+        if not conn.closed:
+            conn.rollback()
+            with self.stream_lock:
+                if self.stream_connector is None and self.opened:
+                    self.stream_connector = conn
+                    return
+            conn.close()
+
+    def _set_schema(self, conn):
+        """Point the search_path of conn at this userspace's schema, for the
+        rest of the connection's life
+        """
+        with conn.cursor() as cr:
+            if self.schema is None:
+                cr.execute("reset search_path")
+            else:
+                cr.execute(
+                    "select set_config('search_path', %s, false)",
+                    (quote_ident(self.schema, cr),),
+                )
+        conn.commit()
+        try:
+            conn.schema = self.schema
+        except AttributeError:  # not one of our connections, set it every time
+            pass
+
+    @contextmanager
+    def _cursor(self, streaming=False, read_only=False):
+        """Yield a cursor, re-connecting to the database if necessary.
+
+        In pooled mode the connection is checked out of the pool for the
+        duration of the block and given back afterwards. The transaction
+        is rolled back if the block raises.
+
+        A read only cursor is on one of the replicas, if there are any and
+        the thread has not used the primary in the last read_your_writes
+        seconds. A replica whose connection fails is left out for a while.
+
+        A streaming cursor is a server-side cursor that fetches its results
+        itersize rows at a time as it is iterated, on a connection no other
+        call uses meanwhile.
+        """
+        replica = None
+        if read_only and self.replicas is not None and not self._wrote_recently():
+            replica = self.replicas.getconn()
+        if replica is not None:
+            index, conn = replica
+            putconn = partial(self.replicas.putconn, index)
+        else:
+            conn, putconn = self._getconn(streaming)
+            if self.read_your_writes and not read_only:
+                self.last_write.at = time.time()
+        try:
+            if getattr(conn, "schema", None) != self.schema:
+                self._set_schema(conn)
+            if streaming:
+                name = "pgusers_{}".format(next(self.cursor_ids))
+                cursor = conn.cursor(name)
+                cursor.itersize = self.itersize
+            else:
+                cursor = conn.cursor()
+            with cursor as cr:
+                yield cr
+        except psycopg2.OperationalError:
+            if replica is not None:
+                # the replica may be down, leave it out for a while
+                self.replicas.mark_down(index)
+                putconn = partial(self.replicas.putconn, index, close=True)
+            elif not conn.closed:
+                conn.rollback()
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            putconn(conn)
 
+    @instrumented()
     def create_user(self, username, password, email, admin=False, extra_data=None):
         """Create a user in the UserSpace's database.
         @param username The username to be created, if there is already
@@ -58,51 +628,133 @@ class UserSpace:
                         the database.
         @param admin    Whether the user is an admin.
         @param extra_data An application dependent dictionary to be stored
-                        as a pickle (e.g. phone number, password reminders,
-                        etc)
+                        as a pickle, or as JSON in json_extra mode (e.g.
+                        phone number, password reminders, etc)
 
         @return Integer representing the user id
         """
-        sql_retrieve_username = "select userid from users where username = %s"
-        cr = self._cursor()
-        cr.execute(sql_retrieve_username, (username,))
-        if cr.fetchone():
-            raise BadCallError(f"User '{username}' already in database")
-        salt = os.urandom(16)
-        bpwd = password.encode("utf-8")
-        kpasswd = hashlib.pbkdf2_hmac("sha512", bpwd, salt, 100000)
-        edata = pickle.dumps(extra_data)
-        try:
-            cr.execute(
-                "insert into users (username, email, salt, kpasswd, admin, extra_data) "
-                "values (%s, %s, %s, %s, %s, %s)",
-                (username, email, salt.hex(), kpasswd.hex(), admin, edata),
-            )
-        except Exception as err:
-            raise BadCallError(str(err))
-        else:
-            cr.execute(sql_retrieve_username, (username,))
+        kpasswd, salt, hasher = self._new_password(password)
+        edata, ejson = self._dump_extra(extra_data)
+        with self._cursor() as cr:
+            try:
+                cr.execute(
+                    "insert into users "
+                    "(username, email, salt, kpasswd, hasher, admin, "
+                    "extra_data, extra_json) "
+                    "values (%s, %s, %s, %s, %s, %s, %s, %s::jsonb) "
+                    "returning userid",
+                    (
+                        username,
+                        email,
+                        salt,
+                        kpasswd,
+                        hasher,
+                        admin,
+                        edata,
+                        ejson,
+                    ),
+                )
+            except (psycopg2.IntegrityError, psycopg2.DataError) as err:
+                raise BadCallError(_insert_error(err, username, email))
             userid = cr.fetchone()[0]
-        finally:
-            self.connector.commit()
-            cr.close()
+            cr.connection.commit()
         return userid
 
+    @instrumented()
+    def create_users(self, users, batch_size=1000):
+        """Create many users at once.
+        @param users    Iterable of dictionaries with the keys username,
+                        password, email and optionally admin and extra_data,
+                        or of tuples with those values in that order. It is
+                        consumed batch_size users at a time.
+        @param batch_size Number of users loaded per transaction.
+
+        The passwords of each batch are hashed in parallel, on the userspace's
+        HashExecutor or on a temporary one using all the CPUs, and the batch
+        is loaded with COPY. Users whose username or email already exists
+        (in the database or earlier in the batch) are not created, and
+        don't stop the rest from being created. Neither do users with a
+        missing field or with fields that cannot be stored, such as a
+        username over 20 characters, which are checked before hashing.
+
+        @return tuple(created, failures) where created is the number of
+                users created and failures a list of (index, username, reason)
+                tuples, index being the position of the user in users.
+        """
+        return self._create_in_batches(users, batch_size)
+
+    def _create_batch(self, batch, executor, failures):
+        rows = self._hash_batch(
+            batch, executor, failures, partial(dump_extra, as_json=self.json_extra)
+        )
+        copy_buffer = io.StringIO()
+        writer = csv.writer(copy_buffer)
+        for index, user, (edata, ejson), kpasswd, salt in rows:
+            writer.writerow(
+                (
+                    index,
+                    user["username"],
+                    user.get("email"),
+                    salt,
+                    kpasswd,
+                    self.hasher.descriptor,
+                    bool(user.get("admin", False)),
+                    edata and "\\x" + edata.hex(),
+                    ejson,
+                )
+            )
+        copy_buffer.seek(0)
+
+        with self._cursor() as cr:
+            cr.execute(
+                "create temporary table import_users "
+                "(idx integer, username varchar(20), email varchar(128), "
+                "salt varchar(32), kpasswd varchar(128), hasher varchar(64), "
+                "admin boolean, extra_data bytea, extra_json jsonb) on commit drop"
+            )
+            cr.copy_expert(
+                "copy import_users from stdin with (format csv)", copy_buffer
+            )
+            cr.execute(
+                "insert into users (username, email, salt, kpasswd, hasher, "
+                "admin, extra_data, extra_json) "
+                "select username, email, salt, kpasswd, hasher, admin, "
+                "extra_data, extra_json "
+                "from import_users order by idx "
+                "on conflict do nothing returning username"
+            )
+            created = len(cr.fetchall())
+            cr.execute(
+                "select i.idx, i.username, "
+                "exists (select 1 from users u where u.username = i.username) "
+                "from import_users i "
+                "where not exists (select 1 from users u "
+                "where u.username = i.username and u.kpasswd = i.kpasswd) "
+                "order by i.idx"
+            )
+            for index, username, name_taken in cr.fetchall():
+                reason = "username exists" if name_taken else "email exists"
+                failures.append((index, username, reason))
+            cr.connection.commit()
+        return created
+
+    @instrumented()
     def is_admin(self, userid):
         """
         True if a user is admin
         @param userid   The user id as returned by find_user()
         @return True if the user is admin, False otherwise
         """
-        with self._cursor() as cr:
+        with self._cursor(read_only=True) as cr:
             cr.execute("select admin from users where userid = %s", (userid,))
             result = list(cr.fetchall())
-            self.connector.commit()
+            cr.connection.commit()
             if result:
                 return result[0][0]
             else:
                 raise BadCallError("User {} not found.".format(userid))
 
+    @instrumented()
     def set_admin(self, userid, admin=True):
         """
         Mark the user as admin
@@ -110,54 +762,110 @@ class UserSpace:
         admin = True if admin else False  # force a truthy or falsey value to boolean
         with self._cursor() as cr:
             cr.execute("update users set admin = %s where userid = %s", (admin, userid))
-            self.connector.commit()
+            cr.connection.commit()
+        self._revoke(userid)  # tokens carry the admin flag
 
-    def validate_user(self, username, password, extra_data=None):
+    @instrumented(_login_outcome)
+    def validate_user(self, username, password, extra_data=None, client=None):
         """Validates (or logs in) a username.
         @param  username    The user's username
         @param  password    The user's password in cleartext
         @param  extra_data  Dictionary with additional, user defined
                             data about the session.
+        @param  client      Key of the client attempting the login, such
+                            as its IP address, for the client_rate limit.
 
         @return tuple(key, admin, userid)
                         key is a string or empty string if not found
                         or wrong password; userid is the user id as
                         returned by create_user()
+
+        In token mode the key is a signed token rather than a session key,
+        and no session is stored in the database.
+
+        If the password was hashed with other than the current hasher,
+        it is hashed again with it and stored, in the same transaction as
+        the new session.
+
+        With login_rate or client_rate, the attempts over the limit return
+        ("", False, None) straight away.
         """
-        cr = self._cursor()
-        cr.execute(
-            "select userid, username, salt, kpasswd, admin "
-            "from users where username = %s",
-            (username,),
-        )
-        assert cr.rowcount <= 1
-        row = cr.fetchone()
-        cr.close()
-        self.connector.commit()
+        if self.throttle is not None:
+            limits = self.throttle.limits(username, client, self.schema)
+            if not self.throttle.acquire(limits, time.time()):
+                set_outcome("throttled")
+                return "", False, None
+        with self._cursor() as cr:
+            _execute(cr, "login", (username,))
+            assert cr.rowcount <= 1
+            row = cr.fetchone()
+            cr.connection.commit()
         if row is None:
             return "", False, None
-        userid, username, salt, kpasswd, admin = row
-        bpwd = bytes(password, "utf-8")
-        hpwd = hashlib.pbkdf2_hmac("sha512", bpwd, binascii.unhexlify(salt), 100000)
-        if binascii.unhexlify(kpasswd) == hpwd:
-            return self._make_session_key(userid, extra_data), admin, userid
-        else:
+        userid, username, salt, kpasswd, admin, hasher = row
+        valid, outdated = self._check_password(password, salt, kpasswd, hasher)
+        if not valid:
             return "", False, None
+        if self.throttle is not None:
+            self.throttle.release(limits, time.time())
+        rehash = None
+        if outdated:
+            rehash = self._password_args(userid, password)
+        if self.token_signer is not None:
+            if rehash is not None:
+                self._login_writes([("set_password", rehash)])
+            return self._make_token(userid, username, admin, extra_data), admin, userid
+        return self._make_session_key(userid, extra_data, rehash), admin, userid
+
+    def _password_args(self, userid, password):
+        """Arguments of SET_PASSWORD_SQL to set the password of userid"""
+        return self._new_password(password) + (userid,)
 
-    def _make_session_key(self, userid, extra_data):
+    def _set_password(self, userid, password):
+        args = self._password_args(userid, password)
+        with self._cursor() as cr:
+            _execute(cr, "set_password", args)
+            cr.connection.commit()
+
+    def _make_session_key(self, userid, extra_data, rehash=None):
+        """Create a session, storing the password re-hashed if rehash holds
+        the arguments of SET_PASSWORD_SQL, and return its key
+        """
         now = time.time()
         timeout = self.ttl + now
-        sessid = hashlib.md5(bytes(str(userid) + str(now), "utf-8")).hexdigest()
-        # xsessid = binascii.hexlify(sessid).decode("utf-8")
-        cr = self._cursor()
-        cr.execute(
-            "insert into sessions values (%s, %s, %s, %s)",
-            (userid, sessid, timeout, pickle.dumps(extra_data)),
-        )
-        self.connector.commit()
-        cr.close()
+        self._check_partitions(timeout)
+        sessid = new_session_key()
+        edata, ejson = self._dump_extra(extra_data)
+        statements = [("insert_session", (userid, sessid, timeout, edata, ejson))]
+        if rehash is not None:
+            statements.append(("set_password", rehash))
+        self._login_writes(statements)
         return sessid
 
+    def _login_writes(self, statements):
+        """Run the (name, args) STATEMENTS of a login in one transaction,
+        sent to the server in one go
+        """
+        with self._cursor() as cr:
+            queries = [
+                prepared.mogrify(cr, name, STATEMENTS[name], args)
+                for name, args in statements
+            ]
+            if not self.sync_session_commit:
+                queries.insert(0, b"set local synchronous_commit = off")
+            cr.execute(b"; ".join(queries))
+            cr.connection.commit()
+
+    def _make_token(self, userid, username, admin, extra_data):
+        now = time.time()
+        try:
+            return self.token_signer.issue(
+                userid, username, admin, now, now + self.ttl, extra_data
+            )
+        except TypeError as err:
+            raise BadCallError(f"extra_data cannot be stored in a token: {err}")
+
+    @instrumented(_rc_outcome)
     def delete_user(self, username=None, userid=None):
         """Delete a user given either its username or userid.
 
@@ -170,7 +878,7 @@ class UserSpace:
 
         @throws BadCallError if neither username or userid are specified.
         """
-        query_stmt = "delete from users where {} = %s"
+        query_stmt = "delete from users where {} = %s returning userid"
         if username is not None:
             query = query_stmt.format("username")
             value = username
@@ -182,16 +890,18 @@ class UserSpace:
                 "delete_user(): Either 'username'" + " or 'userid' must be specified."
             )
 
-        cr = self._cursor()
-        cr.execute(query, (value,))
-        if cr.rowcount == 0:
-            rc = NOT_FOUND
-        else:
-            rc = OK
-        cr.close()
-        self.connector.commit()
-        return rc
+        with self._cursor() as cr:
+            cr.execute(query, (value,))
+            row = cr.fetchone()
+            cr.connection.commit()
+        if row is None:
+            return NOT_FOUND
+        if self.session_cache is not None:
+            self.session_cache.discard_user(userid=userid, username=username)
+        self._revoke(row[0])
+        return OK
 
+    @instrumented(_rc_outcome)
     def change_password(self, userid, newpassword, oldpassword=None):
         """Change a user's password
         @param  userid      The user id, as returned by create_user()
@@ -204,11 +914,11 @@ class UserSpace:
 
         @returns OK, NOT_FOUND or REJECTED
         """
-        cr = self._cursor()
-        cr.execute("select username from users where userid = %s", (userid,))
-        row = cr.fetchone()
+        with self._cursor() as cr:
+            cr.execute("select username from users where userid = %s", (userid,))
+            row = cr.fetchone()
+            cr.connection.commit()
         if row is None:
-            cr.close()
             return NOT_FOUND
         username = row[0]
 
@@ -218,23 +928,25 @@ class UserSpace:
                 return REJECTED
             self._kill_session(key)
 
-        bpwd = bytes(newpassword, "utf-8")
-        salt = os.urandom(16)
-        hashpwd = hashlib.pbkdf2_hmac("sha512", bpwd, salt, 100000)
-        cr.execute(
-            "update users set kpasswd = %s, salt = %s where userid = %s",
-            (hashpwd.hex(), salt.hex(), userid),
-        )
-        self.connector.commit()
-        cr.close()
+        self._set_password(userid, newpassword)
+        if self.session_cache is not None:
+            self.session_cache.discard_user(userid)
+        self._revoke(userid)
         return OK
 
     def _kill_session(self, key):
-        cr = self._cursor()
-        cr.execute("delete from sessions where key = %s", (key,))
-        self.connector.commit()
-        cr.close()
+        if self.token_signer is not None and is_token(key):
+            payload = self.token_signer.verify(key)
+            if payload is not None:
+                self._revoke(jti=payload["jti"], expiration=payload["exp"])
+            return
+        with self._cursor() as cr:
+            _execute(cr, "delete_session", (key,))
+            cr.connection.commit()
+        if self.session_cache is not None:
+            self.session_cache.discard(key)
 
+    @instrumented(_session_outcome)
     def check_key(self, key):
         """Reset the session timeout.
         @param  key The session key returned by validate_user()
@@ -242,37 +954,202 @@ class UserSpace:
                     where rc is OK, NOT_FOUND or EXPIRED
                     if NOT_FOUND or EXPIRED, username and userid will be None
 
-        Resets the key's Time To Live to TIMEOUT
+        Resets the key's Time To Live to TIMEOUT, but only once the time
+        left drops below refresh_threshold * ttl. In write-behind mode the
+        new expiration is queued and written later.
+
+        In token mode, tokens are verified without querying the database
+        and are not renewed: they expire TTL seconds after they were issued.
         """
-        cr = self._cursor()
-        cr.execute(
-            """select t1.userid, t1.key, t1.expiration,
-                             t1.extra_data, t2.username
-            from sessions as t1, users as t2
-            where  t1.userid = t2.userid and
-                   t1.key = %s""",
-            (key,),
-        )
-        session_row = cr.fetchone()
-        if session_row is None:
-            cr.close()
+        if self.token_signer is not None and is_token(key):
+            return self._check_token(key)
+        if self.session_cache is not None:
+            cached = self.session_cache.get(key, time.time())
+            if cached is not None:
+                return (OK, cached.username, cached.userid, cached.extra_data)
+
+        self._check_partitions(time.time() + self.ttl)
+        with self._cursor() as cr:
+            _execute(cr, "check_session", (key,))
+            session_row = cr.fetchone()
+            if session_row is None:
+                cr.connection.commit()
+                return (NOT_FOUND, None, None, None)
+            now = time.time()
+            uid, key, timeout, extra, extra_json, username = session_row
+            extra_data = load_extra(extra, extra_json)
+            if self.touch_queue is not None:
+                timeout = max(timeout, self.touch_queue.pending(key) or 0.0)
+            renewed = renewed_expiration(timeout, now, self.ttl, self.refresh_threshold)
+            if renewed is None:
+                _execute(cr, "delete_session", (key,))
+                cr.connection.commit()
+                if self.session_cache is not None:
+                    self.session_cache.discard(key)
+                if self.touch_queue is not None:
+                    self.touch_queue.discard(key)
+                return (EXPIRED, None, None, None)
+
+            touched = renewed != timeout
+            if touched:
+                timeout = renewed
+                if self.touch_queue is None:
+                    _execute(cr, "renew_session", (timeout, key))
+            cr.connection.commit()
+        # queued once the connection is given back: touch() may flush
+        if touched and self.touch_queue is not None:
+            self.touch_queue.touch(key, timeout)
+        if self.session_cache is not None:
+            self.session_cache.put(key, username, uid, extra_data, timeout, now)
+        return (OK, username, uid, extra_data)
+
+    def _check_token(self, token):
+        payload = self.token_signer.verify(token)
+        if payload is None:
             return (NOT_FOUND, None, None, None)
         now = time.time()
-        uid, key, timeout, extra, username = session_row
-        extra_data = pickle.loads(extra)
-        if timeout < now:
-            cr.execute("delete from sessions where key = %s", (key,))
-            self.connector.commit()
-            cr.close()
+        if payload["exp"] < now:
             return (EXPIRED, None, None, None)
+        if self.revocations.is_revoked(payload, now):
+            return (NOT_FOUND, None, None, None)
+        return (OK, payload["usr"], payload["uid"], payload["xtr"])
 
-        timeout = now + self.ttl
-        cr.execute(
-            "update sessions set expiration = %s " "where key = %s", (timeout, key)
-        )
-        self.connector.commit()
-        cr.close()
-        return (OK, username, uid, extra_data)
+    def _revoke(self, userid=None, jti=None, expiration=None):
+        """Record the revocation of the tokens of userid (all users if 0)
+        issued until now, or of the token jti, in token mode.
+        """
+        if self.token_signer is None:
+            return
+        now = time.time()
+        if expiration is None:
+            expiration = now + self.ttl  # all the tokens revoked are gone by then
+        userid = userid or None
+        with self._cursor() as cr:
+            cr.execute(
+                "insert into revocations (userid, jti, issued_before, expiration) "
+                "values (%s, %s, %s, %s)",
+                (userid, jti, now, expiration),
+            )
+            cr.connection.commit()
+        # effective right away in this process
+        self.revocations.add(userid, jti, now, expiration)
+
+    def _load_revocations(self, since):
+        with self._cursor() as cr:
+            cr.execute(
+                "select userid, jti, issued_before, expiration from revocations "
+                "where issued_before >= %s and expiration >= %s",
+                (since, time.time()),
+            )
+            rows = cr.fetchall()
+            cr.connection.commit()
+        return rows
+
+    @instrumented()
+    def check_keys(self, keys):
+        """Check many session keys at once, as check_key() does for one.
+        @param  keys    An iterable of session keys.
+        @returns    Dictionary mapping each key to a tuple of the form
+                    (rc, username, userid, extra_data), as returned by
+                    check_key().
+
+        All the sessions are read in one query. The expirations to renew
+        are written in one statement and the expired sessions deleted in
+        another. In token mode, the tokens are verified without querying
+        the database, as check_key() does.
+        """
+        results = {}
+        now = time.time()
+        keys = set(keys)
+        if self.token_signer is not None:
+            for key in keys:
+                if is_token(key):
+                    results[key] = self._check_token(key)
+        if self.session_cache is not None:
+            for key in keys.difference(results):
+                cached = self.session_cache.get(key, now)
+                if cached is not None:
+                    results[key] = (
+                        OK,
+                        cached.username,
+                        cached.userid,
+                        cached.extra_data,
+                    )
+        keys = [key for key in keys if key not in results]
+        if not keys:
+            return results
+
+        expired = []
+        renewed = []
+        self._check_partitions(time.time() + self.ttl)
+        with self._cursor() as cr:
+            _execute(cr, "check_sessions", (keys,))
+            rows = cr.fetchall()
+            now = time.time()
+            for uid, key, timeout, extra, extra_json, username in rows:
+                if self.touch_queue is not None:
+                    timeout = max(timeout, self.touch_queue.pending(key) or 0.0)
+                expiration = renewed_expiration(
+                    timeout, now, self.ttl, self.refresh_threshold
+                )
+                if expiration is None:
+                    expired.append(key)
+                    results[key] = (EXPIRED, None, None, None)
+                    continue
+                if expiration != timeout:
+                    timeout = expiration
+                    renewed.append((key, timeout))
+                extra_data = load_extra(extra, extra_json)
+                results[key] = (OK, username, uid, extra_data)
+                if self.session_cache is not None:
+                    self.session_cache.put(key, username, uid, extra_data, timeout, now)
+
+            if expired:
+                cr.execute("delete from sessions where key = any(%s)", (expired,))
+            if renewed and self.touch_queue is None:
+                execute_values(
+                    cr, RENEW_SESSIONS_SQL, sorted(renewed), page_size=len(renewed)
+                )
+            cr.connection.commit()
+
+        if self.touch_queue is not None:
+            for key, timeout in renewed:
+                self.touch_queue.touch(key, timeout)
+            for key in expired:
+                self.touch_queue.discard(key)
+        if self.session_cache is not None:
+            for key in expired:
+                self.session_cache.discard(key)
+        for key in keys:
+            results.setdefault(key, (NOT_FOUND, None, None, None))
+        return results
+
+    @instrumented()
+    def ensure_partitions(self):
+        """Create the sessions partitions needed for the sessions expiring
+        from now until a partition past the TTL.
+        @return List of the names of the partitions created.
+
+        Called as needed by the methods creating or renewing sessions, and
+        by the reaper. Does nothing if the sessions table is not partitioned.
+        """
+        if not self.partition_size:
+            return []
+        return self._ensure_partitions(self._cursor)
+
+    def _ensure_partitions(self, cursor):
+        now = time.time()
+        until = now + self.ttl + self.partition_size
+        with cursor() as cr:
+            created = partitions.ensure_partitions(cr, now, until, self.partition_size)
+            self.partitions_until = partitions.partitions(cr)[-1][1]
+            cr.connection.commit()
+        return created
+
+    def _check_partitions(self, expiration):
+        """Make sure there is a partition for sessions expiring at expiration"""
+        if self.partition_size and expiration >= self.partitions_until:
+            self.ensure_partitions()
 
     def set_session_TTL(self, secs):
         """Sets the TTL for all sessions.
@@ -281,6 +1158,19 @@ class UserSpace:
         """
         self.ttl = secs
 
+    def set_refresh_threshold(self, fraction):
+        """Sets when check_key() renews the expiration of a session.
+        @param  fraction    fraction of the TTL, between 0 and 1.
+        The expiration is only written back to the database when the time
+        left for the session is less than fraction * TTL. With 1.0 (the
+        default) every check renews the session, lower values make most
+        checks read-only at the cost of sessions lasting a bit less.
+        """
+        if not 0.0 <= fraction <= 1.0:
+            raise BadCallError("Refresh threshold must be between 0 and 1")
+        self.refresh_threshold = fraction
+
+    @instrumented(_found_outcome)
     def find_user(self, username=None, email=None, userid=None):
         """Find a user given either its username, its email or its userid.
         @param  username    The username string.
@@ -289,18 +1179,14 @@ class UserSpace:
         @returns A dictionary with fields userid, username, email, admin, and extra_data
                  None if not found.
         """
-        query_stmt = (
-            "select userid, username, email, admin, extra_data "
-            "from users where {} = %s"
-        )
         if username is not None:
-            query = query_stmt.format("username")
+            name = "find_user_username"
             value = username
         elif email is not None:
-            query = query_stmt.format("email")
+            name = "find_user_email"
             value = email
         elif userid is not None:
-            query = query_stmt.format("userid")
+            name = "find_user_userid"
             value = userid
         else:
             raise BadCallError(
@@ -308,20 +1194,87 @@ class UserSpace:
                 "'email' or 'userid' must be specified."
             )
 
-        cr = self._cursor()
-        cr.execute(query, (value,))
+        with self._cursor(read_only=True) as cr:
+            _execute(cr, name, (value,))
 
-        row = cr.fetchone()
-        if row is not None:
-            ret_row = {d[0]: v for d, v in zip(cr.description, row)}
-            ret_row["extra_data"] = pickle.loads(ret_row["extra_data"])
-        else:
-            ret_row = None
+            row = cr.fetchone()
+            cr.connection.commit()
+        return _user_row(row)
+
+    @instrumented()
+    def find_users_by_extra(self, **criteria):
+        """Find the users whose extra_data contains the given items.
+        @param  criteria    Keys and values that the extra_data dictionary
+                            of the users must have. Values may be nested
+                            dictionaries or lists, which must be contained
+                            in those of the user.
+        @returns A list of dictionaries like the ones returned by
+                 find_user(), sorted by username.
+
+        Uses the index on the extra_data stored as JSON, so it only finds
+        users whose extra_data was stored in json_extra mode or converted
+        with convert_extra_data().
+        """
+        try:
+            contained = json.dumps(criteria)
+        except TypeError as err:
+            raise BadCallError(f"find_users_by_extra(): {err}")
+        with self._cursor(read_only=True) as cr:
+            cr.execute(
+                "select userid, username, email, admin, extra_data, "
+                "extra_json::text from users where extra_json @> %s::jsonb "
+                "order by username",
+                (contained,),
+            )
+            rows = cr.fetchall()
+            cr.connection.commit()
+        return [_user_row(row) for row in rows]
 
-        cr.close()
-        self.connector.commit()
-        return ret_row
+    @instrumented()
+    def convert_extra_data(self, batch_size=1000):
+        """Store the pickled extra_data of the users as JSON.
+        @param  batch_size  number of users converted per transaction.
+        @return The number of users converted.
+
+        Users whose extra_data cannot be encoded as JSON are left as they
+        are. Sessions are not converted, they are short lived anyway.
+        """
+        converted = 0
+        last = 0
+        while True:
+            with self._cursor() as cr:
+                cr.execute(
+                    "select userid, extra_data from users "
+                    "where userid > %s and extra_data is not null "
+                    "order by userid limit %s",
+                    (last, batch_size),
+                )
+                rows = cr.fetchall()
+                values = []
+                for userid, extra in rows:
+                    try:
+                        values.append(
+                            (userid, dump_extra(load_extra(extra, None), True)[1])
+                        )
+                    except TypeError:
+                        pass  # not representable as JSON
+                if values:
+                    execute_values(
+                        cr,
+                        "update users as u set extra_data = null, "
+                        "extra_json = v.extra_json::jsonb "
+                        "from (values %s) as v (userid, extra_json) "
+                        "where u.userid = v.userid",
+                        values,
+                        page_size=len(values),
+                    )
+                cr.connection.commit()
+            converted += len(values)
+            if len(rows) < batch_size:
+                return converted
+            last = rows[-1][0]
 
+    @instrumented(_rc_outcome)
     def modify_user(self, userid, username=None, email=None, extra_data=None):
         """Modify user data.
         @param userid   The user id as returned by create_user()
@@ -341,34 +1294,190 @@ class UserSpace:
             fields_sql.append("email = %s")
             fields_list.append(email)
         if extra_data is not None:
-            fields_sql.append("extra_data = %s")
-            fields_list.append(pickle.dumps(extra_data))
+            fields_sql.append("extra_data = %s, extra_json = %s::jsonb")
+            fields_list.extend(self._dump_extra(extra_data))
 
         if fields_list:
             query = "update users set " + ", ".join(fields_sql) + " where userid = %s"
 
             fields_list.append(userid)
 
-            cr = self._cursor()
-            cr.execute(query, fields_list)
-            if cr.rowcount <= 0:
-                rc = NOT_FOUND
-            self.connector.commit()
-            cr.close()
+            with self._cursor() as cr:
+                cr.execute(query, fields_list)
+                if cr.rowcount <= 0:
+                    rc = NOT_FOUND
+                cr.connection.commit()
+            if self.session_cache is not None:
+                self.session_cache.discard_user(userid)
 
         return rc
 
+    @instrumented()
     def all_users(self):
-        """Generator yielding (userid, username, email, admin) tuples for all users"""
-        with self._cursor() as cr:
+        """Generator yielding (userid, username, email, admin) tuples for all users
+
+        The users are fetched from the database itersize at a time.
+        """
+        with self._cursor(streaming=True, read_only=True) as cr:
             cr.execute(
                 "select userid, username, email, admin from users " "order by username"
             )
-            for row in cr.fetchall():
-                yield row
-            self.connector.commit()
+            yield from cr
+            cr.close()
+            cr.connection.commit()
+
+    @instrumented()
+    def list_users(
+        self,
+        limit=50,
+        after=None,
+        admins_only=False,
+        username_prefix=None,
+        email_prefix=None,
+        count=False,
+    ):
+        """Return one page of users, in username order.
+        @param limit    Maximum number of users in the page, at least 1.
+        @param after    Where the page starts: the next_after value returned
+                        with the previous page, or a username to start
+                        right after it. None for the first page.
+        @param admins_only  Only list the administrators.
+        @param username_prefix  Only list users whose username starts with it.
+        @param email_prefix     Only list users whose email starts with it.
+        @param count    Also return the planner's estimate of the number of
+                        users matching the filters.
+
+        @return tuple(users, next_after, total) where users is a list of
+                (userid, username, email, admin) tuples, next_after is the
+                value of after for the next page or None if this is the
+                last one, and total is the estimated number of users (None
+                unless count is True).
+        """
+        if limit < 1:
+            raise BadCallError("The page limit must be at least 1")
+        filters = []
+        filter_args = []
+        if admins_only:
+            filters.append("admin")
+        if username_prefix:
+            filters.append("username like %s")
+            filter_args.append(_like_prefix(username_prefix))
+        if email_prefix:
+            filters.append("email like %s")
+            filter_args.append(_like_prefix(email_prefix))
+
+        conds = list(filters)
+        args = list(filter_args)
+        if isinstance(after, str):
+            conds.append("username > %s")
+            args.append(after)
+        elif after is not None:
+            conds.append("(username, userid) > (%s, %s)")
+            args.extend(after)
+
+        sql = "select userid, username, email, admin from users "
+        if conds:
+            sql += "where " + " and ".join(conds) + " "
+        sql += "order by username, userid limit %s"
+        args.append(limit + 1)  # one more to know if there is a next page
 
+        total = None
+        with self._cursor(read_only=True) as cr:
+            cr.execute(sql, args)
+            rows = cr.fetchall()
+            if count:
+                sql = "explain (format json) select 1 from users"
+                if filters:
+                    sql += " where " + " and ".join(filters)
+                cr.execute(sql, filter_args)
+                total = cr.fetchone()[0][0]["Plan"]["Plan Rows"]
+            cr.connection.commit()
+
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = (rows[-1][1], rows[-1][0])
+        return rows, next_after, total
+
+    @instrumented()
+    def reap_sessions(self, batch_size=1000, sleep=0.1, max_batches=None):
+        """Delete the expired sessions a batch at a time.
+        @param  batch_size  number of sessions deleted per transaction.
+        @param  sleep       seconds to pause between batches.
+        @param  max_batches if specified, stop after this many batches even
+                            if there are expired sessions left.
+        @return The number of sessions deleted.
+        """
+        return self._reap(self._cursor, batch_size, sleep, max_batches)
+
+    def _reap(self, cursor, batch_size, sleep, max_batches=None, stopping=None):
+        self.flush()  # don't reap sessions renewed but not yet written
+        now = time.time()
+        reaped = 0
+        batches = 0
+        if self.partition_size:
+            self._ensure_partitions(cursor)
+            with cursor() as cr:
+                reaped += partitions.drop_expired_partitions(cr, now)
+                cr.connection.commit()
+        with cursor() as cr:
+            # the tokens they revoke have all expired
+            cr.execute("delete from revocations where expiration < %s", (now,))
+            cr.connection.commit()
+        while max_batches is None or batches < max_batches:
+            with cursor() as cr:
+                # skip locked rows so concurrent reapers don't wait on each other
+                cr.execute(
+                    """delete from sessions where key in (
+                         select key from sessions where expiration < %s
+                         limit %s for update skip locked)""",
+                    (now, batch_size),
+                )
+                deleted = cr.rowcount
+                cr.connection.commit()
+            reaped += deleted
+            batches += 1
+            if deleted < batch_size:
+                break
+            if stopping is None:
+                time.sleep(sleep)
+            elif stopping.wait(sleep):
+                break
+        return reaped
+
+    def start_reaper(self, interval=60.0, batch_size=1000, sleep=0.1):
+        """Start a background thread deleting the expired sessions.
+        @param  interval    seconds between rounds.
+        @param  batch_size  number of sessions deleted per transaction.
+        @param  sleep       seconds to pause between batches.
+        """
+        if self.reaper is not None:
+            self.stop_reaper()
+
+        def reap(stopping):
+            cursor = partial(self._thread_cursor, "reap_connector")
+            return self._reap(cursor, batch_size, sleep, stopping=stopping)
+
+        self.reaper = SessionReaper(reap, interval)
+        self.reaper.start()
+        atexit.register(self.reaper.stop)
+
+    def stop_reaper(self):
+        """Stop the background thread started by start_reaper()"""
+        if self.reaper is not None:
+            self.reaper.stop()
+            atexit.unregister(self.reaper.stop)
+            self.reaper = None
+
+    def set_itersize(self, rows):
+        """Sets how many rows all_users() and list_sessions() fetch at a time.
+        @param  rows    number of rows fetched from the database at a time.
+        """
+        self.itersize = rows
+
+    @instrumented()
     def list_sessions(self, uid, expired=False):
+        self.flush()
         now = time.time()
         sql = """select u.username, s.key, s.expiration
                  from sessions s
@@ -392,14 +1501,15 @@ class UserSpace:
         if expcond:
             sql += expcond
 
-        with self._cursor() as cr:
+        with self._cursor(streaming=True, read_only=True) as cr:
             cr.execute(sql, args)
-            for row in cr.fetchall():
-                yield row
-
-        self.connector.commit()
+            yield from cr
+            cr.close()
+            cr.connection.commit()
 
+    @instrumented()
     def kill_sessions(self, uid, expired=False):
+        self.flush()  # don't kill sessions renewed but not yet written
         now = time.time()
         sql = "delete from sessions "
         args = []
@@ -423,33 +1533,67 @@ class UserSpace:
 
         with self._cursor() as cr:
             cr.execute(sql, args)
+            cr.connection.commit()
+        if not expired:
+            self._revoke(uid)
 
-        self.connector.commit()
+        if self.session_cache is not None:
+            # expired sessions are never served from the cache anyway
+            if uid != 0:
+                self.session_cache.discard_user(uid)
+            elif not expired:
+                self.session_cache.clear()
 
 
-def dbinit(db):
-    """Create a new database structure"""
-    sql = [  # statements to be executed in sequence
-        """create table if not exists users (
-            userid      serial primary key,
-            username    varchar(20),
-            email       varchar(128),
-            salt        varchar(32),
-            kpasswd     varchar(128),
-            admin       boolean not null default 'no',
-            extra_data  bytea
-            )
-    """,
-        """create table if not exists sessions (
-            userid  integer,
-            key     varchar(32),
-            expiration real,
-            extra_data  bytea
-            )
-    """,
-    ]
-    csr = db.cursor()
-    for stmt in sql:
-        csr.execute(stmt)
-    db.commit()
+def _execute(cr, name, args):
+    """Run one of the STATEMENTS, prepared if the connection allows it"""
+    prepared.execute(cr, name, STATEMENTS[name], args)
+
+
+def _insert_error(err, username, email):
+    """Message for the database error raised inserting a user"""
+    constraint = err.diag.constraint_name
+    if constraint == "users_username_key":
+        return f"User '{username}' already in database"
+    if constraint == "users_email_key":
+        return f"Email '{email}' already in database"
+    return str(err).strip()
+
+
+def _user_row(row):
+    """Dictionary returned by find_user() for a users row selected with
+    the userid, username, email, admin, extra_data and extra_json columns
+    """
+    if row is None:
+        return None
+    userid, username, email, admin, extra, extra_json = row
+    return {
+        "userid": userid,
+        "username": username,
+        "email": email,
+        "admin": admin,
+        "extra_data": load_extra(extra, extra_json),
+    }
+
+
+def _like_prefix(prefix):
+    """LIKE pattern matching the strings that start with prefix"""
+    for char in "\\%_":
+        prefix = prefix.replace(char, "\\" + char)
+    return prefix + "%"
+
+
+def dbinit(db, partitioned_sessions=False):
+    """Create a new database structure, or upgrade an existing one.
+    BadCallError is raised if the upgrade finds users sharing a username
+    or an email, which must be told apart first: see usermgr duplicates.
+    """
+    if partitioned_sessions:
+        with db.cursor() as cr:
+            partitions.create_sessions_table(cr)
+        db.commit()
+    try:
+        migrate(db)
+    except DuplicateValuesError as err:
+        raise BadCallError(str(err)) from err
     return db
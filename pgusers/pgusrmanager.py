@@ -1,11 +1,18 @@
 import sys
 import argparse
 import re
+import csv
+import json
+import time
 from datetime import datetime
 from pprint import pprint
 from getpass import getpass
 
+import psycopg2
+
 import pgusers
+from pgusers.migrations import migrate, schema_version, MIGRATIONS
+from pgusers.migrations import find_duplicates, DuplicateValuesError
 
 
 def get_cli_options(argv):
@@ -81,7 +88,31 @@ def get_cli_options(argv):
     )
     deluser.add_argument("user", help="userid or email for the user")
 
-    subparsers.add_parser("list", description="list all users", help="list all users")
+    listusers = subparsers.add_parser(
+        "list",
+        description="list all users, or one page of them",
+        help="list all users",
+    )
+    listusers.add_argument(
+        "--limit",
+        "-l",
+        type=int,
+        metavar="N",
+        help="list at most N users (50 by default when paginating)",
+    )
+    listusers.add_argument(
+        "--after", metavar="USERNAME", help="start the list after this username"
+    )
+    listusers.add_argument(
+        "--admins-only",
+        "-a",
+        action="store_true",
+        default=False,
+        help="list only the administrators",
+    )
+    listusers.add_argument(
+        "--prefix", metavar="PREFIX", help="list only usernames starting with PREFIX"
+    )
 
     info = subparsers.add_parser(
         "info",
@@ -132,11 +163,101 @@ def get_cli_options(argv):
     )
     killsess.add_argument("user", nargs="?", help="userid or email for the user")
 
+    reap = subparsers.add_parser(
+        "reap",
+        description="delete the expired sessions a batch at a time",
+        help="delete the expired sessions",
+    )
+    reap.add_argument(
+        "--batch-size",
+        "-b",
+        type=int,
+        default=1000,
+        metavar="N",
+        help="number of sessions deleted per transaction (default 1000)",
+    )
+    reap.add_argument(
+        "--sleep",
+        "-S",
+        type=float,
+        default=0.1,
+        metavar="SECS",
+        help="seconds to pause between batches (default 0.1)",
+    )
+    reap.add_argument(
+        "--max-batches",
+        "-m",
+        type=int,
+        metavar="N",
+        help="stop after N batches",
+    )
+
+    stats = subparsers.add_parser(
+        "stats",
+        description="print, in the Prometheus text format, the number of "
+        "users and sessions in the userspace, followed by the metrics "
+        "snapshot written by an application with Metrics.dump()",
+        help="print the userspace's metrics",
+    )
+    stats.add_argument(
+        "--file", "-f", metavar="PATH", help="metrics snapshot file to include"
+    )
+
+    migrate_cmd = subparsers.add_parser(
+        "migrate",
+        description="upgrade the database schema to the latest version",
+        help="upgrade the database schema",
+    )
+    migrate_cmd.add_argument(
+        "--target",
+        "-T",
+        type=int,
+        metavar="VERSION",
+        help="upgrade up to this version instead of the latest",
+    )
+    migrate_cmd.add_argument(
+        "--dry-run",
+        "-n",
+        action="store_true",
+        default=False,
+        help="only show the current version and the pending migrations",
+    )
+
+    subparsers.add_parser(
+        "duplicates",
+        description="list the users sharing a username or an email, which "
+        "stop the upgrade of databases created by older versions",
+        help="list the users sharing a username or an email",
+    )
+
+    importcmd = subparsers.add_parser(
+        "import",
+        description="create the users listed in a CSV or JSON lines file. "
+        "CSV files must have a header line naming the columns username, "
+        "password, email and optionally admin. JSON lines files hold one "
+        "object per line with the same keys, plus optionally extra_data.",
+        help="create users in bulk from a file",
+    )
+    importcmd.add_argument(
+        "--format",
+        "-f",
+        choices=["csv", "jsonl"],
+        help="file format, by default guessed from the file extension",
+    )
+    importcmd.add_argument(
+        "--batch-size",
+        "-b",
+        type=int,
+        default=1000,
+        metavar="N",
+        help="number of users loaded at a time (default 1000)",
+    )
+    importcmd.add_argument("file", help="the file to import, '-' for stdin")
+
     return parser.parse_args(argv)
 
 
-def get_userspace(opts):
-    name = opts.userspace
+def get_connection_params(opts):
     params = {}
     if opts.dbuser:
         params["user"] = opts.dbuser
@@ -146,8 +267,11 @@ def get_userspace(opts):
         params["host"] = opts.dbhost
     if opts.dbhost or opts.dbport != "5432":  # don't bother with port if no host
         params["port"] = opts.dbport
+    return params
 
-    return pgusers.UserSpace(name, **params)
+
+def get_userspace(opts):
+    return pgusers.UserSpace(opts.userspace, **get_connection_params(opts))
 
 
 def enter_password(userid):
@@ -224,11 +348,25 @@ def cmd_delete(opts):
 
 def cmd_listusers(opts):
     userspace = get_userspace(opts)
-    for i, (uid, username, email, admin) in enumerate(userspace.all_users()):
+    paginate = opts.limit or opts.after or opts.admins_only or opts.prefix
+    next_after = None
+    if paginate:
+        rows, next_after, total = userspace.list_users(
+            limit=opts.limit or 50,
+            after=opts.after,
+            admins_only=opts.admins_only,
+            username_prefix=opts.prefix,
+        )
+    else:
+        rows = userspace.all_users()
+
+    for i, (uid, username, email, admin) in enumerate(rows):
         if i == 0:
             print(f"{'uid':5}|{'username':20}|adm|{'email':30}")
             print(f"{'='*5}+{'='*20}+===+{'='*30}")
         print(f"{uid:5}|{username:20}|{'yes' if admin else ' ':3}|{email:30}")
+    if next_after:
+        print(f"More users after '{next_after[0]}'")
     return 0
 
 
@@ -285,6 +423,153 @@ def cmd_listsessions(opts):
     return 0
 
 
+def cmd_reap(opts):
+    userspace = get_userspace(opts)
+    reaped = userspace.reap_sessions(opts.batch_size, opts.sleep, opts.max_batches)
+    print(f"{reaped} expired sessions deleted.")
+    return 0
+
+
+def cmd_stats(opts):
+    db = psycopg2.connect(dbname=opts.userspace, **get_connection_params(opts))
+    with db.cursor() as cr:
+        cr.execute("select count(*) from users")
+        users = cr.fetchone()[0]
+        cr.execute(
+            "select count(*), count(*) filter (where expiration < %s) from sessions",
+            (time.time(),),
+        )
+        sessions, expired = cr.fetchone()
+    db.close()
+    for name, help_text, value in (
+        ("users", "Users in the userspace.", users),
+        ("sessions", "Sessions stored, including the expired ones.", sessions),
+        ("expired_sessions", "Expired sessions not yet deleted.", expired),
+    ):
+        print(f"# HELP pgusers_{name} {help_text}")
+        print(f"# TYPE pgusers_{name} gauge")
+        print(f"pgusers_{name} {value}")
+    if opts.file:
+        with open(opts.file) as snapshot:
+            sys.stdout.write(snapshot.read())
+    return 0
+
+
+def read_csv_users(stream, errors):
+    """Yield the users of a CSV file. The rows that cannot be read are
+    yielded empty, their error kept in errors by index, so that
+    create_users() reports them in their place.
+    """
+    rows = csv.DictReader(stream)
+    index = 0
+    while True:
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        except csv.Error as err:
+            errors[index] = f"unreadable line: {err}"
+            row = {}
+        else:
+            admin = (row.get("admin") or "").strip().lower()
+            row["admin"] = admin in ("1", "yes", "true")
+        index += 1
+        yield row
+
+
+def read_jsonl_users(stream, errors):
+    """Yield the users of a JSON lines file, as read_csv_users() does"""
+    for index, line in enumerate(stream):
+        user = {}
+        if line.strip():
+            try:
+                user = json.loads(line)
+            except ValueError as err:
+                errors[index] = f"invalid JSON: {err}"
+            else:
+                if not isinstance(user, (dict, list)):
+                    errors[index] = "not a JSON object or array"
+                    user = {}
+        yield user
+
+
+def cmd_import(opts):
+    fmt = opts.format
+    if fmt is None:
+        fmt = "jsonl" if opts.file.endswith((".jsonl", ".json")) else "csv"
+    if fmt == "csv":
+        reader, first_line = read_csv_users, 2  # after the header
+    else:
+        reader, first_line = read_jsonl_users, 1
+
+    userspace = get_userspace(opts)
+    stream = sys.stdin if opts.file == "-" else open(opts.file, newline="")
+    errors = {}  # index: why the line could not be read
+    with stream:
+        try:
+            created, failures = userspace.create_users(
+                reader(stream, errors), opts.batch_size
+            )
+        except psycopg2.Error as err:
+            print(f"Import stopped, earlier batches may have been created: {err}")
+            return 1
+
+    for index, username, reason in failures:
+        reason = errors.get(index, reason)
+        print(f"line {index + first_line}: user '{username}' not created: {reason}")
+    print(f"{created} users created, {len(failures)} failed.")
+    return 1 if failures else 0
+
+
+def cmd_migrate(opts):
+    db = psycopg2.connect(dbname=opts.userspace, **get_connection_params(opts))
+    current = schema_version(db)
+    print(f"Schema version: {current}")
+    pending = [
+        (version, description)
+        for version, description, func in MIGRATIONS
+        if version > current and (opts.target is None or version <= opts.target)
+    ]
+    if not pending:
+        print("Nothing to do.")
+    elif opts.dry_run:
+        for version, description in pending:
+            print(f"Pending: {version:4} {description}")
+    else:
+        try:
+            for version, description in migrate(db, opts.target):
+                print(f"Applied: {version:4} {description}")
+        except DuplicateValuesError as err:
+            print(err)
+            print("See: usermgr", opts.userspace, "duplicates")
+            return 1
+        finally:
+            db.close()
+        return 0
+    db.close()
+    return 0
+
+
+def cmd_duplicates(opts):
+    db = psycopg2.connect(dbname=opts.userspace, **get_connection_params(opts))
+    with db.cursor() as cr:
+        duplicates = find_duplicates(cr)
+        for column, value, userids in duplicates:
+            print(f"{column} '{value}':")
+            cr.execute(
+                "select userid, username, email from users where userid = any(%s) "
+                "order by userid",
+                (userids,),
+            )
+            for userid, username, email in cr.fetchall():
+                print(f"    {userid:6} {username:20} {email}")
+    db.close()
+    if not duplicates:
+        print("No duplicates.")
+        return 0
+    return 1
+
+
 def cmd_setadmin(opts):
     admin = not opts.remove
     userspace = get_userspace(opts)
@@ -317,6 +602,11 @@ def main(argv=None):
         "info": cmd_info,
         "listsessions": cmd_listsessions,
         "killsessions": cmd_killsessions,
+        "reap": cmd_reap,
+        "stats": cmd_stats,
+        "migrate": cmd_migrate,
+        "duplicates": cmd_duplicates,
+        "import": cmd_import,
     }
     return commands[opts.cmd](opts)
 
@@ -0,0 +1,89 @@
+import threading
+import time
+
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+
+class ConnectionPool:
+    """Thread-safe pool of connections to one database.
+
+    psycopg2's ThreadedConnectionPool raises PoolError as soon as all its
+    connections are checked out. This pool makes the caller wait instead,
+    for at most ``timeout`` seconds (forever if None), and keeps count of
+    how often and how long callers had to wait for a connection.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=None, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def getconn(self):
+        """Check out a connection, waiting for one to be returned if necessary.
+        @throws PoolError if no connection became free within the timeout.
+        """
+        if not self._slots.acquire(blocking=False):
+            start = time.perf_counter()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            waited = time.perf_counter() - start
+            with self._lock:
+                self.waits += 1
+                self.wait_time += waited
+                if not acquired:
+                    self.timeouts += 1
+            if not acquired:
+                raise PoolError(
+                    "No connection available after {:.3f} seconds".format(waited)
+                )
+
+        try:
+            conn = self._pool.getconn()
+            if conn.closed:  # lost connection, replace it with a fresh one
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool. Any open transaction is rolled back."""
+        try:
+            if self._pool.closed:  # closed while conn was checked out
+                conn.close()
+            else:
+                self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def closeall(self):
+        """Close all the connections in the pool"""
+        if not self._pool.closed:
+            self._pool.closeall()
+
+    def stats(self):
+        """Return a dictionary with the pool usage counters"""
+        with self._lock:
+            return {
+                "minconn": self.minconn,
+                "maxconn": self.maxconn,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "timeouts": self.timeouts,
+            }
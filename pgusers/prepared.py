@@ -0,0 +1,72 @@
+"""Server-side prepared statements for the queries run on every request.
+
+psycopg2 sends the whole text of every query, which the server parses
+and plans each time. Connections created with PreparingConnection keep
+track of the statements prepared on them, so that each statement is
+prepared once per connection and then run with EXECUTE. A new connection,
+after a reconnection for instance, starts with nothing prepared. On other
+connections the statements are just executed as they are.
+"""
+
+import re
+import threading
+
+from .metrics import TimedConnection
+
+PLACEHOLDER = re.compile(r"%s")
+PREFIX = "pgusers_"  # to keep clear of the application's own statements
+
+
+class PreparingConnection(TimedConnection):
+    """Connection remembering the statements prepared on it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.prepare_lock = threading.Lock()  # for connections shared by threads
+
+
+def _numbered(sql):
+    """sql with its %s placeholders replaced by $1, $2..."""
+    counter = iter(range(1, sql.count("%s") + 1))
+    return PLACEHOLDER.sub(lambda match: f"${next(counter)}", sql)
+
+
+def _execute_sql(name, nargs):
+    return "execute {}{}{}".format(
+        PREFIX, name, " ({})".format(", ".join(["%s"] * nargs)) if nargs else ""
+    )
+
+
+def _prepare(cr, name, sql):
+    """Prepare sql as name on the cursor's connection unless already done.
+    @return Whether the connection runs prepared statements.
+    """
+    prepared = getattr(cr.connection, "prepared", None)
+    if prepared is None:
+        return False
+    if name not in prepared:
+        with cr.connection.prepare_lock:
+            if name not in prepared:
+                cr.execute(f"prepare {PREFIX}{name} as {_numbered(sql)}")
+                prepared.add(name)
+    return True
+
+
+def execute(cr, name, sql, args=()):
+    """Run sql, with args, as the prepared statement name"""
+    if _prepare(cr, name, sql):
+        cr.execute(_execute_sql(name, len(args)), args)
+    else:
+        cr.execute(sql, args)
+
+
+def mogrify(cr, name, sql, args=()):
+    """Return the query text running sql, with args, as the prepared
+    statement name, to be sent along with other statements. The statement
+    is prepared beforehand if needed, so that the query does not depend on
+    it having been.
+    """
+    if _prepare(cr, name, sql):
+        return cr.mogrify(_execute_sql(name, len(args)), args)
+    return cr.mogrify(sql, args)
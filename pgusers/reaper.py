@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+class SessionReaper:
+    """Background thread deleting the expired sessions.
+
+    Every ``interval`` seconds ``reap_func(stopping)`` is called to delete
+    the sessions that have expired. It is expected to do so in small
+    batches, each in a transaction of its own, to return the number of
+    sessions deleted, and to return early once the ``stopping`` event is
+    set.
+    """
+
+    def __init__(self, reap_func, interval=60.0):
+        self.reap_func = reap_func
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.reaped = 0
+        self.errors = 0
+        self.last_run = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="pgusers-session-reaper", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread once the batch in progress is done"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def reap(self):
+        """Delete the expired sessions now. Returns the number deleted."""
+        try:
+            reaped = self.reap_func(self._stopping)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        with self._lock:
+            self.runs += 1
+            self.reaped += reaped
+            self.last_run = time.time()
+        return reaped
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.reap()
+            except Exception:
+                pass  # counted in errors, retried on the next round
+
+    def stats(self):
+        """Return a dictionary with the reaper's counters"""
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "runs": self.runs,
+                "reaped": self.reaped,
+                "errors": self.errors,
+                "last_run": self.last_run,
+            }
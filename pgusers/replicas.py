@@ -0,0 +1,90 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+from .pool import ConnectionPool
+
+
+class ReplicaSet:
+    """Pools of connections to read-only replicas, used in turn.
+
+    Each replica is given either as a DSN string or as a dictionary of
+    connection parameters. Connections are only opened when first needed.
+    A replica that cannot be connected to, or whose connection fails while
+    in use, is left out for ``retry_after`` seconds, after which it is
+    tried again.
+    """
+
+    def __init__(self, replicas, maxconn=1, timeout=None, retry_after=30.0):
+        self.replicas = [
+            {"dsn": replica} if isinstance(replica, str) else dict(replica)
+            for replica in replicas
+        ]
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._pools = [None] * len(self.replicas)
+        self._down_until = [0.0] * len(self.replicas)
+        self._reads = [0] * len(self.replicas)
+        self._failures = [0] * len(self.replicas)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _pool(self, index):
+        with self._lock:
+            if self._pools[index] is None:
+                self._pools[index] = ConnectionPool(
+                    0, self.maxconn, self.timeout, **self.replicas[index]
+                )
+            return self._pools[index]
+
+    def getconn(self):
+        """Check out a connection to the next replica that is up.
+        @return tuple(index, connection), or None if no replica is available.
+        """
+        for attempt in range(len(self.replicas)):
+            with self._lock:
+                index = self._next
+                self._next = (index + 1) % len(self.replicas)
+                if self._down_until[index] > time.time():
+                    continue
+            try:
+                conn = self._pool(index).getconn()
+            except psycopg2.OperationalError:
+                self.mark_down(index)
+                continue
+            except PoolError:
+                continue  # busy, not broken
+            with self._lock:
+                self._reads[index] += 1
+            return index, conn
+        return None
+
+    def putconn(self, index, conn, close=False):
+        self._pool(index).putconn(conn, close)
+
+    def mark_down(self, index):
+        """Leave the replica out until retry_after seconds from now"""
+        with self._lock:
+            self._down_until[index] = time.time() + self.retry_after
+            self._failures[index] += 1
+
+    def closeall(self):
+        for pool in self._pools:
+            if pool is not None:
+                pool.closeall()
+
+    def stats(self):
+        """Return a list with a dictionary of counters for each replica"""
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "up": self._down_until[index] <= now,
+                    "reads": self._reads[index],
+                    "failures": self._failures[index],
+                }
+                for index in range(len(self.replicas))
+            ]
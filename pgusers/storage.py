@@ -0,0 +1,502 @@
+"""Storage backends for EmbeddedUserSpace.
+
+A backend stores the users and sessions and answers the handful of queries
+the userspace methods need, leaving the passwords, expirations and return
+codes to the userspace. Two are provided: MemoryBackend keeps everything
+in dictionaries, for tests and for nodes that only need the sessions while
+they run, and SQLiteBackend keeps it in an SQLite database file.
+
+User rows are (userid, username, email, salt, kpasswd, hasher, admin,
+extra_data) tuples and session rows (userid, key, expiration, extra_data,
+username) tuples, extra_data being pickled. Listings of users are in
+(username, userid) order.
+"""
+
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+
+USER_FIELDS = ("username", "email", "salt", "kpasswd", "hasher", "admin", "extra_data")
+MAX_USERID = 2**62  # sorts after every userid, for pages after a bare username
+
+
+class DuplicateError(Exception):
+    """A user with the same username or email exists. args[0] is the field."""
+
+
+class Backend(ABC):
+    """Interface of the storage backends"""
+
+    @abstractmethod
+    def insert_user(self, username, email, salt, kpasswd, hasher, admin, extra_data):
+        """Store a new user and return its userid.
+        Raises DuplicateError if the username or the email are taken.
+        """
+
+    @abstractmethod
+    def get_user(self, field, value):
+        """Return the user row whose field, username, email or userid, is
+        value, or None
+        """
+
+    @abstractmethod
+    def update_user(self, userid, **fields):
+        """Change the given fields of a user. Return False if not found.
+        Raises DuplicateError if the new username or email are taken.
+        """
+
+    @abstractmethod
+    def delete_user(self, field, value):
+        """Delete a user and its sessions. Return its userid, None if not
+        found.
+        """
+
+    @abstractmethod
+    def users(
+        self,
+        after=None,
+        limit=None,
+        admins_only=False,
+        username_prefix=None,
+        email_prefix=None,
+    ):
+        """Return a list of (userid, username, email, admin) tuples.
+        @param after    Only the users after this (username, userid).
+        @param limit    Maximum number of users returned.
+        @param admins_only  Only the administrators.
+        @param username_prefix  Only the users whose username starts with it.
+        @param email_prefix     Only the users whose email starts with it.
+        """
+
+    @abstractmethod
+    def count_users(self, admins_only=False, username_prefix=None, email_prefix=None):
+        """Return the number of users users() lists without a limit"""
+
+    @abstractmethod
+    def insert_session(self, userid, key, expiration, extra_data):
+        """Store a new session"""
+
+    @abstractmethod
+    def get_sessions(self, keys):
+        """Return the session rows of keys, leaving out the unknown ones"""
+
+    @abstractmethod
+    def renew_sessions(self, renewals):
+        """Set the expiration of each session in a list of (key, expiration)
+        pairs, unless it is later already
+        """
+
+    @abstractmethod
+    def delete_sessions(self, keys):
+        """Delete the sessions of a list of keys"""
+
+    @abstractmethod
+    def sessions(self, userid=None, expired_before=None):
+        """Return a list of (username, key, expiration) tuples for the
+        sessions of userid (of everybody if None), and only those expiring
+        before expired_before if given
+        """
+
+    @abstractmethod
+    def kill_sessions(self, userid=None, expired_before=None):
+        """Delete the sessions sessions() would return, and return how many"""
+
+    @abstractmethod
+    def delete_expired(self, now, limit):
+        """Delete up to limit sessions expired at now, and return how many"""
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(Backend):
+    """Users and sessions kept in dictionaries, indexed by username, email,
+    session key and userid. Nothing survives the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users = {}  # userid: user row
+        self._by_username = {}
+        self._by_email = {}
+        self._order = []  # sorted (username, userid)
+        self._sessions = {}  # key: [userid, expiration, extra_data]
+        self._user_sessions = {}  # userid: set of keys
+        self._next_userid = 1
+
+    def insert_user(self, username, email, salt, kpasswd, hasher, admin, extra_data):
+        with self._lock:
+            if username in self._by_username:
+                raise DuplicateError("username")
+            if email is not None and email in self._by_email:
+                raise DuplicateError("email")
+            userid = self._next_userid
+            self._next_userid += 1
+            row = (userid, username, email, salt, kpasswd, hasher, admin, extra_data)
+            self._users[userid] = row
+            self._index(row)
+            return userid
+
+    def get_user(self, field, value):
+        with self._lock:
+            if field == "userid":
+                return self._users.get(value)
+            index = self._by_username if field == "username" else self._by_email
+            userid = index.get(value)
+            return None if userid is None else self._users[userid]
+
+    def update_user(self, userid, **fields):
+        with self._lock:
+            row = self._users.get(userid)
+            if row is None:
+                return False
+            old = dict(zip(USER_FIELDS, row[1:]))
+            new = dict(old, **fields)
+            if new["username"] != old["username"]:
+                if new["username"] in self._by_username:
+                    raise DuplicateError("username")
+            if new["email"] != old["email"] and new["email"] is not None:
+                if new["email"] in self._by_email:
+                    raise DuplicateError("email")
+            self._unindex(row)
+            row = (userid,) + tuple(new[field] for field in USER_FIELDS)
+            self._users[userid] = row
+            self._index(row)
+            return True
+
+    def _index(self, row):
+        userid, username, email = row[:3]
+        self._by_username[username] = userid
+        if email is not None:
+            self._by_email[email] = userid
+        insort(self._order, (username, userid))
+
+    def _unindex(self, row):
+        userid, username, email = row[:3]
+        del self._by_username[username]
+        if email is not None:
+            del self._by_email[email]
+        del self._order[bisect_left(self._order, (username, userid))]
+
+    def delete_user(self, field, value):
+        with self._lock:
+            row = self.get_user(field, value)
+            if row is None:
+                return None
+            userid = row[0]
+            self._unindex(row)
+            del self._users[userid]
+            for key in self._user_sessions.pop(userid, ()):
+                del self._sessions[key]
+            return userid
+
+    def _matching(self, after, admins_only, username_prefix, email_prefix):
+        """Yield the (userid, username, email, admin) of the users matching,
+        in order
+        """
+        order = self._order
+        start = 0 if after is None else bisect_right(order, tuple(after))
+        if username_prefix:
+            start = max(start, bisect_left(order, (username_prefix,)))
+        for index in range(start, len(order)):
+            username, userid = order[index]
+            if username_prefix and not username.startswith(username_prefix):
+                break  # past the usernames with the prefix
+            row = self._users[userid]
+            if admins_only and not row[6]:
+                continue
+            if email_prefix and not (row[2] or "").startswith(email_prefix):
+                continue
+            yield (userid, username, row[2], row[6])
+
+    def users(
+        self,
+        after=None,
+        limit=None,
+        admins_only=False,
+        username_prefix=None,
+        email_prefix=None,
+    ):
+        with self._lock:
+            return list(
+                islice(
+                    self._matching(after, admins_only, username_prefix, email_prefix),
+                    limit,
+                )
+            )
+
+    def count_users(self, admins_only=False, username_prefix=None, email_prefix=None):
+        with self._lock:
+            return sum(
+                1
+                for user in self._matching(
+                    None, admins_only, username_prefix, email_prefix
+                )
+            )
+
+    def insert_session(self, userid, key, expiration, extra_data):
+        with self._lock:
+            self._sessions[key] = [userid, expiration, extra_data]
+            self._user_sessions.setdefault(userid, set()).add(key)
+
+    def get_sessions(self, keys):
+        with self._lock:
+            rows = []
+            for key in keys:
+                session = self._sessions.get(key)
+                if session is not None:
+                    userid, expiration, extra_data = session
+                    username = self._users[userid][1]
+                    rows.append((userid, key, expiration, extra_data, username))
+            return rows
+
+    def renew_sessions(self, renewals):
+        with self._lock:
+            for key, expiration in renewals:
+                session = self._sessions.get(key)
+                if session is not None and session[1] < expiration:
+                    session[1] = expiration
+
+    def delete_sessions(self, keys):
+        with self._lock:
+            for key in keys:
+                session = self._sessions.pop(key, None)
+                if session is not None:
+                    self._user_sessions[session[0]].discard(key)
+
+    def _select(self, userid, expired_before):
+        if userid is None:
+            keys = list(self._sessions)
+        else:
+            keys = list(self._user_sessions.get(userid, ()))
+        return [
+            key
+            for key in keys
+            if expired_before is None or self._sessions[key][1] < expired_before
+        ]
+
+    def sessions(self, userid=None, expired_before=None):
+        with self._lock:
+            return [
+                (self._users[self._sessions[key][0]][1], key, self._sessions[key][1])
+                for key in self._select(userid, expired_before)
+            ]
+
+    def kill_sessions(self, userid=None, expired_before=None):
+        with self._lock:
+            keys = self._select(userid, expired_before)
+            self.delete_sessions(keys)
+            return len(keys)
+
+    def delete_expired(self, now, limit):
+        with self._lock:
+            keys = []
+            for key, (userid, expiration, extra_data) in self._sessions.items():
+                if expiration < now:
+                    keys.append(key)
+                    if len(keys) >= limit:
+                        break
+            self.delete_sessions(keys)
+            return len(keys)
+
+
+class SQLiteBackend(Backend):
+    """Users and sessions kept in an SQLite database.
+    @param path     The database file, created if needed, or ":memory:".
+
+    The connection is shared by the threads, one statement at a time.
+    """
+
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self.db:
+            self.db.executescript(
+                """create table if not exists users (
+                    userid      integer primary key autoincrement,
+                    username    text not null unique,
+                    email       text unique,
+                    salt        text,
+                    kpasswd     text,
+                    hasher      text,
+                    admin       boolean not null default 0,
+                    extra_data  blob);
+                create index if not exists users_order_idx on users (username, userid);
+                create table if not exists sessions (
+                    key         text primary key,
+                    userid      integer not null,
+                    expiration  real not null,
+                    extra_data  blob);
+                create index if not exists sessions_userid_idx on sessions (userid);
+                create index if not exists sessions_expiration_idx
+                    on sessions (expiration);"""
+            )
+
+    def _query(self, sql, args=()):
+        with self._lock, self.db:
+            return self.db.execute(sql, args).fetchall()
+
+    def _modify(self, sql, args=()):
+        with self._lock, self.db:
+            return self.db.execute(sql, args).rowcount
+
+    def insert_user(self, username, email, salt, kpasswd, hasher, admin, extra_data):
+        try:
+            with self._lock, self.db:
+                return self.db.execute(
+                    "insert into users (username, email, salt, kpasswd, hasher, "
+                    "admin, extra_data) values (?, ?, ?, ?, ?, ?, ?)",
+                    (username, email, salt, kpasswd, hasher, admin, extra_data),
+                ).lastrowid
+        except sqlite3.IntegrityError as err:
+            raise DuplicateError(_duplicate_field(err))
+
+    def get_user(self, field, value):
+        rows = self._query(
+            "select userid, username, email, salt, kpasswd, hasher, admin, "
+            f"extra_data from users where {field} = ?",
+            (value,),
+        )
+        return _sqlite_user(rows[0]) if rows else None
+
+    def update_user(self, userid, **fields):
+        if not fields:
+            return bool(self.get_user("userid", userid))
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        try:
+            count = self._modify(
+                f"update users set {assignments} where userid = ?",
+                tuple(fields.values()) + (userid,),
+            )
+        except sqlite3.IntegrityError as err:
+            raise DuplicateError(_duplicate_field(err))
+        return count > 0
+
+    def delete_user(self, field, value):
+        with self._lock, self.db:
+            row = self.db.execute(
+                f"select userid from users where {field} = ?", (value,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute("delete from users where userid = ?", row)
+            self.db.execute("delete from sessions where userid = ?", row)
+            return row[0]
+
+    def _where(self, admins_only, username_prefix, email_prefix):
+        conds = []
+        args = []
+        if admins_only:
+            conds.append("admin")
+        for field, prefix in (("username", username_prefix), ("email", email_prefix)):
+            if prefix:
+                conds.append(f"substr({field}, 1, ?) = ?")
+                args.extend((len(prefix), prefix))
+        return conds, args
+
+    def users(
+        self,
+        after=None,
+        limit=None,
+        admins_only=False,
+        username_prefix=None,
+        email_prefix=None,
+    ):
+        conds, args = self._where(admins_only, username_prefix, email_prefix)
+        if after is not None:
+            conds.append("(username > ? or (username = ? and userid > ?))")
+            args.extend((after[0], after[0], after[1]))
+        sql = "select userid, username, email, admin from users"
+        if conds:
+            sql += " where " + " and ".join(conds)
+        sql += " order by username, userid"
+        if limit is not None:
+            sql += " limit ?"
+            args.append(limit)
+        return [
+            (userid, username, email, bool(admin))
+            for userid, username, email, admin in self._query(sql, args)
+        ]
+
+    def count_users(self, admins_only=False, username_prefix=None, email_prefix=None):
+        conds, args = self._where(admins_only, username_prefix, email_prefix)
+        sql = "select count(*) from users"
+        if conds:
+            sql += " where " + " and ".join(conds)
+        return self._query(sql, args)[0][0]
+
+    def insert_session(self, userid, key, expiration, extra_data):
+        self._modify(
+            "insert into sessions (userid, key, expiration, extra_data) "
+            "values (?, ?, ?, ?)",
+            (userid, key, expiration, extra_data),
+        )
+
+    def get_sessions(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        return self._query(
+            "select s.userid, s.key, s.expiration, s.extra_data, u.username "
+            "from sessions s inner join users u on (s.userid = u.userid) "
+            f"where s.key in ({', '.join('?' * len(keys))})",
+            keys,
+        )
+
+    def renew_sessions(self, renewals):
+        with self._lock, self.db:
+            self.db.executemany(
+                "update sessions set expiration = ? "
+                "where key = ? and expiration < ?",
+                [(expiration, key, expiration) for key, expiration in renewals],
+            )
+
+    def delete_sessions(self, keys):
+        with self._lock, self.db:
+            self.db.executemany(
+                "delete from sessions where key = ?", [(key,) for key in keys]
+            )
+
+    def _session_filter(self, userid, expired_before):
+        conds = []
+        args = []
+        if userid is not None:
+            conds.append("s.userid = ?")
+            args.append(userid)
+        if expired_before is not None:
+            conds.append("s.expiration < ?")
+            args.append(expired_before)
+        return (" where " + " and ".join(conds)) if conds else "", args
+
+    def sessions(self, userid=None, expired_before=None):
+        where, args = self._session_filter(userid, expired_before)
+        return self._query(
+            "select u.username, s.key, s.expiration from sessions s "
+            "inner join users u on (s.userid = u.userid)" + where,
+            args,
+        )
+
+    def kill_sessions(self, userid=None, expired_before=None):
+        where, args = self._session_filter(userid, expired_before)
+        return self._modify("delete from sessions as s" + where, args)
+
+    def delete_expired(self, now, limit):
+        return self._modify(
+            "delete from sessions where key in "
+            "(select key from sessions where expiration < ? limit ?)",
+            (now, limit),
+        )
+
+    def close(self):
+        self.db.close()
+
+
+def _sqlite_user(row):
+    return row[:6] + (bool(row[6]), row[7])
+
+
+def _duplicate_field(err):
+    """The field of the unique constraint an sqlite3.IntegrityError is about"""
+    return "email" if "users.email" in str(err) else "username"
@@ -0,0 +1,186 @@
+import threading
+from collections import OrderedDict
+
+# take a token from a bucket in the login_throttle table, refilling it first;
+# returns no row if the bucket holds less than one token
+TAKE_TOKEN_SQL = (
+    "insert into login_throttle as t (key, tokens, updated) "
+    "values (%(key)s, %(burst)s - 1, %(now)s) "
+    "on conflict (key) do update set "
+    "tokens = least(%(burst)s, t.tokens + (%(now)s - t.updated) * %(rate)s) - 1, "
+    "updated = %(now)s "
+    "where least(%(burst)s, t.tokens + (%(now)s - t.updated) * %(rate)s) >= 1 "
+    "returning tokens"
+)
+GIVE_TOKEN_SQL = (
+    "update login_throttle set "
+    "tokens = least(%(burst)s, tokens + (%(now)s - updated) * %(rate)s + 1), "
+    "updated = %(now)s where key = %(key)s"
+)
+
+
+class LoginThrottle:
+    """Token buckets limiting the login attempts per username and per client.
+
+    Each username, and each client key (an IP address, say) if given, has a
+    bucket of up to ``burst`` tokens that refills at ``rate`` tokens per
+    second. An attempt takes a token from each of its buckets and is refused
+    if one of them is empty. A successful login gives its tokens back, so
+    that only the failures count.
+
+    The buckets are kept in memory, up to ``max_size`` of them, the least
+    recently used being evicted first. Forgetting a bucket only makes it
+    full again.
+    """
+
+    def __init__(
+        self, rate, burst=10, client_rate=None, client_burst=None, max_size=100000
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.client_rate = client_rate
+        self.client_burst = burst if client_burst is None else client_burst
+        self.max_size = max_size
+        self._buckets = OrderedDict()  # key: (tokens, updated)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.throttled = 0
+        self.evictions = 0
+
+    def limits(self, username, client=None, scope=None):
+        """Return the (key, rate, burst) of the buckets of an attempt. scope
+        keeps apart the users of different tenants.
+        """
+        prefix = f"{scope}." if scope else ""
+        limits = []
+        if self.rate is not None:
+            limits.append((f"{prefix}user:{username}", self.rate, self.burst))
+        if client is not None and self.client_rate is not None:
+            limits.append(
+                (f"{prefix}client:{client}", self.client_rate, self.client_burst)
+            )
+        return limits
+
+    def acquire(self, limits, now):
+        """Take a token from each bucket in limits.
+        @return False, taking none, if a bucket is empty.
+        """
+        allowed = self._take(limits, now)
+        with self._lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.throttled += 1
+        return allowed
+
+    def release(self, limits, now):
+        """Give back the tokens taken by acquire()"""
+        with self._lock:
+            for key, rate, burst in limits:
+                entry = self._buckets.get(key)
+                if entry is not None:
+                    tokens = _refill(entry, rate, burst, now)
+                    self._buckets[key] = (min(burst, tokens + 1), now)
+
+    def _take(self, limits, now):
+        with self._lock:
+            levels = [
+                _refill(self._buckets.get(key), rate, burst, now)
+                for key, rate, burst in limits
+            ]
+            if any(tokens < 1 for tokens in levels):
+                return False
+            for (key, rate, burst), tokens in zip(limits, levels):
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        """Return a dictionary with the number of buckets and the counters"""
+        with self._lock:
+            return {
+                "size": len(self._buckets),
+                "max_size": self.max_size,
+                "allowed": self.allowed,
+                "throttled": self.throttled,
+                "evictions": self.evictions,
+            }
+
+
+class SharedLoginThrottle(LoginThrottle):
+    """LoginThrottle keeping its buckets in the login_throttle table, so that
+    the limits hold across all the processes using the database.
+
+    ``cursor_func()`` must return a context manager giving a cursor, as
+    UserSpace._cursor() does. Each attempt then costs one short transaction
+    instead of a password hash. The buckets left untouched long enough to
+    be full again are deleted every ``purge_interval`` seconds.
+    """
+
+    def __init__(self, cursor_func, rate, purge_interval=60.0, **kwargs):
+        super().__init__(rate, **kwargs)
+        self.cursor_func = cursor_func
+        self.purge_interval = purge_interval
+        self.purged_at = None
+
+    def _take(self, limits, now):
+        with self.cursor_func() as cr:
+            for key, rate, burst in limits:
+                cr.execute(
+                    TAKE_TOKEN_SQL, dict(key=key, rate=rate, burst=burst, now=now)
+                )
+                if cr.fetchone() is None:
+                    cr.connection.rollback()
+                    return False
+            cr.connection.commit()
+            if self.purged_at is None or now - self.purged_at > self.purge_interval:
+                self.purged_at = now
+                self.purge(cr, now)
+        return True
+
+    def release(self, limits, now):
+        with self.cursor_func() as cr:
+            for key, rate, burst in limits:
+                cr.execute(
+                    GIVE_TOKEN_SQL, dict(key=key, rate=rate, burst=burst, now=now)
+                )
+            cr.connection.commit()
+
+    def purge(self, cr, now):
+        """Delete the buckets that have had time to fill up again"""
+        buckets = ((self.rate, self.burst), (self.client_rate, self.client_burst))
+        refills = [burst / rate for rate, burst in buckets if rate]
+        if refills:
+            cr.execute(
+                "delete from login_throttle where updated < %s",
+                (now - max(refills),),
+            )
+            cr.connection.commit()
+
+    def clear(self):
+        with self.cursor_func() as cr:
+            cr.execute("delete from login_throttle")
+            cr.connection.commit()
+
+    def stats(self):
+        stats = super().stats()
+        with self.cursor_func() as cr:
+            cr.execute("select count(*) from login_throttle")
+            stats["size"] = cr.fetchone()[0]
+            cr.connection.commit()
+        return stats
+
+
+def _refill(entry, rate, burst, now):
+    """Tokens in a bucket given its (tokens, updated) entry, None if new"""
+    if entry is None:
+        return burst
+    tokens, updated = entry
+    return min(burst, tokens + (now - updated) * rate)
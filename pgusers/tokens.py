@@ -0,0 +1,160 @@
+"""Signed session tokens, verified without querying the database.
+
+A token is the base64url encoded JSON payload and its HMAC-SHA256
+signature, separated by a dot. The payload holds the userid, username,
+admin flag, issue and expiration times, a random token id (jti) and the
+session's extra_data.
+
+Tokens cannot be deleted like session rows, so killing them is done by
+recording revocations in the database: of one token by its id, of the
+tokens of a user issued before a given time, or of every token issued
+before a given time. Each process keeps the revocations in memory and
+reads the new ones every few seconds.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import threading
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def is_token(key):
+    """Whether key is a token rather than a session key"""
+    return isinstance(key, str) and "." in key
+
+
+class TokenSigner:
+    """Issues and verifies signed tokens.
+
+    Tokens are signed with the first secret and verified with any of
+    them, so that the secret can be changed without invalidating the
+    tokens already issued: put the new secret first and drop the old one
+    once a TTL has gone by.
+    """
+
+    def __init__(self, secret, *old_secrets):
+        self.secrets = [
+            s.encode("utf-8") if isinstance(s, str) else s
+            for s in (secret,) + old_secrets
+        ]
+
+    def _signature(self, body, secret):
+        return hmac.new(secret, body.encode("ascii"), hashlib.sha256).digest()
+
+    def issue(self, userid, username, admin, issued, expiration, extra_data=None):
+        """Return a token for the session. Raises TypeError if extra_data
+        cannot be encoded as JSON.
+        """
+        payload = {
+            "uid": userid,
+            "usr": username,
+            "adm": bool(admin),
+            "iat": issued,
+            "exp": expiration,
+            "jti": os.urandom(12).hex(),
+            "xtr": extra_data,
+        }
+        body = _b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        return body + "." + _b64encode(self._signature(body, self.secrets[0]))
+
+    def verify(self, token):
+        """Return the payload of token, None if it is not correctly signed"""
+        body, sep, signature = token.partition(".")
+        try:
+            signature = _b64decode(signature)
+            if not any(
+                hmac.compare_digest(signature, self._signature(body, secret))
+                for secret in self.secrets
+            ):
+                return None
+            return json.loads(_b64decode(body))
+        except (ValueError, binascii.Error):
+            return None
+
+
+class RevocationList:
+    """In-memory copy of the revocations recorded in the database.
+
+    ``load_func(since)`` must return the revocations made since the given
+    time, as (userid, jti, issued_before, expiration) tuples, userid being
+    None for revocations affecting every user. The new revocations are
+    read once the copy is more than ``max_age`` seconds old, which bounds
+    how long a revoked token is still accepted by other processes. Each
+    read goes back ``overlap`` seconds before the previous one, to allow
+    for transactions committed late and for clocks slightly apart.
+    """
+
+    def __init__(self, load_func, max_age=5.0, overlap=60.0):
+        self.load_func = load_func
+        self.max_age = max_age
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self.refreshed_at = None
+        self.everyone = (0.0, 0.0)  # (issued_before, expiration)
+        self.users = {}  # userid: (issued_before, expiration)
+        self.tokens = {}  # jti: expiration
+
+    def add(self, userid, jti, issued_before, expiration):
+        with self._lock:
+            self._add(userid, jti, issued_before, expiration)
+
+    def _add(self, userid, jti, issued_before, expiration):
+        if jti is not None:
+            self.tokens[jti] = expiration
+        elif userid is None:
+            self.everyone = max(self.everyone, (issued_before, expiration))
+        else:
+            self.users[userid] = max(
+                self.users.get(userid, (0.0, 0.0)), (issued_before, expiration)
+            )
+
+    def refresh(self, now):
+        """Read the new revocations and forget the ones no longer needed"""
+        with self._lock:
+            since = 0.0
+            if self.refreshed_at is not None:
+                since = self.refreshed_at - self.overlap
+            for row in self.load_func(since):
+                self._add(*row)
+            self.tokens = {
+                jti: expiration
+                for jti, expiration in self.tokens.items()
+                if expiration >= now
+            }
+            self.users = {
+                userid: revoked
+                for userid, revoked in self.users.items()
+                if revoked[1] >= now
+            }
+            self.refreshed_at = now
+
+    def is_revoked(self, payload, now):
+        if self.refreshed_at is None or now - self.refreshed_at > self.max_age:
+            self.refresh(now)
+        with self._lock:
+            issued = payload["iat"]
+            if issued < self.everyone[0]:
+                return True
+            if issued < self.users.get(payload["uid"], (0.0, 0.0))[0]:
+                return True
+            return payload["jti"] in self.tokens
+
+    def stats(self):
+        """Return a dictionary with the number of revocations held"""
+        with self._lock:
+            return {
+                "refreshed_at": self.refreshed_at,
+                "users": len(self.users),
+                "tokens": len(self.tokens),
+            }
@@ -0,0 +1,111 @@
+import threading
+
+
+class TouchQueue:
+    """Session expirations waiting to be written to the database.
+
+    check_key() queues the new expiration of a session here instead of
+    updating it right away. The queued expirations are handed to
+    ``write_func`` as a list of (key, expiration) pairs, sorted by key,
+    every ``interval`` seconds by a background thread, or as soon as
+    ``max_pending`` sessions are waiting. With no interval there is no
+    background thread and the batch is written by the thread that fills
+    the queue.
+    """
+
+    def __init__(self, write_func, interval=1.0, max_pending=1000):
+        self.write_func = write_func
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+
+    def start(self):
+        if self.interval and self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="pgusers-touch-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and write whatever is still queued"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def touch(self, key, expiration):
+        with self._lock:
+            if expiration > self._pending.get(key, 0.0):
+                self._pending[key] = expiration
+            full = len(self._pending) >= self.max_pending
+        if full:
+            if self._thread is not None:
+                self._wakeup.set()
+            else:
+                self.flush()
+
+    def pending(self, key):
+        """Return the queued expiration for key, None if there is none"""
+        with self._lock:
+            return self._pending.get(key)
+
+    def discard(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write the queued expirations. Returns the number of sessions written.
+
+        If writing fails, the batch is queued again and the exception raised.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                self.write_func(sorted(batch.items()))
+            except Exception:
+                with self._lock:
+                    for key, expiration in batch.items():
+                        if expiration > self._pending.get(key, 0.0):
+                            self._pending[key] = expiration
+                    self.errors += 1
+                raise
+            self.flushes += 1
+            self.written += len(batch)
+            return len(batch)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # counted in errors, retried on the next round
+
+    def stats(self):
+        """Return a dictionary with the queue length and counters"""
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "flushes": self.flushes,
+                "written": self.written,
+                "errors": self.errors,
+            }
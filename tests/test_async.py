@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+import unittest
+import time
+from unittest.mock import MagicMock
+
+import pgusers as users
+
+DBNAME = "pytestdb"
+
+
+@unittest.skipIf(users.AsyncUserSpace is None, "psycopg 3 not installed")
+class AsyncTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.us = await users.AsyncUserSpace(DBNAME, max_size=4).open()
+
+    async def asyncTearDown(self):
+        async with self.us.pool.connection() as conn:
+            await conn.execute("drop table if exists users")
+            await conn.execute("drop table if exists sessions")
+        await self.us.close()
+
+    async def test_create_and_find_user(self):
+        "Can create a user and find it"
+        userid = await self.us.create_user(
+            "user1", "pass1", "user1@abc.de", extra_data={"data1": 543}
+        )
+        udata = await self.us.find_user(email="user1@abc.de")
+        self.assertEqual(udata["userid"], userid)
+        self.assertEqual(udata["username"], "user1")
+        self.assertEqual(udata["extra_data"], {"data1": 543})
+        self.assertIsNone(await self.us.find_user(userid=userid + 1))
+
+    async def test_json_extra_data(self):
+        "extra_data stored as JSON can be searched"
+        self.us.json_extra = True
+        userid = await self.us.create_user(
+            "user5", "pass5", "user5@abc.de", extra_data={"plan": "pro"}
+        )
+        await self.us.create_user("user6", "pass6", "user6@abc.de")
+        [udata] = await self.us.find_users_by_extra(plan="pro")
+        self.assertEqual(userid, udata["userid"])
+        self.assertEqual({"plan": "pro"}, udata["extra_data"])
+        key, admin, uid = await self.us.validate_user("user5", "pass5", {"n": 5})
+        self.assertEqual(
+            (users.OK, "user5", uid, {"n": 5}), await self.us.check_key(key)
+        )
+
+    async def test_duplicate_user_gives_exception(self):
+        "Exception trying to create existing user"
+        await self.us.create_user("user2", "pass2", "user2@abc.de")
+        with self.assertRaises(users.BadCallError):
+            await self.us.create_user("user2", "pass3", "user2@fgh.ij")
+
+    async def test_validate_and_check_key(self):
+        "A validated user gets a session that can be checked"
+        userid = await self.us.create_user("user3", "pass3", "user3@abc.de")
+        key, admin, uid = await self.us.validate_user("user3", "pass3", {"ip": "::1"})
+        self.assertTrue(key)
+        self.assertEqual(uid, userid)
+        rc, uname, uid, xtra = await self.us.check_key(key)
+        self.assertEqual(rc, users.OK)
+        self.assertEqual(uname, "user3")
+        self.assertEqual(xtra, {"ip": "::1"})
+
+        key, admin, uid = await self.us.validate_user("user3", "badpass")
+        self.assertFalse(key)
+        self.assertEqual(
+            (users.NOT_FOUND, None, None, None), await self.us.check_key("x")
+        )
+
+    async def test_session_expires(self):
+        "Sessions expire after their time to live"
+        await self.us.create_user("user4", "pass4", "user4@abc.de")
+        time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        key, admin, uid = await self.us.validate_user("user4", "pass4")
+        time.time.return_value = 200.0 + self.us.ttl + 60.0
+        rc, uname, uid, xtra = await self.us.check_key(key)
+        time.time = time_time
+        self.assertEqual(rc, users.EXPIRED)
+
+    async def test_change_password(self):
+        "Password changes are checked against the old password"
+        uid = await self.us.create_user("user5", "pass5", "user5@abc.de")
+        self.assertEqual(
+            users.REJECTED, await self.us.change_password(uid, "new5", "bad5")
+        )
+        self.assertEqual(users.OK, await self.us.change_password(uid, "new5", "pass5"))
+        key, admin, uid = await self.us.validate_user("user5", "new5")
+        self.assertTrue(key)
+
+    async def test_list_and_kill_sessions(self):
+        "Sessions can be listed and killed"
+        u6 = await self.us.create_user("user6", "pass6", "user6@abc.de")
+        await self.us.create_user("user7", "pass7", "user7@abc.de")
+        await self.us.validate_user("user6", "pass6")
+        await self.us.validate_user("user7", "pass7")
+        self.assertEqual(2, len([s async for s in self.us.list_sessions(0)]))
+        await self.us.kill_sessions(u6)
+        sessions = [s async for s in self.us.list_sessions(0)]
+        self.assertEqual(["user7"], [s[0] for s in sessions])
+        users_list = [u async for u in self.us.all_users()]
+        self.assertEqual(["user6", "user7"], [u[1] for u in users_list])
+
+
+if __name__ == "__main__":
+    unittest.main()
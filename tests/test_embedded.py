@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import pgusers as users
+
+
+class EmbeddedTests:
+    """Tests run on each backend"""
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.us = users.EmbeddedUserSpace(
+            self.make_backend(), hasher=users.PBKDF2Hasher(1000)
+        )
+        self.time_time = time.time
+
+    def tearDown(self):
+        time.time = self.time_time
+        self.us.close()
+
+    def test_users(self):
+        "Users can be created, found, modified and deleted"
+        uid = self.us.create_user("user1", "pass1", "user1@emb.net", extra_data=[1])
+        self.assertEqual(
+            {
+                "userid": uid,
+                "username": "user1",
+                "email": "user1@emb.net",
+                "admin": False,
+                "extra_data": [1],
+            },
+            self.us.find_user(email="user1@emb.net"),
+        )
+        self.assertRaises(
+            users.BadCallError, self.us.create_user, "user1", "pass", "other@emb.net"
+        )
+        self.assertRaises(
+            users.BadCallError, self.us.create_user, "user2", "pass", "user1@emb.net"
+        )
+        self.assertEqual(users.OK, self.us.modify_user(uid, username="user3"))
+        self.assertIsNone(self.us.find_user(username="user1"))
+        self.assertEqual(uid, self.us.find_user(username="user3")["userid"])
+        self.assertEqual(users.NOT_FOUND, self.us.modify_user(uid + 1, email="x"))
+        self.us.set_admin(uid)
+        self.assertTrue(self.us.is_admin(uid))
+        self.assertRaises(users.BadCallError, self.us.is_admin, uid + 1)
+        self.assertRaises(users.BadCallError, self.us.find_user)
+        self.assertEqual(users.OK, self.us.delete_user(userid=uid))
+        self.assertEqual(users.NOT_FOUND, self.us.delete_user(username="user3"))
+
+    def test_passwords(self):
+        "Users log in with their password, which can be changed"
+        uid = self.us.create_user("user4", "pass4", "user4@emb.net")
+        self.assertEqual(("", False, None), self.us.validate_user("user4", "bad"))
+        self.assertEqual(("", False, None), self.us.validate_user("nobody", "pass4"))
+        key, admin, userid = self.us.validate_user("user4", "pass4")
+        self.assertEqual(32, len(key))
+        self.assertEqual(uid, userid)
+        self.assertEqual(users.REJECTED, self.us.change_password(uid, "new", "bad"))
+        self.assertEqual(users.OK, self.us.change_password(uid, "new", "pass4"))
+        self.assertEqual(uid, self.us.validate_user("user4", "new")[2])
+        self.assertEqual(users.NOT_FOUND, self.us.change_password(uid + 1, "new"))
+
+    def test_rehash_on_login(self):
+        "Passwords are re-hashed with the current hasher on login"
+        uid = self.us.create_user("user4", "pass4", "user4@emb.net")
+        self.us.hasher = users.PBKDF2Hasher(2000)
+        self.assertEqual(uid, self.us.validate_user("user4", "pass4")[2])
+        self.assertEqual(
+            "pbkdf2$sha512$2000", self.us.backend.get_user("userid", uid)[5]
+        )
+        self.assertEqual(uid, self.us.validate_user("user4", "pass4")[2])
+
+    def test_sessions(self):
+        "Sessions are renewed, expire, and carry their extra_data"
+        self.us.create_user("user5", "pass5", "user5@emb.net")
+        uid = self.us.create_user("user6", "pass6", "user6@emb.net")
+        self.us.set_refresh_threshold(0.5)
+        time.time = MagicMock(return_value=200.0)
+        k5 = self.us.validate_user("user5", "pass5")[0]
+        time.time.return_value = 500.0
+        k6 = self.us.validate_user("user6", "pass6", {"ip": "10.0.0.1"})[0]
+        [(uname, key, expiration)] = self.us.list_sessions(uid)
+
+        time.time.return_value = 500.0 + self.us.ttl * 0.25
+        self.assertEqual(
+            (users.OK, "user6", uid, {"ip": "10.0.0.1"}), self.us.check_key(k6)
+        )
+        self.assertEqual([("user6", k6, expiration)], list(self.us.list_sessions(uid)))
+        self.assertEqual(2, len(list(self.us.list_sessions(0))))
+
+        time.time.return_value = 200.0 + self.us.ttl + 60.0
+        self.assertEqual([k5], [s[1] for s in self.us.list_sessions(0, expired=True)])
+        self.assertEqual(
+            {
+                k5: (users.EXPIRED, None, None, None),
+                k6: (users.OK, "user6", uid, {"ip": "10.0.0.1"}),
+                "nokey": (users.NOT_FOUND, None, None, None),
+            },
+            self.us.check_keys([k5, k6, "nokey"]),
+        )
+        [(uname, key, renewed)] = self.us.list_sessions(0)
+        self.assertGreater(renewed, expiration)
+        self.assertRaises(users.BadCallError, self.us.set_refresh_threshold, 2.0)
+
+    def test_kill_and_reap_sessions(self):
+        "Sessions are killed by user, by expiration, and reaped"
+        u7 = self.us.create_user("user7", "pass7", "user7@emb.net")
+        self.us.create_user("user8", "pass8", "user8@emb.net")
+        time.time = MagicMock(return_value=200.0)
+        for n in range(3):
+            self.us.validate_user("user7", "pass7")
+            self.us.validate_user("user8", "pass8")
+        time.time.return_value = 500.0
+        self.us.validate_user("user8", "pass8")
+
+        self.us.kill_sessions(u7)
+        self.assertEqual(["user8"] * 4, [s[0] for s in self.us.list_sessions(0)])
+        time.time.return_value = 200.0 + self.us.ttl + 60.0
+        self.assertEqual(2, self.us.reap_sessions(2, 0, max_batches=1))
+        self.us.kill_sessions(0, expired=True)
+        self.assertEqual(1, len(list(self.us.list_sessions(0))))
+        self.assertEqual(0, self.us.reap_sessions(2, 0))
+        self.us.delete_user(username="user8")
+        self.assertEqual([], list(self.us.list_sessions(0)))
+
+    def test_throttle(self):
+        "Failed logins over the limit are refused"
+        self.us = users.EmbeddedUserSpace(
+            self.make_backend(), hasher=users.PBKDF2Hasher(1000), login_rate=1e-6
+        )
+        self.us.create_user("user10", "pass10", "user10@emb.net")
+        for n in range(10):
+            self.us.validate_user("user10", "bad")
+        self.assertEqual(("", False, None), self.us.validate_user("user10", "pass10"))
+        self.assertEqual(1, self.us.throttle.stats()["throttled"])
+        uid = self.us.create_user("user11", "pass11", "user11@emb.net")
+        self.assertEqual(uid, self.us.validate_user("user11", "pass11")[2])
+
+    def test_list_users(self):
+        "Users are listed in pages, in username order, with filters"
+        created, failures = self.us.create_users(
+            [
+                (f"user{n:02}", "pass", f"u{n % 3}x{n}@emb.net", n % 4 == 0)
+                for n in range(20)
+            ]
+            + [("user05", "pass", "dup@emb.net"), ("", "pass", "empty@emb.net")],
+            batch_size=7,
+        )
+        self.assertEqual(20, created)
+        self.assertEqual(
+            [(20, "user05", "username exists"), (21, "", "missing field")], failures
+        )
+        self.assertEqual(
+            [f"user{n:02}" for n in range(20)], [u[1] for u in self.us.all_users(6)]
+        )
+        page, after, total = self.us.list_users(limit=8, count=True)
+        self.assertEqual([f"user{n:02}" for n in range(8)], [u[1] for u in page])
+        self.assertEqual(20, total)
+        page, after, total = self.us.list_users(limit=8, after=after)
+        page, after, total = self.us.list_users(limit=8, after=after)
+        self.assertEqual([f"user{n:02}" for n in range(16, 20)], [u[1] for u in page])
+        self.assertIsNone(after)
+        page, after, total = self.us.list_users(after="user17")
+        self.assertEqual(["user18", "user19"], [u[1] for u in page])
+        self.assertRaises(users.BadCallError, self.us.list_users, limit=0)
+        page, after, total = self.us.list_users(
+            admins_only=True, username_prefix="user1", count=True
+        )
+        self.assertEqual(["user12", "user16"], [u[1] for u in page])
+        self.assertEqual(2, total)
+        page, after, total = self.us.list_users(email_prefix="u1x")
+        self.assertEqual(
+            [f"user{n:02}" for n in range(20) if n % 3 == 1], [u[1] for u in page]
+        )
+
+
+class MemoryBackendTests(EmbeddedTests, unittest.TestCase):
+    def make_backend(self):
+        return users.MemoryBackend()
+
+    def test_backend_is_abstract(self):
+        "A Backend must implement all its methods to be instantiated"
+        self.assertRaises(TypeError, users.Backend)
+
+        class PartialBackend(users.Backend):
+            def get_user(self, field, value):
+                return None
+
+        self.assertRaises(TypeError, PartialBackend)
+
+
+class SQLiteBackendTests(EmbeddedTests, unittest.TestCase):
+    def make_backend(self):
+        return users.SQLiteBackend()
+
+    def test_kept_in_file(self):
+        "The users and sessions are kept in the SQLite file"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "users.db")
+            us = users.EmbeddedUserSpace(
+                users.SQLiteBackend(path), hasher=users.PBKDF2Hasher(1000)
+            )
+            uid = us.create_user("user9", "pass9", "user9@emb.net")
+            key = us.validate_user("user9", "pass9")[0]
+            us.close()
+            us = users.EmbeddedUserSpace(users.SQLiteBackend(path))
+            self.assertEqual((users.OK, "user9", uid, None), us.check_key(key))
+            us.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,31 @@
 #! /usr/bin/env python3
 import unittest
 import time
+import threading
 from unittest.mock import MagicMock
 
+import psycopg2
+from psycopg2.pool import PoolError
+
 import pgusers as users
+from pgusers.migrations import schema_version, latest_version, migrate
+from pgusers.hashing import hash_time
+from pgusers.partitions import partitions
+from pgusers.extra import LazyJSON
+from pgusers.tokens import TokenSigner
+from pgusers.throttle import LoginThrottle, SharedLoginThrottle
 
 DBNAME = "pytestdb"
 
 
+def reopen(**kwargs):
+    """Open the test userspace afresh with the given settings"""
+    us = users.UserSpace.userspaces.get(DBNAME)
+    if us is not None:
+        us.close()
+    return users.UserSpace(DBNAME, **kwargs)
+
+
 class InitTests(unittest.TestCase):
 
     # def tearDown(self):
@@ -34,7 +52,7 @@ class InitTests(unittest.TestCase):
 
 class UserTests(unittest.TestCase):
     def setUp(self):
-        self.us = users.UserSpace(DBNAME)
+        self.us = reopen()
 
     def tearDown(self):
         csr = self.us.connector.cursor()
@@ -172,10 +190,113 @@ class UserTests(unittest.TestCase):
         for exp, retr in zip(expected, self.us.all_users()):
             self.assertEqual(exp, retr)
 
+    def test_all_users_streams(self):
+        "all_users() can be iterated while calling other methods"
+        for i in range(5):
+            self.us.create_user(f"user{i}", "pw", f"user{i}@stream.org")
+        self.us.set_itersize(2)
+        names = []
+        for uid, username, email, admin in self.us.all_users():
+            names.append(self.us.find_user(userid=uid)["username"])
+        self.us.set_itersize(2000)
+        self.assertEqual([f"user{i}" for i in range(5)], names)
+
+    def test_all_users_survives_failed_calls(self):
+        "A call failing while all_users() is iterated does not end the iteration"
+        for i in range(5):
+            self.us.create_user(f"user{i}", "pw", f"user{i}@stream.org")
+        self.us.set_itersize(2)
+        names = []
+        for uid, username, email, admin in self.us.all_users():
+            names.append(username)
+            with self.assertRaises(users.BadCallError):
+                self.us.create_user("user0", "pw", "user0@stream.org")
+        self.us.set_itersize(2000)
+        self.assertEqual([f"user{i}" for i in range(5)], names)
+
+    def test_list_users_pages(self):
+        "list_users() returns the users a page at a time"
+        for i in range(7):
+            self.us.create_user(f"user{i}", "pw", f"user{i}@page.org", i % 3 == 0)
+        rows, after, total = self.us.list_users(limit=3, count=True)
+        self.assertEqual(["user0", "user1", "user2"], [r[1] for r in rows])
+        self.assertIsInstance(total, int)
+        rows, after, total = self.us.list_users(limit=3, after=after)
+        self.assertEqual(["user3", "user4", "user5"], [r[1] for r in rows])
+        self.assertIsNone(total)
+        rows, after, total = self.us.list_users(limit=3, after=after)
+        self.assertEqual(["user6"], [r[1] for r in rows])
+        self.assertIsNone(after)
+        self.assertRaises(users.BadCallError, self.us.list_users, limit=0)
+
+    def test_list_users_filters(self):
+        "list_users() can list only admins or usernames and emails by prefix"
+        for i, name in enumerate(["al_1", "alice", "bob", "albert", "carol"]):
+            self.us.create_user(name, "pw", f"{name}@{i}.org", name.startswith("a"))
+        rows, after, total = self.us.list_users(admins_only=True, after="albert")
+        self.assertEqual(["alice"], [r[1] for r in rows])
+        rows, after, total = self.us.list_users(username_prefix="al_")
+        self.assertEqual(["al_1"], [r[1] for r in rows])
+        rows, after, total = self.us.list_users(email_prefix="bob@")
+        self.assertEqual(["bob"], [r[1] for r in rows])
+
     def test_all_users_on_empty_db(self):
         "all_users() on empty db returns no users"
         self.assertEqual([], list(self.us.all_users()))
 
+    def test_create_users(self):
+        "Users can be created in bulk"
+        self.us.create_user("bob", "bobpass", "bob@bebop.com")
+        created, failures = self.us.create_users(
+            [
+                {"username": "alice", "password": "pw1", "email": "alice@wl.com"},
+                ("bob", "pw2", "bob2@bebop.com"),
+                ("carol", "pw3", "carol@xmas.com", True, {"age": 33}),
+                ("dave", "pw4", "alice@wl.com"),
+                ("", "pw5", "nobody@void.com"),
+                ("carol", "pw6", "carol2@xmas.com"),
+            ],
+            batch_size=4,
+        )
+        self.assertEqual(2, created)
+        self.assertEqual(
+            [
+                (1, "bob", "username exists"),
+                (3, "dave", "email exists"),
+                (4, "", "missing field"),
+                (5, "carol", "username exists"),
+            ],
+            failures,
+        )
+        carol = self.us.find_user(username="carol")
+        self.assertTrue(carol["admin"])
+        self.assertEqual({"age": 33}, carol["extra_data"])
+        self.assertEqual(carol["userid"], self.us.validate_user("carol", "pw3")[2])
+
+    def test_create_users_invalid_rows(self):
+        "Users that don't fit the table are reported without stopping the rest"
+        created, failures = self.us.create_users(
+            [
+                ("ok1", "pw1", "ok1@wl.com"),
+                ("x" * 25, "pw2", "long@wl.com"),
+                ("ok2", "pw3", "e" * 130),
+                ("ok3", 1234, "ok3@wl.com"),
+                ("ok\x004", "pw5", "ok4@wl.com"),
+                ("ok5", "pw6", "ok5@wl.com"),
+            ]
+        )
+        self.assertEqual(2, created)
+        self.assertEqual(
+            [
+                (1, "x" * 25, "invalid username"),
+                (2, "ok2", "invalid email"),
+                (3, "ok3", "invalid password"),
+                (4, "ok\x004", "invalid username"),
+            ],
+            failures,
+        )
+        self.assertEqual(["ok1", "ok5"], [user[1] for user in self.us.all_users()])
+
     def test_retrieve_admin_user(self):
         "an admin user is retrieved"
         uid = self.us.create_user("user1", "pw1", "user@somewhere.com", True)
@@ -202,7 +323,7 @@ class UserTests(unittest.TestCase):
 
 class PasswordTests(unittest.TestCase):
     def setUp(self):
-        self.us = users.UserSpace(DBNAME)
+        self.us = reopen()
 
     def tearDown(self):
         csr = self.us.connector.cursor()
@@ -266,7 +387,7 @@ class PasswordTests(unittest.TestCase):
 
 class SessionTests(unittest.TestCase):
     def setUp(self):
-        self.us = users.UserSpace(DBNAME)
+        self.us = reopen()
 
     def tearDown(self):
         csr = self.us.connector.cursor()
@@ -301,6 +422,32 @@ class SessionTests(unittest.TestCase):
 
         time.time = time_time
 
+    def test_session_refresh_threshold(self):
+        "Sessions are only renewed when below the refresh threshold"
+        self.us.create_user("user10", "pass10", "user10@suchandsu.ch")
+        self.us.set_refresh_threshold(0.5)
+        time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        seskey, admin, userid = self.us.validate_user("user10", "pass10")
+        [(uname, key, expiration)] = self.us.list_sessions(userid)
+
+        time.time.return_value = 200.0 + self.us.ttl * 0.25
+        self.assertEqual(users.OK, self.us.check_key(seskey)[0])
+        [(uname, key, expiration1)] = self.us.list_sessions(userid)
+        self.assertEqual(expiration, expiration1)
+
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        self.assertEqual(users.OK, self.us.check_key(seskey)[0])
+        [(uname, key, expiration2)] = self.us.list_sessions(userid)
+        self.assertGreater(expiration2, expiration)
+
+        time.time = time_time
+        self.us.set_refresh_threshold(1.0)
+
+    def test_bad_refresh_threshold(self):
+        "The refresh threshold must be a fraction"
+        self.assertRaises(users.BadCallError, self.us.set_refresh_threshold, 2.0)
+
     def test_session_expires(self):
         "Sessions expire after their time to live"
         userid = self.us.create_user("user11", "pass11", "user11@suchandsu.ch")
@@ -318,6 +465,33 @@ class SessionTests(unittest.TestCase):
 
         time.time = time_time
 
+    def test_check_keys(self):
+        "Many sessions can be checked at once"
+        self.us.create_user("user13", "pass13", "user13@blah.com")
+        u14 = self.us.create_user("user14", "pass14", "user14@choff.com")
+        time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        k13, admin13, u13 = self.us.validate_user("user13", "pass13")
+        time.time.return_value = 500.0
+        k14, admin14, u14 = self.us.validate_user("user14", "pass14", {"n": 14})
+        [(uname, key, expiration)] = self.us.list_sessions(u14)
+        # user13's session has expired, user14's has to be renewed
+        time.time.return_value = 200.0 + self.us.ttl + 60.0
+        results = self.us.check_keys([k13, k14, "nokey"])
+        time.time = time_time
+
+        self.assertEqual(
+            {
+                k13: (users.EXPIRED, None, None, None),
+                k14: (users.OK, "user14", u14, {"n": 14}),
+                "nokey": (users.NOT_FOUND, None, None, None),
+            },
+            results,
+        )
+        [(uname, key, renewed)] = self.us.list_sessions(0)
+        self.assertEqual(k14, key)
+        self.assertGreater(renewed, expiration)
+
     def test_recover_session_xtradata(self):
         self.us.create_user("user12", "pass12", "user12@all.net")
         seskey, admin, userid = self.us.validate_user(
@@ -443,6 +617,42 @@ class SessionTests(unittest.TestCase):
 
         time.time = time_time
 
+    def test_reap_sessions(self):
+        "Expired sessions are deleted a batch at a time"
+        self.us.create_user("user13", "pass13", "user13@blah.com")
+        time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        for i in range(5):
+            time.time.return_value = 200.0 + i
+            self.us.validate_user("user13", "pass13")
+        time.time.return_value = 204.0 + self.us.ttl + 60.0
+        k13, admin13, u13 = self.us.validate_user("user13", "pass13")
+
+        self.assertEqual(2, self.us.reap_sessions(2, 0, max_batches=1))
+        self.assertEqual(3, self.us.reap_sessions(2, 0))
+        self.assertEqual(0, self.us.reap_sessions(2, 0))
+        time.time = time_time
+        [(user, key, expires)] = self.us.list_sessions(0)
+        self.assertEqual(k13, key)
+
+    def test_reaper_thread(self):
+        "The background reaper deletes the expired sessions"
+        self.us.create_user("user13", "pass13", "user13@blah.com")
+        self.us.set_session_TTL(-1000.0)  # well past, the expiration is a real
+        self.us.validate_user("user13", "pass13")
+        self.us.start_reaper(interval=0.05, batch_size=10, sleep=0)
+        reaper = self.us.reaper
+        for i in range(100):
+            if reaper.stats()["reaped"]:
+                break
+            time.sleep(0.05)
+        self.us.stop_reaper()
+        self.us.set_session_TTL(864000.0)
+
+        self.assertIsNone(self.us.reaper)
+        self.assertEqual(1, reaper.stats()["reaped"])
+        self.assertEqual([], list(self.us.list_sessions(0)))
+
     def test_kill_all_sessions_of_user(self):
         self.us.create_user("user13", "pass13", "user13@blah.com")
         u14 = self.us.create_user("user14", "pass14", "user14@choff.com")
@@ -482,5 +692,1063 @@ class SessionTests(unittest.TestCase):
         time.time = time_time
 
 
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen()
+
+    def tearDown(self):
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def test_new_database_is_latest_version(self):
+        "A new database is created with the latest schema"
+        self.assertEqual(latest_version(), schema_version(self.us.connector))
+
+    def test_unversioned_database_gets_upgraded(self):
+        "Tables created before versioning are upgraded in place"
+        csr = self.us.connector.cursor()
+        csr.execute("alter table users drop constraint users_email_key")
+        csr.execute("drop index sessions_expiration_idx")
+        csr.execute("delete from schema_version")
+        self.us.connector.commit()
+        self.assertEqual(1, schema_version(self.us.connector))
+
+        applied = migrate(self.us.connector)
+        self.assertEqual(list(range(2, latest_version() + 1)), [v for v, d in applied])
+        csr.execute("select to_regclass('sessions_expiration_idx') is not null")
+        self.assertTrue(csr.fetchone()[0])
+        self.us.connector.commit()
+        csr.close()
+        self.assertEqual([], migrate(self.us.connector))
+
+    def test_duplicates_stop_upgrade(self):
+        "Users sharing an email stop the upgrade cleanly, and it resumes once fixed"
+        self.us.create_user("user2", "pass2", "user2@abc.de")
+        uid3 = self.us.create_user("user3", "pass3", "user3@abc.de")
+        csr = self.us.connector.cursor()
+        csr.execute("alter table users drop constraint users_email_key")
+        csr.execute(
+            "update users set email = 'user2@abc.de' where userid = %s", (uid3,)
+        )
+        csr.execute("delete from schema_version where version > 1")
+        self.us.connector.commit()
+        with self.assertRaises(users.BadCallError) as raised:
+            reopen()
+        self.assertIn("email 'user2@abc.de' (userids ", str(raised.exception))
+        self.assertEqual(1, schema_version(self.us.connector))
+        csr = self.us.connector.cursor()
+        csr.execute("select to_regclass('users_email_key') is null")
+        self.assertTrue(csr.fetchone()[0])
+
+        csr.execute("update users set email = null where userid = %s", (uid3,))
+        self.us.connector.commit()
+        csr.close()
+        self.us = reopen()
+        self.assertEqual(latest_version(), schema_version(self.us.connector))
+
+    def test_duplicate_email_gives_exception(self):
+        "Exception trying to create a user with an existing email"
+        self.us.create_user("user2", "pass2", "user2@abc.de")
+        self.assertRaises(
+            users.BadCallError, self.us.create_user, "user3", "pass3", "user2@abc.de"
+        )
+
+
+class PartitionTests(unittest.TestCase):
+    def setUp(self):
+        self.time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        self.us = reopen(partitioned_sessions=True)
+        self.us.create_user("user18", "pass18", "user18@later.com")
+
+    def tearDown(self):
+        time.time = self.time_time
+        with self.us._cursor() as csr:
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.connection.commit()
+
+    def partition_of(self, key):
+        with self.us._cursor() as csr:
+            csr.execute(
+                "select tableoid::regclass from sessions where key = %s", (key,)
+            )
+            row = csr.fetchone()
+            csr.connection.commit()
+        return row and row[0]
+
+    def windows(self):
+        with self.us._cursor() as csr:
+            windows = partitions(csr)
+            csr.connection.commit()
+        return windows
+
+    def test_partitions_are_created(self):
+        "Partitions are created from now until past the TTL"
+        windows = self.windows()
+        self.assertEqual((0, 86400), windows[0])
+        self.assertGreater(windows[-1][1], 200.0 + self.us.ttl + 86400.0)
+        self.assertEqual([], self.us.ensure_partitions())
+
+    def test_sessions_move_between_partitions(self):
+        "Sessions live in the partition of their expiration"
+        key, admin, uid = self.us.validate_user("user18", "pass18")
+        self.assertEqual("sessions_864000_950400", self.partition_of(key))
+        time.time.return_value = 200.0 + self.us.ttl * 0.5
+        self.assertEqual((users.OK, "user18", uid, None), self.us.check_key(key))
+        self.assertEqual("sessions_1296000_1382400", self.partition_of(key))
+        self.assertEqual(1, len(list(self.us.list_sessions(uid))))
+        self.us.kill_sessions(uid)
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(key)[0])
+
+    def test_reap_drops_partitions(self):
+        "Partitions whose sessions have all expired are dropped"
+        k1, admin, uid = self.us.validate_user("user18", "pass18")
+        time.time.return_value = 300.0
+        k2, admin, uid = self.us.validate_user("user18", "pass18")
+        time.time.return_value = 900000.0
+        k3, admin, uid = self.us.validate_user("user18", "pass18")
+
+        time.time.return_value = 950400.0
+        self.assertEqual(2, self.us.reap_sessions(sleep=0))
+        self.assertNotIn((864000, 950400), self.windows())
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(k1)[0])
+        self.assertEqual(users.OK, self.us.check_key(k3)[0])
+
+    def test_unpartitioned_table_is_kept(self):
+        "An existing sessions table cannot become partitioned"
+        self.tearDown()
+        self.us = reopen()
+        self.assertRaises(users.BadCallError, reopen, partitioned_sessions=True)
+
+
+class JSONExtraTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(json_extra=True)
+
+    def tearDown(self):
+        with self.us._cursor() as csr:
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.connection.commit()
+
+    def test_extra_data_is_lazy(self):
+        "extra_data stored as JSON is decoded when first read"
+        extra = {"phone": "555-1234", "tags": ["a", "b"]}
+        userid = self.us.create_user("user19", "pass19", "user19@abc.de", False, extra)
+        udata = self.us.find_user(userid=userid)
+        self.assertIsInstance(udata["extra_data"], LazyJSON)
+        self.assertIsNone(udata["extra_data"]._value)
+        self.assertEqual(extra, udata["extra_data"])
+        self.assertEqual(["a", "b"], udata["extra_data"]["tags"])
+
+        key, admin, uid = self.us.validate_user("user19", "pass19", [1, 2])
+        self.assertEqual((users.OK, "user19", uid, [1, 2]), self.us.check_key(key))
+
+    def test_create_users_invalid_extra(self):
+        "Users whose extra_data cannot be stored as JSON are reported"
+        created, failures = self.us.create_users(
+            [("user26", "pw", "u26@x.org", False, {"s": {1}}), ("user27", "pw")]
+        )
+        self.assertEqual(
+            (1, [(0, "user26", "invalid extra_data")]), (created, failures)
+        )
+
+    def test_find_users_by_extra(self):
+        "Users can be searched by the contents of their extra_data"
+        self.us.create_user("user20", "pass20", "user20@abc.de", False, {"plan": "pro"})
+        u21 = self.us.create_user(
+            "user21", "pass21", "user21@abc.de", False, {"plan": "pro", "seats": 3}
+        )
+        self.us.create_user("user22", "pass22", "user22@abc.de")
+        found = self.us.find_users_by_extra(plan="pro")
+        self.assertEqual(["user20", "user21"], [u["username"] for u in found])
+        [udata] = self.us.find_users_by_extra(plan="pro", seats=3)
+        self.assertEqual(u21, udata["userid"])
+        self.assertEqual([], self.us.find_users_by_extra(plan="free"))
+        self.assertRaises(
+            users.BadCallError, self.us.modify_user, u21, extra_data={"s": {1, 2}}
+        )
+
+    def test_convert_extra_data(self):
+        "Pickled extra_data can be converted to JSON"
+        self.us.json_extra = False
+        self.us.create_user("user23", "pass23", "user23@abc.de", False, {"plan": "pro"})
+        self.us.create_user("user24", "pass24", "user24@abc.de", False, {"s": {1, 2}})
+        self.us.create_users([("user25", "pass25", "user25@abc.de", False, {"n": 1})])
+        lossy = {1: "one", "t": (1, 2)}
+        self.us.create_user("user26", "pass26", "user26@abc.de", False, lossy)
+        self.assertEqual([], self.us.find_users_by_extra(plan="pro"))
+
+        self.assertEqual(2, self.us.convert_extra_data(batch_size=2))
+        [udata] = self.us.find_users_by_extra(plan="pro")
+        self.assertEqual("user23", udata["username"])
+        self.assertEqual({"n": 1}, self.us.find_user("user25")["extra_data"])
+        self.assertEqual({"s": {1, 2}}, self.us.find_user("user24")["extra_data"])
+        self.assertEqual(lossy, self.us.find_user("user26")["extra_data"])
+
+    def test_extra_data_changed_by_json(self):
+        "extra_data that JSON would not give back the same is refused"
+        for extra in ({1: "one"}, {"t": (1, 2)}, [float("nan")]):
+            self.assertRaises(
+                users.BadCallError,
+                self.us.create_user,
+                "user27",
+                "pass27",
+                "user27@abc.de",
+                False,
+                extra,
+            )
+        self.assertIsNone(self.us.find_user("user27"))
+
+
+class TokenTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(token_secret="s3cret")
+        self.uid = self.us.create_user("user26", "pass26", "user26@abc.de")
+
+    def tearDown(self):
+        with self.us._cursor() as csr:
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.execute("drop table if exists revocations")
+            csr.connection.commit()
+
+    def test_token_checked_without_database(self):
+        "Tokens are verified without querying the database"
+        token, admin, uid = self.us.validate_user("user26", "pass26", {"ip": "::1"})
+        self.assertEqual(self.uid, uid)
+        self.assertEqual([], list(self.us.list_sessions(0)))
+        self.assertEqual(
+            (users.OK, "user26", uid, {"ip": "::1"}), self.us.check_key(token)
+        )
+
+        self.us._cursor = MagicMock(side_effect=AssertionError("database used"))
+        try:
+            self.assertEqual(users.OK, self.us.check_key(token)[0])
+        finally:
+            del self.us._cursor
+
+    def test_bad_tokens(self):
+        "Tokens not signed with the secret are rejected"
+        token, admin, uid = self.us.validate_user("user26", "pass26")
+        body, signature = token.split(".")
+        now = time.time()
+        forged = TokenSigner("other").issue(uid, "user26", True, now, now + 60.0)
+        for bad in (
+            forged,
+            forged.split(".")[0] + "." + signature,
+            body + "." + signature[::-1],
+        ):
+            self.assertEqual(users.NOT_FOUND, self.us.check_key(bad)[0])
+        self.assertEqual(users.NOT_FOUND, self.us.check_key("not.a.token")[0])
+
+    def test_tokens_checked_together(self):
+        "check_keys() verifies the tokens among the keys as check_key() does"
+        token, admin, uid = self.us.validate_user("user26", "pass26", {"ip": "::1"})
+        self.assertEqual(
+            {
+                token: (users.OK, "user26", uid, {"ip": "::1"}),
+                "not.a.token": (users.NOT_FOUND, None, None, None),
+                "nokey": (users.NOT_FOUND, None, None, None),
+            },
+            self.us.check_keys([token, "not.a.token", "nokey"]),
+        )
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(None)[0])
+
+    def test_secret_rotation(self):
+        "Tokens signed with an older secret are still accepted"
+        token, admin, uid = self.us.validate_user("user26", "pass26")
+        self.us = reopen(token_secret=["n3w", "s3cret"])
+        self.assertEqual(users.OK, self.us.check_key(token)[0])
+
+    def test_token_expires(self):
+        "Tokens expire after the TTL since they were issued"
+        time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        token, admin, uid = self.us.validate_user("user26", "pass26")
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        self.assertEqual(users.OK, self.us.check_key(token)[0])
+        time.time.return_value = 200.0 + self.us.ttl + 1.0
+        self.assertEqual(users.EXPIRED, self.us.check_key(token)[0])
+        time.time = time_time
+
+    def test_tokens_get_revoked(self):
+        "Killing sessions and changing the password revoke tokens"
+        token, admin, uid = self.us.validate_user("user26", "pass26")
+        self.us.kill_sessions(uid)
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(token)[0])
+
+        token, admin, uid = self.us.validate_user("user26", "pass26")
+        self.assertEqual(users.OK, self.us.check_key(token)[0])
+        self.us.change_password(uid, "newpass26", "pass26")
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(token)[0])
+
+        token, admin, uid = self.us.validate_user("user26", "newpass26")
+        self.assertEqual(users.OK, self.us.check_key(token)[0])
+
+    def test_revocations_from_elsewhere(self):
+        "Revocations recorded by other processes are read periodically"
+        token, admin, uid = self.us.validate_user("user26", "pass26")
+        self.assertEqual(users.OK, self.us.check_key(token)[0])
+        with self.us._cursor() as csr:
+            csr.execute(
+                "insert into revocations (userid, issued_before, expiration) "
+                "values (%s, %s, %s)",
+                (uid, time.time(), time.time() + 60.0),
+            )
+            csr.connection.commit()
+        self.assertEqual(users.OK, self.us.check_key(token)[0])
+        self.us.revocations.refreshed_at -= self.us.revocations.max_age + 1.0
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(token)[0])
+
+
+class SessionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(cache_size=2, cache_max_age=30.0)
+
+    def tearDown(self):
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def delete_session_rows(self):
+        csr = self.us.connector.cursor()
+        csr.execute("delete from sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def test_cache_hit_skips_database(self):
+        "A cached session is validated without reading the database"
+        uid = self.us.create_user("user16", "pass16", "user16@cache.org")
+        key, admin, uid = self.us.validate_user("user16", "pass16", {"a": 1})
+        self.us.check_key(key)
+        self.delete_session_rows()
+        self.assertEqual((users.OK, "user16", uid, {"a": 1}), self.us.check_key(key))
+        stats = self.us.session_cache.stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+
+    def test_cache_entries_go_stale(self):
+        "Cached sessions are read again after cache_max_age"
+        self.us.create_user("user16", "pass16", "user16@cache.org")
+        time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+        key, admin, uid = self.us.validate_user("user16", "pass16")
+        self.us.check_key(key)
+        self.delete_session_rows()
+        time.time.return_value = 240.0
+        rc, uname, uid, xtra = self.us.check_key(key)
+        time.time = time_time
+        self.assertEqual(users.NOT_FOUND, rc)
+
+    def test_killed_sessions_are_evicted(self):
+        "Killing sessions removes them from the cache"
+        uid = self.us.create_user("user16", "pass16", "user16@cache.org")
+        key, admin, uid = self.us.validate_user("user16", "pass16")
+        self.us.check_key(key)
+        self.us.kill_sessions(uid)
+        self.assertEqual(users.NOT_FOUND, self.us.check_key(key)[0])
+
+    def test_least_recently_used_evicted(self):
+        "The cache holds at most cache_size sessions"
+        self.us.create_user("user16", "pass16", "user16@cache.org")
+        keys = []
+        for i in range(3):
+            key, admin, uid = self.us.validate_user("user16", "pass16")
+            keys.append(key)
+            self.us.check_key(key)
+        stats = self.us.session_cache.stats()
+        self.assertEqual(2, stats["size"])
+        self.assertEqual(1, stats["evictions"])
+        self.assertIsNone(self.us.session_cache.get(keys[0], time.time()))
+
+
+class WriteBehindTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(write_behind=True, flush_interval=None, flush_size=3)
+        self.us.create_user("user17", "pass17", "user17@later.com")
+        self.time_time = time.time
+        time.time = MagicMock(return_value=200.0)
+
+    def tearDown(self):
+        time.time = self.time_time
+        self.us = reopen()  # writes the queue, and reconnects if pooled
+        with self.us._cursor() as csr:
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.connection.commit()
+
+    def stored_expiration(self, key):
+        with self.us._cursor() as csr:
+            csr.execute("select expiration from sessions where key = %s", (key,))
+            expiration = csr.fetchone()[0]
+            csr.connection.commit()
+        return expiration
+
+    def test_renewals_are_queued(self):
+        "Renewed expirations are only written when flushed"
+        key, admin, uid = self.us.validate_user("user17", "pass17")
+        expiration = self.stored_expiration(key)
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+        self.assertEqual(expiration, self.stored_expiration(key))
+        self.assertEqual(1, self.us.flush())
+        self.assertGreater(self.stored_expiration(key), expiration)
+
+    def test_queued_renewal_keeps_session_alive(self):
+        "A session renewed but not yet written does not expire"
+        key, admin, uid = self.us.validate_user("user17", "pass17")
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        self.us.check_key(key)
+        time.time.return_value = 200.0 + self.us.ttl * 1.5
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+
+    def test_full_queue_gets_written(self):
+        "The queue is written when flush_size sessions are waiting"
+        keys = []
+        for i in range(3):
+            time.time.return_value = 200.0 + i
+            keys.append(self.us.validate_user("user17", "pass17")[0])
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        for key in keys:
+            self.us.check_key(key)
+        stats = self.us.touch_queue.stats()
+        self.assertEqual(0, stats["pending"])
+        self.assertEqual(3, stats["written"])
+
+    def test_full_queue_written_with_one_connection(self):
+        "A pooled check_key() writes the full queue once its connection is back"
+        self.us = reopen(
+            write_behind=True,
+            flush_interval=None,
+            flush_size=1,
+            maxconn=1,
+            pool_timeout=2,
+        )
+        key, admin, uid = self.us.validate_user("user17", "pass17")
+        expiration = self.stored_expiration(key)
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+        self.assertEqual(1, self.us.touch_queue.stats()["written"])
+        self.assertGreater(self.stored_expiration(key), expiration)
+
+    def test_close_writes_queue(self):
+        "Closing the userspace writes the queued renewals"
+        key, admin, uid = self.us.validate_user("user17", "pass17")
+        expiration = self.stored_expiration(key)
+        time.time.return_value = 200.0 + self.us.ttl * 0.75
+        self.us.check_key(key)
+        self.us.close()
+        self.assertGreater(self.stored_expiration(key), expiration)
+
+
+class HashExecutorTests(unittest.TestCase):
+    def tearDown(self):
+        self.us.hash_executor.shutdown()
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def check_logins(self, executor):
+        self.us = reopen(hash_executor=executor)
+        uid = self.us.create_user("user18", "pass18", "user18@hash.net")
+        results = []
+
+        def worker(password):
+            results.append(self.us.validate_user("user18", password)[2])
+
+        threads = [
+            threading.Thread(target=worker, args=(pwd,))
+            for pwd in ["pass18", "bad18"] * 3
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([None] * 3 + [uid] * 3, sorted(results, key=bool))
+        stats = executor.stats()
+        self.assertEqual(7, stats["completed"])
+        self.assertEqual(0, executor.queue_depth)
+        self.assertLessEqual(stats["max_depth"], 2)
+
+    def test_thread_executor(self):
+        "Passwords can be hashed on a pool of threads"
+        self.check_logins(users.HashExecutor("thread", max_workers=2, max_pending=2))
+
+    def test_process_executor(self):
+        "Passwords can be hashed on a pool of processes"
+        self.check_logins(users.HashExecutor("process", max_workers=2, max_pending=2))
+
+    def test_bad_executor_kind(self):
+        "Only thread and process executors exist"
+        self.us = reopen(hash_executor=users.HashExecutor())
+        self.assertRaises(ValueError, users.HashExecutor, "fibers")
+
+
+class HasherTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(hasher=users.PBKDF2Hasher(1000))
+
+    def tearDown(self):
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def stored_hasher(self, userid):
+        csr = self.us.connector.cursor()
+        csr.execute("select hasher from users where userid = %s", (userid,))
+        hasher = csr.fetchone()[0]
+        self.us.connector.commit()
+        csr.close()
+        return hasher
+
+    def test_hasher_is_stored(self):
+        "The hasher used for a password is stored with it"
+        uid = self.us.create_user("user19", "pass19", "user19@hash.net")
+        self.assertEqual("pbkdf2$sha512$1000", self.stored_hasher(uid))
+
+    def test_scrypt(self):
+        "Users can be authenticated with scrypt hashes"
+        self.us = reopen(hasher=users.ScryptHasher(2**12))
+        uid = self.us.create_user("user19", "pass19", "user19@hash.net")
+        self.assertEqual("scrypt$4096$8$1", self.stored_hasher(uid))
+        self.assertEqual(uid, self.us.validate_user("user19", "pass19")[2])
+        self.assertIsNone(self.us.validate_user("user19", "pass20")[2])
+
+    def test_rehash_on_login(self):
+        "Passwords are re-hashed with the current hasher on login"
+        uid = self.us.create_user("user19", "pass19", "user19@hash.net")
+        self.us = reopen(hasher=users.PBKDF2Hasher(2000))
+        self.assertIsNone(self.us.validate_user("user19", "pass20")[2])
+        self.assertEqual("pbkdf2$sha512$1000", self.stored_hasher(uid))
+        self.assertEqual(uid, self.us.validate_user("user19", "pass19")[2])
+        self.assertEqual("pbkdf2$sha512$2000", self.stored_hasher(uid))
+        self.assertEqual(uid, self.us.validate_user("user19", "pass19")[2])
+
+    def test_login_is_one_transaction(self):
+        "A login re-hashing the password writes in a single transaction"
+        uid = self.us.create_user("user19", "pass19", "user19@hash.net")
+        self.us = reopen(hasher=users.PBKDF2Hasher(2000), sync_session_commit=False)
+        cursor = self.us._cursor
+        self.us._cursor = MagicMock(side_effect=cursor)
+        try:
+            key, admin, userid = self.us.validate_user("user19", "pass19")
+            self.assertEqual(2, self.us._cursor.call_count)  # read, then write
+        finally:
+            del self.us._cursor
+        self.assertEqual("pbkdf2$sha512$2000", self.stored_hasher(uid))
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+
+    def test_legacy_passwords(self):
+        "Passwords stored without a hasher are PBKDF2 with 100000 iterations"
+        self.us = reopen()
+        uid = self.us.create_user("user19", "pass19", "user19@hash.net")
+        csr = self.us.connector.cursor()
+        csr.execute("update users set hasher = null")
+        self.us.connector.commit()
+        csr.close()
+        self.us = reopen(hasher=users.PBKDF2Hasher(1000))
+        self.assertEqual(uid, self.us.validate_user("user19", "pass19")[2])
+        self.assertEqual("pbkdf2$sha512$1000", self.stored_hasher(uid))
+
+    def test_legacy_passwords_kept(self):
+        "Passwords stored without a hasher are not re-hashed with the default one"
+        self.us = reopen()
+        uid = self.us.create_user("user19", "pass19", "user19@hash.net")
+        csr = self.us.connector.cursor()
+        csr.execute("update users set hasher = null")
+        csr.execute("select kpasswd from users where userid = %s", (uid,))
+        kpasswd = csr.fetchone()[0]
+        self.us.connector.commit()
+        hash_calls = []
+        hash = self.us._hash
+        self.us._hash = lambda *args: hash_calls.append(args) or hash(*args)
+        try:
+            self.assertEqual(uid, self.us.validate_user("user19", "pass19")[2])
+        finally:
+            del self.us._hash
+        self.assertEqual(1, len(hash_calls))
+        self.assertIsNone(self.stored_hasher(uid))
+        csr.execute("select kpasswd from users where userid = %s", (uid,))
+        self.assertEqual(kpasswd, csr.fetchone()[0])
+        self.us.connector.commit()
+        csr.close()
+
+    def test_calibrate(self):
+        "Calibrated hashers take at least the target time"
+        hasher = users.calibrate(users.PBKDF2Hasher, 0.01)
+        self.assertGreaterEqual(hash_time(hasher), 0.01 * 0.5)
+        self.assertIsInstance(
+            users.calibrate(users.ScryptHasher, 0.001), users.ScryptHasher
+        )
+
+
+class PreparedStatementTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(hasher=users.PBKDF2Hasher(1000))
+
+    def tearDown(self):
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def prepared_statements(self):
+        csr = self.us.connector.cursor()
+        csr.execute("select name from pg_prepared_statements")
+        names = {row[0] for row in csr.fetchall()}
+        self.us.connector.commit()
+        csr.close()
+        return names
+
+    def login(self):
+        self.us.create_user("user20", "pass20", "user20@prep.net")
+        key = self.us.validate_user("user20", "pass20")[0]
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+        self.assertEqual("user20", self.us.find_user(username="user20")["username"])
+        return key
+
+    def test_statements_prepared_once(self):
+        "The hot statements are prepared on first use and reused"
+        self.login()
+        key = self.us.validate_user("user20", "pass20")[0]
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+        self.assertLessEqual(
+            {"login", "insert_session", "check_session", "find_user_username"},
+            self.us.connector.prepared,
+        )
+        self.assertEqual(
+            {"pgusers_" + name for name in self.us.connector.prepared},
+            self.prepared_statements(),
+        )
+
+    def test_prepared_again_after_reconnecting(self):
+        "A new connection prepares the statements again"
+        key = self.login()
+        self.us.connector.close()
+        self.assertEqual(users.OK, self.us.check_key(key)[0])
+        self.assertIn("check_session", self.us.connector.prepared)
+        self.assertNotIn("login", self.us.connector.prepared)
+        self.assertEqual(
+            {"pgusers_" + name for name in self.us.connector.prepared},
+            self.prepared_statements(),
+        )
+
+    def test_failed_statement_stays_prepared(self):
+        "A statement failing after being prepared is not prepared twice"
+        uid = self.us.create_user("user20", "pass20", "user20@prep.net")
+        with self.assertRaises(psycopg2.DataError):
+            self.us.find_user(userid="user20")
+        self.assertEqual("user20", self.us.find_user(userid=uid)["username"])
+        self.assertIn("pgusers_find_user_userid", self.prepared_statements())
+
+    def test_not_prepared(self):
+        "Statements are run as they are with prepare_statements=False"
+        self.us = reopen(prepare_statements=False)
+        self.login()
+        self.assertFalse(hasattr(self.us.connector, "prepared"))
+        self.assertEqual(set(), self.prepared_statements())
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(hasher=users.PBKDF2Hasher(1000))
+        self.uid = self.us.create_user("user21", "pass21", "user21@metrics.net")
+        self.us.metrics.reset()
+
+    def tearDown(self):
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        self.us.connector.commit()
+        csr.close()
+
+    def test_calls_by_outcome(self):
+        "Calls are counted by method and outcome"
+        key = self.us.validate_user("user21", "pass21")[0]
+        self.us.validate_user("user21", "wrong")
+        self.us.check_key(key)
+        self.us.check_key("nokey")
+        with self.assertRaises(users.BadCallError):
+            self.us.create_user("user21", "pass21", "user21@metrics.net")
+        self.assertEqual(
+            {
+                ("validate_user", "ok"): 1,
+                ("validate_user", "rejected"): 1,
+                ("check_key", "ok"): 1,
+                ("check_key", "not_found"): 1,
+                ("create_user", "BadCallError"): 1,
+            },
+            self.us.metrics.snapshot()["calls"],
+        )
+
+    def test_phases(self):
+        "The latency of a login is split into hashing, queries and commits"
+        self.us.validate_user("user21", "pass21")  # prepares the statements
+        self.us.metrics.reset()
+        self.us.validate_user("user21", "pass21")
+        snap = self.us.metrics.snapshot()
+        for phase in ("total", "hash", "query", "commit"):
+            buckets, count, total = snap["latency"]["validate_user", phase]
+            self.assertEqual(1, count)
+            self.assertEqual(1, buckets[-1][1])
+        self.assertGreater(
+            snap["latency"]["validate_user", "total"][2],
+            snap["latency"]["validate_user", "hash"][2],
+        )
+        self.assertEqual(2, snap["queries"]["validate_user"])  # select, insert
+        self.assertEqual(2, snap["rows"]["validate_user"])
+
+    def test_generator_rows(self):
+        "The rows of the generator methods are the items they yield"
+        self.us.create_user("user22", "pass22", "user22@metrics.net")
+        self.assertEqual(2, len(list(self.us.all_users())))
+        self.assertEqual(2, self.us.metrics.snapshot()["rows"]["all_users"])
+
+    def test_sink(self):
+        "Sinks get the details of every call"
+        calls = []
+        self.us.metrics.add_sink(lambda *args: calls.append(args))
+        self.us.find_user(userid=self.uid)
+        self.us.find_user(username="nobody")
+        self.assertEqual(["ok", "not_found"], [call[1] for call in calls])
+        method, outcome, timings, rows = calls[0]
+        self.assertEqual("find_user", method)
+        self.assertEqual(1, rows)
+        self.assertGreaterEqual(timings["total"], timings["query"])
+
+    def test_prometheus(self):
+        "The metrics are exported in the Prometheus text format"
+        self.us.check_key("nokey")  # prepares the statement
+        self.us.metrics.reset()
+        self.us.check_key("nokey")
+        text = self.us.metrics.prometheus()
+        self.assertIn(
+            'pgusers_calls_total{method="check_key",outcome="not_found"} 1\n', text
+        )
+        self.assertIn(
+            'pgusers_call_seconds_bucket{method="check_key",phase="total",le="+Inf"} 1',
+            text,
+        )
+        self.assertIn(
+            'pgusers_call_seconds_count{method="check_key",phase="query"}', text
+        )
+        self.assertIn('pgusers_queries_total{method="check_key"} 1\n', text)
+
+    def test_disabled(self):
+        "No metrics are kept with metrics=False"
+        self.us = reopen(metrics=False)
+        self.assertIsNone(self.us.metrics)
+        self.assertEqual(users.NOT_FOUND, self.us.check_key("nokey")[0])
+
+
+class TenantTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(maxconn=2, hasher=users.PBKDF2Hasher(1000))
+
+    def tearDown(self):
+        with self.us._cursor() as csr:
+            csr.execute("drop schema if exists tenant1 cascade")
+            csr.execute('drop schema if exists "Tenant 2" cascade')
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.connection.commit()
+
+    def test_tenants_are_separate(self):
+        "Each tenant has its own users and sessions"
+        t1 = self.us.create_tenant("tenant1")
+        t2 = self.us.create_tenant("Tenant 2")
+        uid1 = t1.create_user("user24", "pass24", "user24@one.net")
+        uid2 = t2.create_user("user24", "pass24", "user24@two.net", admin=True)
+        key, admin, userid = t2.validate_user("user24", "pass24")
+        self.assertEqual((uid2, True), (userid, admin))
+        self.assertEqual(users.OK, t2.check_key(key)[0])
+        self.assertEqual(users.NOT_FOUND, t1.check_key(key)[0])
+        self.assertEqual("user24@one.net", t1.find_user(userid=uid1)["email"])
+        self.assertIsNone(self.us.find_user(username="user24"))
+        self.assertEqual(["Tenant 2", "tenant1"], self.us.tenants())
+        self.assertEqual(self.us.tenants(), t1.tenants())
+        self.assertLessEqual(self.us.pool.stats()["in_use"], 2)
+
+    def test_opening_is_free(self):
+        "Opening a tenant runs no query and returns the same userspace"
+        self.us.create_tenant("tenant1")
+        self.us.open_tenants.clear()
+        cursor = self.us._cursor
+        self.us._cursor = MagicMock(side_effect=cursor)
+        try:
+            t1 = self.us.tenant("tenant1")
+            self.assertIs(t1, self.us.tenant("tenant1"))
+            self.assertEqual(0, self.us._cursor.call_count)
+        finally:
+            del self.us._cursor
+        self.assertIs(t1.pool, self.us.pool)
+        self.assertEqual([], list(t1.all_users()))
+
+    def test_drop_tenant(self):
+        "Dropping a tenant drops its schema"
+        t1 = self.us.create_tenant("tenant1")
+        t1.create_user("user24", "pass24", "user24@one.net")
+        self.us.drop_tenant("tenant1")
+        self.assertEqual([], self.us.tenants())
+        self.assertEqual([], list(self.us.create_tenant("tenant1").all_users()))
+
+    def test_tenants_need_pool(self):
+        "Tenants can only be opened on a pooled userspace"
+        self.us = reopen()
+        self.assertRaises(users.BadCallError, self.us.tenant, "tenant1")
+
+
+class ThrottleTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(
+            hasher=users.PBKDF2Hasher(1000), login_rate=1e-6, login_burst=3
+        )
+        self.uid = self.us.create_user("user25", "pass25", "user25@throttle.net")
+
+    def tearDown(self):
+        csr = self.us.connector.cursor()
+        csr.execute("drop table if exists users")
+        csr.execute("drop table if exists sessions")
+        csr.execute("drop table if exists login_throttle")
+        self.us.connector.commit()
+        csr.close()
+
+    def test_failures_throttled(self):
+        "Failed logins over the limit are refused before hashing"
+        self.us.metrics.reset()
+        for n in range(3):
+            self.assertEqual(("", False, None), self.us.validate_user("user25", "bad"))
+        self.us._hash = MagicMock()
+        try:
+            self.assertEqual(
+                ("", False, None), self.us.validate_user("user25", "pass25")
+            )
+            self.assertEqual(0, self.us._hash.call_count)
+        finally:
+            del self.us._hash
+        self.assertEqual(
+            {("validate_user", "rejected"): 3, ("validate_user", "throttled"): 1},
+            self.us.metrics.snapshot()["calls"],
+        )
+        self.assertEqual(1, self.us.throttle.stats()["throttled"])
+
+    def test_successes_not_counted(self):
+        "Successful logins give their attempts back"
+        for n in range(5):
+            self.assertEqual(self.uid, self.us.validate_user("user25", "pass25")[2])
+        self.us.validate_user("user25", "bad")
+        self.us.validate_user("user25", "bad")
+        self.assertEqual(self.uid, self.us.validate_user("user25", "pass25")[2])
+
+    def test_client_limit(self):
+        "The attempts of a client are limited across usernames"
+        self.us = reopen(
+            hasher=users.PBKDF2Hasher(1000), client_rate=1e-6, client_burst=2
+        )
+        for name in ("nobody", "user25"):
+            self.us.validate_user(name, "bad", client="10.0.0.1")
+        self.assertEqual(
+            ("", False, None),
+            self.us.validate_user("user25", "pass25", client="10.0.0.1"),
+        )
+        self.assertEqual(
+            self.uid, self.us.validate_user("user25", "pass25", client="10.0.0.2")[2]
+        )
+        self.assertEqual(self.uid, self.us.validate_user("user25", "pass25")[2])
+
+    def test_shared(self):
+        "In shared mode the attempts are counted for every process"
+        self.us = reopen(login_rate=1e-6, login_burst=2, shared_throttle=True)
+        self.us.validate_user("user25", "bad")
+        self.us.validate_user("user25", "bad")
+        other = SharedLoginThrottle(self.us._cursor, 1e-6, burst=2)
+        now = time.time()
+        self.assertFalse(other.acquire(other.limits("user25"), now))
+        self.assertTrue(other.acquire(other.limits("user26"), now))
+        self.assertEqual(2, other.stats()["size"])
+        self.us.throttle.clear()
+        self.assertTrue(other.acquire(other.limits("user25"), now))
+
+    def test_buckets(self):
+        "Buckets refill with time and the least recently used are evicted"
+        throttle = LoginThrottle(0.5, burst=2, max_size=2)
+        limits = throttle.limits("user25")
+        self.assertTrue(throttle.acquire(limits, 100.0))
+        self.assertTrue(throttle.acquire(limits, 100.0))
+        self.assertFalse(throttle.acquire(limits, 101.0))
+        self.assertTrue(throttle.acquire(limits, 102.0))
+        throttle.release(limits, 102.0)
+        self.assertTrue(throttle.acquire(limits, 102.0))
+        for name in ("user26", "user27"):
+            throttle.acquire(throttle.limits(name), 102.0)
+        self.assertEqual(
+            {
+                "size": 2,
+                "max_size": 2,
+                "allowed": 6,
+                "throttled": 1,
+                "evictions": 1,
+            },
+            throttle.stats(),
+        )
+        self.assertTrue(throttle.acquire(limits, 102.0))
+        self.assertEqual(
+            ["tenant1.user:user25"],
+            [key for key, rate, burst in throttle.limits("user25", scope="tenant1")],
+        )
+
+
+class ReplicaTests(unittest.TestCase):
+    def tearDown(self):
+        with self.us._cursor() as csr:
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.connection.commit()
+        self.us.close()
+
+    def reads(self):
+        return [replica["reads"] for replica in self.us.replicas.stats()]
+
+    def test_reads_go_to_replicas(self):
+        "Read only methods use the replicas in turn"
+        # the same database stands in for the replicas
+        self.us = reopen(replicas=[{}, {"application_name": "r2"}])
+        uid = self.us.create_user("user27", "pass27", "user27@abc.de")
+        self.assertEqual([0, 0], self.reads())
+        self.assertEqual("user27", self.us.find_user(userid=uid)["username"])
+        self.assertFalse(self.us.is_admin(uid))
+        self.assertEqual(1, len(list(self.us.all_users())))
+        self.assertEqual(0, len(list(self.us.list_sessions(0))))
+        self.assertEqual([2, 2], self.reads())
+
+    def test_failed_replica_left_out(self):
+        "A replica that cannot be reached is not used for a while"
+        self.us = reopen(replicas=[{"port": "1"}, {}])
+        uid = self.us.create_user("user27", "pass27", "user27@abc.de")
+        for i in range(3):
+            self.assertEqual("user27", self.us.find_user(userid=uid)["username"])
+        bad, good = self.us.replicas.stats()
+        self.assertEqual((False, 1, 0), (bad["up"], bad["failures"], bad["reads"]))
+        self.assertEqual(3, good["reads"])
+
+    def test_read_your_writes(self):
+        "A thread reads from the primary for a while after writing"
+        self.us = reopen(replicas=[{}], read_your_writes=30.0)
+        uid = self.us.create_user("user27", "pass27", "user27@abc.de")
+        self.assertIsNotNone(self.us.find_user(userid=uid))
+        self.assertEqual([0], self.reads())
+
+        other = threading.Thread(target=self.us.find_user, kwargs={"userid": uid})
+        other.start()
+        other.join()
+        self.assertEqual([1], self.reads())
+
+        self.us.last_write.at -= 31.0
+        self.assertIsNotNone(self.us.find_user(userid=uid))
+        self.assertEqual([2], self.reads())
+
+
+class PoolTests(unittest.TestCase):
+    def setUp(self):
+        self.us = reopen(minconn=1, maxconn=3, pool_timeout=0.5)
+
+    def tearDown(self):
+        with self.us._cursor() as csr:
+            csr.execute("drop table if exists users")
+            csr.execute("drop table if exists sessions")
+            csr.connection.commit()
+        self.us.close()
+
+    def test_opening_again_keeps_pool(self):
+        "Opening the userspace again leaves alone the connections in use"
+        for n in range(3):
+            self.us.create_user(f"user3{n}", "pass", f"user3{n}@pool.org")
+        self.us.set_itersize(1)
+        pool = self.us.pool
+        rows = self.us.all_users()
+        first = next(rows)
+        self.assertIs(self.us, users.UserSpace(DBNAME, maxconn=4))
+        self.assertIs(pool, self.us.pool)
+        self.assertEqual(3, len([first] + list(rows)))
+        self.assertEqual(0, pool.stats()["in_use"])
+
+    def test_pooled_sessions_from_threads(self):
+        "Sessions can be checked concurrently from several threads"
+        self.us.create_user("user15", "pass15", "user15@pool.org")
+        key, admin, uid = self.us.validate_user("user15", "pass15")
+        results = []
+
+        def worker():
+            for i in range(10):
+                results.append(self.us.check_key(key)[0])
+
+        threads = [threading.Thread(target=worker) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([users.OK] * 60, results)
+        stats = self.us.pool.stats()
+        self.assertEqual(0, stats["in_use"])
+        self.assertGreaterEqual(stats["checkouts"], 60)
+
+    def test_concurrent_create_user(self):
+        "Only one of several concurrent creations of a username succeeds"
+        self.us.hasher = users.PBKDF2Hasher(1000)
+        barrier = threading.Barrier(3)
+        results = []
+
+        def worker(i):
+            barrier.wait()
+            try:
+                results.append(
+                    self.us.create_user("user16", "pass16", f"u16-{i}@x.org")
+                )
+            except users.BadCallError as err:
+                results.append(str(err))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len([r for r in results if isinstance(r, int)]))
+        self.assertEqual(2, results.count("User 'user16' already in database"))
+        self.assertEqual(1, len(list(self.us.all_users())))
+        email = self.us.find_user("user16")["email"]
+        self.assertRaisesRegex(
+            users.BadCallError,
+            f"Email '{email}' already",
+            self.us.create_user,
+            "user17",
+            "pass17",
+            email,
+        )
+
+    def test_pool_timeout(self):
+        "Checking out more than maxconn connections times out"
+        conns = [self.us.pool.getconn() for i in range(3)]
+        self.assertRaises(PoolError, self.us.find_user, userid=1)
+        for conn in conns:
+            self.us.pool.putconn(conn)
+        self.assertEqual(1, self.us.pool.stats()["timeouts"])
+        self.assertIsNone(self.us.find_user(userid=1))
+
+
 if __name__ == "__main__":
     unittest.main()